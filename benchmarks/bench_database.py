@@ -0,0 +1,110 @@
+"""get_user / get_user_directories throughput under concurrency.
+
+Compares the old access pattern (a fresh sqlite3.connect per call, rollback
+journal) with DatabaseHandler's per-thread WAL connections, while a background
+thread keeps registering users and creating directories like a login storm.
+
+Usage:
+    python -m benchmarks.bench_database [--threads 1,8,32] [--seconds 3]
+"""
+import io
+import os
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+import contextlib
+
+from src.db.database_handler import DatabaseHandler
+
+USERS = 200
+DIRECTORIES_PER_USER = 5
+
+
+class LegacyDatabaseHandler(DatabaseHandler):
+    """The pre-pool behaviour: connect, run one statement, close, per call (rollback journal)."""
+    PRAGMAS = ()
+
+    def get_user(self, username, password_hash):
+        with sqlite3.connect(self.db_name) as conn:
+            user = conn.execute('''SELECT * FROM users WHERE username = ? AND password_hash = ?''',
+                                (username, password_hash)).fetchone()
+        conn.close()
+        return user
+
+    def get_user_directories(self, user_id):
+        with sqlite3.connect(self.db_name) as conn:
+            rows = conn.execute('''SELECT * FROM directories WHERE user_id = ?''', (user_id,)).fetchall()
+        conn.close()
+        return rows
+
+
+def populate(handler_class, db_name):
+    handler = handler_class(db_name)
+    for i in range(USERS):
+        handler.register_user(f"user{i}", f"hash{i}")
+        for j in range(DIRECTORIES_PER_USER):
+            handler.add_directory(i + 1, f"dir{j}")
+    handler.close()
+
+
+def run(handler, threads, seconds):
+    stop = threading.Event()
+    counts = [0] * threads
+
+    def reader(index):
+        n = 0
+        while not stop.is_set():
+            user = n % USERS
+            handler.get_user(f"user{user}", f"hash{user}")
+            handler.get_user_directories(user + 1)
+            n += 1
+        counts[index] = n * 2
+
+    def writer():
+        n = 0
+        while not stop.is_set():
+            handler.add_directory(1, f"storm{n}")
+            n += 1
+            time.sleep(0.001)
+
+    workers = [threading.Thread(target=reader, args=(i,)) for i in range(threads)]
+    workers.append(threading.Thread(target=writer))
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", default="1,8,32")
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+
+    results = {}
+    # Handler methods print on every write; keep the report readable
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        for name, handler_class in (("legacy", LegacyDatabaseHandler), ("pooled", DatabaseHandler)):
+            db_name = os.path.join(tmp, f"{name}.db")
+            populate(handler_class, db_name)
+            handler = handler_class(db_name)
+            results[name] = {
+                threads: round(run(handler, int(threads), args.seconds))
+                for threads in args.threads.split(",")
+            }
+            handler.close()
+
+    for name, by_threads in results.items():
+        for threads, ops in by_threads.items():
+            print(f"{name:>7} threads={threads:>3}: {ops:10,} reads/s")
+    print(json.dumps({"reads_per_second": results}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""DHCP server throughput under a simulated boot storm.
+
+Starts a DhcpServer in a child process on a loopback port and fires DISCOVERs
+from thousands of simulated MACs through one non-blocking socket, keeping
+--window requests outstanding. Reports offers per second and reply latency
+(p50/p99). With --dora each OFFER is followed by a REQUEST and the ACK is what
+is timed, so lease database commits are part of the cost.
+
+  --mode thread   the blocking recvfrom loop (start_dhcp_server)
+  --mode async    the asyncio DatagramProtocol loop with grouped ACK commits
+  --format json|binary  message encoding used by the simulated clients
+
+Usage:
+    python -m benchmarks.bench_dhcp [--mode async] [--format binary] [--macs 5000]
+                                    [--duration 5] [--window 64] [--dora]
+"""
+import io
+import os
+import json
+import math
+import time
+import random
+import select
+import socket
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+
+from src.dhcp import dhcp_message
+from src.dhcp.dhcp_message import DHCPACK, DHCPDISCOVER, DHCPOFFER, DHCPREQUEST
+from src.dhcp.dhcp_server import DhcpServer
+
+NETWORK = '10.0.0.0/16'
+REPLY_TIMEOUT = 1.0
+
+
+def run_server(mode, port, lease_db):
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = DhcpServer(network=NETWORK, lease_db=lease_db)
+        server.SERVER_PORT = port
+        if mode == "async":
+            server.start_async_dhcp_server()
+        else:
+            server.start_dhcp_server()
+
+
+def wait_for_server(sock, address, binary):
+    probe = dhcp_message.encode({"op": DHCPDISCOVER, "chaddr": "00:00:00:00:00:00", "xid": 0}, binary)
+    for _ in range(100):
+        sock.sendto(probe, address)
+        if select.select([sock], [], [], 0.1)[0]:
+            sock.recvfrom(2048)
+            return
+    raise RuntimeError("DHCP server did not start")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(len(values) * fraction) - 1)]  # Nearest rank
+
+
+def generate_load(address, macs, duration, window, binary, dora):
+    """Keep `window` exchanges in flight for `duration` seconds; returns (completed, lost, latencies)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    wait_for_server(sock, address, binary)
+    sock.setblocking(False)
+
+    in_flight = {}  # xid -> (mac, start time, last send time)
+    latencies = []
+    completed = lost = 0
+    next_xid = 1
+    end = time.perf_counter() + duration
+
+    def send(op, mac, xid, requested_ip=None):
+        message = {"op": op, "chaddr": mac, "xid": xid}
+        if requested_ip:
+            message["requested_ip"] = requested_ip
+        sock.sendto(dhcp_message.encode(message, binary), address)
+
+    while True:
+        now = time.perf_counter()
+        if now < end:
+            while len(in_flight) < window:
+                mac = macs[next_xid % len(macs)]
+                send(DHCPDISCOVER, mac, next_xid)
+                in_flight[next_xid] = (mac, now, now)
+                next_xid += 1
+        elif not in_flight:
+            break
+        if not select.select([sock], [], [], 0.05)[0]:
+            for xid in [xid for xid, (_, _, sent) in in_flight.items() if now - sent > REPLY_TIMEOUT]:
+                del in_flight[xid]
+                lost += 1
+            continue
+        while True:
+            try:
+                packet, _ = sock.recvfrom(2048)
+            except BlockingIOError:
+                break
+            reply, _ = dhcp_message.decode(packet)
+            entry = in_flight.get(reply.get("xid"))
+            if entry is None:
+                continue
+            mac, started, _ = entry
+            if dora and reply["op"] == DHCPOFFER:
+                send(DHCPREQUEST, mac, reply["xid"], reply["yiaddr"])
+                in_flight[reply["xid"]] = (mac, started, time.perf_counter())
+                continue
+            del in_flight[reply["xid"]]
+            if reply["op"] == (DHCPACK if dora else DHCPOFFER):
+                completed += 1
+                latencies.append(time.perf_counter() - started)
+            else:
+                lost += 1
+    sock.close()
+    return completed, lost, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("thread", "async"), default="async")
+    parser.add_argument("--format", choices=("json", "binary"), default="json")
+    parser.add_argument("--macs", type=int, default=5000, help="Number of simulated clients")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--window", type=int, default=64, help="Outstanding requests")
+    parser.add_argument("--dora", action="store_true", help="Time DISCOVER/OFFER/REQUEST/ACK instead of DISCOVER/OFFER")
+    parser.add_argument("--port", type=int, default=16767)
+    args = parser.parse_args()
+
+    macs = [":".join(format(byte, "02x") for byte in (0x02, 0, *random.randbytes(4))) for _ in range(args.macs)]
+    with tempfile.TemporaryDirectory() as workdir:
+        server = multiprocessing.Process(
+            target=run_server, args=(args.mode, args.port, os.path.join(workdir, "leases.db")), daemon=True
+        )
+        server.start()
+        try:
+            completed, lost, latencies = generate_load(
+                ("127.0.0.1", args.port), macs, args.duration, args.window, args.format == "binary", args.dora
+            )
+        finally:
+            server.terminate()
+            server.join()
+
+    rate = completed / args.duration
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    exchange = "DORA" if args.dora else "offers"
+    print(f"{args.mode}/{args.format}: {rate:,.0f} {exchange}/s, {lost} lost, "
+          f"p50 {p50 * 1e3 if p50 else 0:.2f} ms, p99 {p99 * 1e3 if p99 else 0:.2f} ms")
+    print(json.dumps({
+        "mode": args.mode, "format": args.format, "macs": args.macs, "window": args.window, "dora": args.dora,
+        "per_second": rate, "completed": completed, "lost": lost,
+        "p50_ms": p50 * 1e3 if p50 else None, "p99_ms": p99 * 1e3 if p99 else None,
+    }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""DHCP address allocation cost as the pool grows.
+
+Fills a pool with one lease per client and reports the time per DISCOVER:
+
+  legacy     the old allocate_ip: rebuild the list of every pool address per call
+  allocator  IpAllocator: free list + bitmap, O(1) per allocation
+
+The legacy loop is only run on the smaller pools; on a /16 it would take hours.
+
+Usage:
+    python -m benchmarks.bench_dhcp_allocator [--prefixes 24,20,16] [--legacy-max 4096]
+"""
+import io
+import json
+import time
+import argparse
+import ipaddress
+import contextlib
+
+from src.dhcp.ip_allocator import IpAllocator
+
+LEASE_TIME = 3600
+
+
+def legacy_allocate(pool, leases, client_mac):
+    # Same shape as the original DhcpServer.allocate_ip: a fresh list per call
+    available = [ip for ip in pool if ip not in leases.values()]
+    if available:
+        leases[client_mac] = available[0]
+        return available[0]
+    return None
+
+
+def run_legacy(network):
+    pool = [str(ip) for ip in network.hosts()]
+    leases = {}
+    start = time.perf_counter()
+    for i in range(len(pool)):
+        legacy_allocate(pool, leases, f"mac{i}")
+    return (time.perf_counter() - start) / len(pool)
+
+
+def run_allocator(network):
+    allocator = IpAllocator.from_network(str(network))
+    count = allocator.available
+    start = time.perf_counter()
+    for i in range(count):
+        allocator.allocate(f"mac{i}", LEASE_TIME)
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prefixes", default="24,20,16")
+    parser.add_argument("--legacy-max", type=int, default=4096, help="Largest pool the legacy loop is run on")
+    args = parser.parse_args()
+
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for prefix in args.prefixes.split(","):
+            network = ipaddress.IPv4Network(f"10.0.0.0/{prefix}")
+            result = {"pool": network.num_addresses - 2, "allocator_us": run_allocator(network) * 1e6}
+            if network.num_addresses <= args.legacy_max:
+                result["legacy_us"] = run_legacy(network) * 1e6
+            results[f"/{prefix}"] = result
+
+    for prefix, result in results.items():
+        legacy = f"{result['legacy_us']:12.1f} us" if "legacy_us" in result else "     skipped   "
+        print(f"{prefix:>4} ({result['pool']:>6} addresses): allocator {result['allocator_us']:6.2f} us, "
+              f"legacy {legacy} per DISCOVER")
+    print(json.dumps({"us_per_discover": results}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""End-to-end loopback benchmark: tracker, seeding peers and a downloading client.
+
+Starts a FileServer and --peers seeding FileClients on 127.0.0.1, each in its
+own process and working directory (server/, peer0/, ... under one temporary
+directory, so databases and D:/shared_directories stay apart), then drives
+scripted workloads from a client in this process, working in client/:
+
+  login_storm      --logins LOGINs on fresh control connections, --concurrency at a time
+  active_dirs      GET_ACTIVE_DIRS polled by --pollers connections for --seconds
+  list_file        cold LIST_FILE of a --list-files entry directory on a peer, and the
+                   cached (not-modified) re-list
+  download         download_file from one peer, per file size in --sizes-mb
+  bittorrent       download_file_bittorrent from every peer, per file size
+
+Throughput (ops/s, MB/s), latency percentiles and, per role (server, each peer,
+client), CPU seconds and peak RSS are printed as one JSON line at the end, so
+runs on two commits can be diffed.
+
+Usage:
+    python -m benchmarks.bench_loopback [--server-mode thread|async] [--peers 3]
+                                        [--sizes-mb 1,16,64] [--repeat 3] [--only download,bittorrent]
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from src.file_sharing import protocol
+from src.file_sharing.file_client import FileClient
+from src.file_sharing.file_server import FileServer
+
+WORKLOADS = ("login_storm", "active_dirs", "list_file", "download", "bittorrent")
+PASSWORD = "bench"
+SHARE = "share"
+LIST_DIRECTORY = "listing"
+MB = 1024 * 1024
+
+
+class LoopbackFileServer(FileServer):
+    SERVER_IP = "127.0.0.1"
+
+
+class LoopbackFileClient(FileClient):
+    """A FileClient that advertises 127.0.0.1 to the tracker, whatever the hostname resolves to."""
+    SERVER_IP = "127.0.0.1"
+
+    @staticmethod
+    def get_local_ip():
+        return "127.0.0.1"
+
+
+def file_name(size_mb):
+    return f"bench_{size_mb}mb.bin"
+
+
+def write_test_file(path, size):
+    """Same pseudo-random content for a given size on every peer (the multi-peer download needs that)."""
+    rng = random.Random(size)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            block = min(remaining, MB)
+            f.write(rng.randbytes(block))
+            remaining -= block
+
+
+def resource_usage():
+    """CPU seconds and peak RSS (MB) of this process; RSS is None where `resource` is missing."""
+    try:
+        import resource
+    except ImportError:
+        return {"cpu_s": time.process_time(), "peak_rss_mb": None}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    divisor = MB if sys.platform == "darwin" else 1024
+    return {"cpu_s": usage.ru_utime + usage.ru_stime, "peak_rss_mb": usage.ru_maxrss / divisor}
+
+
+def quiet():
+    """Server and peers print on every request; keep the report readable."""
+    sys.stdout = open(os.devnull, "w")
+
+
+def enter_role_directory(workdir, role):
+    """Work in <workdir>/<role>, so each role has its own file_server.db and D:/shared_directories."""
+    path = os.path.join(workdir, role)
+    os.makedirs(path, exist_ok=True)
+    os.chdir(path)
+
+
+def run_server(workdir, port, mode, stop, results):
+    quiet()
+    enter_role_directory(workdir, "server")
+    LoopbackFileServer.SERVER_PORT = port
+    server = LoopbackFileServer()
+    target = server.start_async_file_server if mode == "async" else server.start_file_server
+    threading.Thread(target=target, daemon=True).start()
+    stop.wait()
+    results.put(("server", resource_usage()))
+
+
+def run_peer(workdir, port, index, sizes_mb, list_files, ready, stop, results):
+    quiet()
+    enter_role_directory(workdir, f"peer{index}")
+    LoopbackFileClient.SERVER_PORT = port
+    client = LoopbackFileClient("127.0.0.1")
+    username = f"seed{index}"
+    client.register(username, PASSWORD)
+    if not client.login(username, PASSWORD):
+        ready.put((index, None))
+        return
+    client.create_directory(SHARE)
+    share = os.path.join(client.ROOT_DIR, str(client.user_id), SHARE)
+    for size_mb in sizes_mb:
+        write_test_file(os.path.join(share, file_name(size_mb)), int(size_mb * MB))
+    listing = None
+    if index == 0 and list_files:
+        client.create_directory(LIST_DIRECTORY)
+        listing = os.path.join(client.ROOT_DIR, str(client.user_id), LIST_DIRECTORY)
+        for i in range(list_files):
+            open(os.path.join(listing, f"entry{i:06d}.txt"), "wb").close()
+    client.publish_all_directories()
+    ready.put((index, {"ip": client.local_ip, "port": client.client_port, "share": share, "listing": listing}))
+    stop.wait()
+    results.put((username, resource_usage()))
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+
+    def at(fraction):
+        # Nearest rank: the smallest sample with at least `fraction` of them at or below it
+        return latencies[max(0, math.ceil(len(latencies) * fraction) - 1)] * 1e3
+
+    return {"p50_ms": at(0.5), "p90_ms": at(0.9), "p99_ms": at(0.99), "max_ms": latencies[-1] * 1e3}
+
+
+def control_request(sock, command):
+    start = time.perf_counter()
+    request_id = protocol.send_request(sock, command)
+    reply = protocol.recv_reply(sock, request_id).decode()
+    return reply, time.perf_counter() - start
+
+
+def login_storm(port, logins, concurrency):
+    def login(i):
+        start = time.perf_counter()
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            reply, _ = control_request(sock, f"LOGIN storm {PASSWORD} 127.0.0.1 {10000 + i}")
+        if not reply.startswith("LOGIN_SUCCESS"):
+            raise RuntimeError(f"login failed: {reply}")
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+    return {"ops": logins, "ops_per_s": logins / elapsed, **percentiles(latencies)}
+
+
+def poll_active_dirs(port, pollers, seconds):
+    latencies = [[] for _ in range(pollers)]
+    deadline = time.perf_counter() + seconds
+
+    def poll(index):
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            while time.perf_counter() < deadline:
+                _, latency = control_request(sock, "GET_ACTIVE_DIRS")
+                latencies[index].append(latency)
+
+    threads = [threading.Thread(target=poll, args=(i,)) for i in range(pollers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    merged = [latency for per_poller in latencies for latency in per_poller]
+    return {"ops": len(merged), "ops_per_s": len(merged) / seconds, **percentiles(merged)}
+
+
+def list_file(client, peer, repeat):
+    cold, warm = [], []
+    entries = 0
+    for _ in range(repeat):
+        client.file_lists.clear()
+        start = time.perf_counter()
+        entries = len(client.request_file_list(peer["ip"], peer["port"], peer["listing"], client.PEER_TIMEOUT))
+        cold.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        client.request_file_list(peer["ip"], peer["port"], peer["listing"], client.PEER_TIMEOUT)
+        warm.append(time.perf_counter() - start)
+    return {
+        "entries": entries,
+        "cold": {"entries_per_s": entries / (sum(cold) / len(cold)), **percentiles(cold)},
+        "cached": percentiles(warm),
+    }
+
+
+def timed_downloads(client, size_mb, repeat, download):
+    """Run `download` `repeat` times from scratch; returns MB/s and per-download latency."""
+    download_path = os.path.join(client.ROOT_DIR, str(client.user_id), "download", file_name(size_mb))
+    durations = []
+    for _ in range(repeat):
+        # A complete local copy would turn the next run into a delta transfer
+        for path in (download_path, download_path + ".state"):
+            if os.path.exists(path):
+                os.remove(path)
+        start = time.perf_counter()
+        if not download():
+            raise RuntimeError(f"download of {file_name(size_mb)} failed")
+        durations.append(time.perf_counter() - start)
+    return {"mb_per_s": size_mb * len(durations) / sum(durations), **percentiles(durations)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server-mode", choices=("thread", "async"), default="thread")
+    parser.add_argument("--peers", type=int, default=3)
+    parser.add_argument("--sizes-mb", default="1,16,64")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--logins", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32, help="Connections logging in at once")
+    parser.add_argument("--pollers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=3, help="Length of the GET_ACTIVE_DIRS run")
+    parser.add_argument("--list-files", type=int, default=20000, help="Entries in the LIST_FILE directory")
+    parser.add_argument("--only", help="Comma-separated subset of: " + ", ".join(WORKLOADS))
+    args = parser.parse_args()
+
+    workloads = args.only.split(",") if args.only else WORKLOADS
+    sizes_mb = [float(size) if "." in size else int(size) for size in args.sizes_mb.split(",")]
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    report = {"config": {"server_mode": args.server_mode, "peers": args.peers, "sizes_mb": sizes_mb,
+                         "repeat": args.repeat}, "workloads": {}, "roles": {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        # Fork the server and peers before this process starts any client threads
+        stop, results, ready = multiprocessing.Event(), multiprocessing.Queue(), multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_server, args=(workdir, port, args.server_mode, stop, results))]
+        processes[0].start()
+        time.sleep(0.5)
+        for index in range(args.peers):
+            processes.append(multiprocessing.Process(
+                target=run_peer,
+                args=(workdir, port, index, sizes_mb, args.list_files if "list_file" in workloads else 0,
+                      ready, stop, results),
+            ))
+            processes[-1].start()
+        try:
+            peers = dict(ready.get(timeout=120) for _ in range(args.peers))
+            if not all(peers.values()):
+                raise RuntimeError("a seeding peer could not log in")
+            peers = [peers[index] for index in range(args.peers)]
+
+            enter_role_directory(workdir, "client")
+            LoopbackFileClient.SERVER_PORT = port
+            usage_before = resource_usage()
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                client = LoopbackFileClient("127.0.0.1")
+                client.register("storm", PASSWORD)
+                client.register("leech", PASSWORD)
+                client.login("leech", PASSWORD)
+                results_by_workload = report["workloads"]
+                if "login_storm" in workloads:
+                    results_by_workload["login_storm"] = login_storm(port, args.logins, args.concurrency)
+                if "active_dirs" in workloads:
+                    results_by_workload["active_dirs"] = poll_active_dirs(port, args.pollers, args.seconds)
+                if "list_file" in workloads and args.list_files:
+                    results_by_workload["list_file"] = list_file(client, peers[0], args.repeat)
+                for name in ("download", "bittorrent"):
+                    if name not in workloads:
+                        continue
+                    by_size = results_by_workload[name] = {}
+                    for size_mb in sizes_mb:
+                        if name == "download":
+                            path = os.path.join(peers[0]["share"], file_name(size_mb))
+                            download = lambda: client.download_file(peers[0]["ip"], peers[0]["port"], path)
+                        else:
+                            sources = client.search_file_across_peers(file_name(size_mb))
+                            download = lambda: client.download_file_bittorrent(file_name(size_mb), sources)
+                        by_size[f"{size_mb}mb"] = timed_downloads(client, size_mb, args.repeat, download)
+            usage_after = resource_usage()
+            report["roles"]["client"] = {
+                "cpu_s": usage_after["cpu_s"] - usage_before["cpu_s"], "peak_rss_mb": usage_after["peak_rss_mb"]
+            }
+        finally:
+            os.chdir(os.path.dirname(workdir))
+            stop.set()
+            for _ in processes:
+                try:
+                    role, usage = results.get(timeout=10)
+                except Exception:
+                    break
+                report["roles"][role] = usage
+            for process in processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+
+    for name, result in report["workloads"].items():
+        if name in ("download", "bittorrent"):
+            for size, by_size in result.items():
+                print(f"{name:>11} {size:>7}: {by_size['mb_per_s']:8.1f} MB/s, p50 {by_size['p50_ms']:8.1f} ms")
+        elif name == "list_file":
+            print(f"{name:>11}: {result['entries']} entries, cold p50 {result['cold']['p50_ms']:.1f} ms, "
+                  f"cached p50 {result['cached']['p50_ms']:.2f} ms")
+        else:
+            print(f"{name:>11}: {result['ops_per_s']:10,.0f} ops/s, p50 {result['p50_ms']:.2f} ms, "
+                  f"p99 {result['p99_ms']:.2f} ms")
+    for role, usage in report["roles"].items():
+        rss = f"{usage['peak_rss_mb']:.0f} MB" if usage["peak_rss_mb"] is not None else "n/a"
+        print(f"{role:>11}: cpu {usage['cpu_s']:.2f} s, peak rss {rss}")
+    print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Seeder CPU cost per GB for the peer upload path.
+
+Serves one file over loopback to a receiver process and measures the CPU time
+of the sending thread only, comparing:
+
+  legacy    1 KB read() + sendall() per block (the pre-sendfile upload loop)
+  buffered  readinto() a reused 256 KB buffer (the fallback when sendfile is missing)
+  sendfile  protocol.send_file_data, zero-copy through sendfile(2)
+
+Usage:
+    python -m benchmarks.bench_sendfile [--size-mb 1024] [--repeat 3]
+"""
+import os
+import json
+import time
+import socket
+import argparse
+import tempfile
+import multiprocessing
+
+from src.file_sharing import protocol
+
+
+def drain(port, expected):
+    """Receiver process: read and discard `expected` bytes."""
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        buffer = bytearray(1024 * 1024)
+        received = 0
+        while received < expected:
+            n = sock.recv_into(buffer)
+            if not n:
+                break
+            received += n
+
+
+def send_legacy(conn, file, size):
+    file.seek(0)
+    while (data := file.read(1024)):
+        conn.sendall(data)
+
+
+def send_buffered(conn, file, size):
+    protocol._send_buffered(conn, file, 0, size)
+
+
+def send_sendfile(conn, file, size):
+    protocol.send_file_data(conn, file, 0, size, request_id=1)
+
+
+METHODS = {
+    "legacy": send_legacy,
+    "buffered": send_buffered,
+    "sendfile": send_sendfile,
+}
+
+
+def run_once(method, path, size):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    # sendfile adds a 16-byte frame header in front of the body
+    expected = size + (protocol.HEADER.size if method == "sendfile" else 0)
+    receiver = multiprocessing.Process(target=drain, args=(port, expected))
+    receiver.start()
+    conn, _ = listener.accept()
+    with open(path, "rb") as file:
+        cpu_start, wall_start = time.thread_time(), time.perf_counter()
+        METHODS[method](conn, file, size)
+        cpu, wall = time.thread_time() - cpu_start, time.perf_counter() - wall_start
+    conn.close()
+    listener.close()
+    receiver.join()
+    return cpu, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--methods", default=",".join(METHODS))
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    gigabytes = size / (1024 ** 3)
+    with tempfile.NamedTemporaryFile(delete=False) as tmp:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            tmp.write(block)
+        path = tmp.name
+
+    results = {}
+    try:
+        for method in args.methods.split(","):
+            runs = [run_once(method, path, size) for _ in range(args.repeat)]
+            cpu = min(r[0] for r in runs)
+            wall = min(r[1] for r in runs)
+            results[method] = {
+                "cpu_seconds_per_gb": round(cpu / gigabytes, 4),
+                "throughput_mb_s": round(args.size_mb / wall, 1),
+            }
+            print(f"{method:>9}: {cpu / gigabytes:8.3f} CPU s/GB  {args.size_mb / wall:10.1f} MB/s")
+    finally:
+        os.remove(path)
+
+    print(json.dumps({"size_mb": args.size_mb, "sendfile_available": hasattr(os, "sendfile"), "results": results}))
+
+
+if __name__ == "__main__":
+    main()
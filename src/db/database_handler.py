@@ -1,14 +1,103 @@
+import os
+import hmac
+import json
+import queue
 import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from datetime import datetime
 
 class DatabaseHandler:
+    # Applied to every connection. WAL lets readers run while the writer commits,
+    # and synchronous=NORMAL is durable enough under WAL without an fsync per commit.
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000",  # 16 MB page cache per connection
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
+    )
+    STATEMENT_CACHE_SIZE = 256  # Prepared statements kept per connection
+    WRITE_BATCH_SIZE = 64  # Queued writes committed together in one transaction
+    USER_CACHE_SIZE = 1024  # User records kept in memory for logins, least recently used evicted
+
     def __init__(self, db_name='file_server.db'):
         self.db_name = db_name
+        self.local = threading.local()
+        self.write_queue = queue.Queue()
+        self.user_cache = OrderedDict()  # username -> user record
+        self.user_cache_generation = 0  # Bumped on removal so a lookup racing it does not re-cache the user
+        self.user_cache_lock = threading.Lock()
         self.init_database()
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_name, cached_statements=self.STATEMENT_CACHE_SIZE)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def connection(self):
+        # Mỗi thread giữ một kết nối riêng, mở một lần và dùng lại cho mọi truy vấn đọc
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def writer_loop(self):
+        # Thread ghi duy nhất: gom các lệnh INSERT/DELETE trong hàng đợi và commit theo lô
+        conn = self.connect()
+        while True:
+            batch = [self.write_queue.get()]
+            while len(batch) < self.WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if any(item is None for item in batch):
+                batch = [item for item in batch if item is not None]
+                stop = True
+            else:
+                stop = False
+
+            results = []
+            for sql, params, many, future in batch:
+                try:
+                    cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+                    results.append((future, cursor.lastrowid, None))
+                except Exception as e:
+                    results.append((future, None, e))
+            try:
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                results = [(future, None, error or e) for future, _, error in results]
+            for future, lastrowid, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(lastrowid)
+
+            if stop:
+                conn.close()
+                return
+
+    def write(self, sql, params=(), many=False):
+        """Run a write statement on the writer thread; returns lastrowid once it is committed."""
+        future = Future()
+        self.write_queue.put((sql, params, many, future))
+        return future.result()
+
+    def close(self):
+        """Stop the writer thread after it has flushed every queued write."""
+        self.write_queue.put(None)
+        self.writer_thread.join()
 
     def init_database(self):
         # Khởi tạo database và tạo các bảng users, directories và files
-        with sqlite3.connect(self.db_name) as conn:
+        with self.connect() as conn:
             cursor = conn.cursor()
 
             # Bảng users để lưu thông tin người dùng
@@ -41,79 +130,162 @@ class DatabaseHandler:
                                 FOREIGN KEY (directory_id) REFERENCES directories(id),
                                 FOREIGN KEY (user_id) REFERENCES users(id)
                              )''')
-            
+
+            # Cột path và mtime cho chỉ mục file (thêm vào database cũ nếu chưa có)
+            file_columns = {row[1] for row in cursor.execute('''PRAGMA table_info(files)''')}
+            if 'path' not in file_columns:
+                cursor.execute('''ALTER TABLE files ADD COLUMN path TEXT''')
+            if 'mtime' not in file_columns:
+                cursor.execute('''ALTER TABLE files ADD COLUMN mtime REAL''')
+
+            # Index cho truy vấn thư mục theo user và tìm kiếm file theo tên
+            cursor.execute('''CREATE INDEX IF NOT EXISTS idx_directories_user_id ON directories (user_id)''')
+            cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_files_directory_name ON files (directory_id, name)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS idx_files_name ON files (name)''')
+
             conn.commit()
+        conn.close()
 
     def register_user(self, username, password_hash):
         # Thêm người dùng mới vào bảng users
         created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''INSERT INTO users (username, password_hash, created_at)
-                                  VALUES (?, ?, ?)''', (username, password_hash, created_at))
-                conn.commit()
-                print(f"Tài khoản '{username}' đã được tạo thành công.")
+            self.write('''INSERT INTO users (username, password_hash, created_at)
+                          VALUES (?, ?, ?)''', (username, password_hash, created_at))
+            print(f"Tài khoản '{username}' đã được tạo thành công.")
         except sqlite3.IntegrityError:
             print("Username đã tồn tại. Vui lòng chọn tên khác.")
 
     def get_user(self, username, password_hash):
-        # Lấy thông tin người dùng từ bảng users
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''SELECT * FROM users WHERE username = ? AND password_hash = ?''', (username, password_hash))
-            user = cursor.fetchone()
-            if user:
-                return {
-                    'id': user[0],
-                    'username': user[1],
-                    'password_hash': user[2],
-                    'created_at': user[3]
-                }
+        # Lấy thông tin người dùng: từ cache LRU nếu có, nếu không thì từ bảng users
+        user = self.get_user_record(username)
+        if user and hmac.compare_digest(user['password_hash'], password_hash):
+            return dict(user)
+        return None
+
+    def get_user_record(self, username):
+        with self.user_cache_lock:
+            user = self.user_cache.get(username)
+            if user is not None:
+                self.user_cache.move_to_end(username)
+                return user
+            generation = self.user_cache_generation
+        row = self.connection().execute('''SELECT * FROM users WHERE username = ?''', (username,)).fetchone()
+        if row is None:
             return None
+        user = {
+            'id': row[0],
+            'username': row[1],
+            'password_hash': row[2],
+            'created_at': row[3]
+        }
+        with self.user_cache_lock:
+            if generation == self.user_cache_generation:
+                self.user_cache[username] = user
+                if len(self.user_cache) > self.USER_CACHE_SIZE:
+                    self.user_cache.popitem(last=False)
+        return user
+
+    def invalidate_user(self, username=None):
+        """Forget a cached user record (every record if `username` is None)."""
+        with self.user_cache_lock:
+            self.user_cache_generation += 1
+            if username is None:
+                self.user_cache.clear()
+            else:
+                self.user_cache.pop(username, None)
 
     def remove_user(self, username):
         # Xóa người dùng khỏi bảng users
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''DELETE FROM users WHERE username = ?''', (username,))
-            conn.commit()
-            print(f"Tài khoản '{username}' đã được xóa.")
+        self.write('''DELETE FROM users WHERE username = ?''', (username,))
+        self.invalidate_user(username)
+        print(f"Tài khoản '{username}' đã được xóa.")
 
     def remove_all_users(self):
         # Xóa tất cả người dùng khỏi bảng users
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''DELETE FROM users''')
-            conn.commit()
-            print("Tất cả tài khoản đã được xóa.")
+        self.write('''DELETE FROM users''')
+        self.invalidate_user()
+        print("Tất cả tài khoản đã được xóa.")
 
     def add_directory(self, user_id, name):
         # Thêm thư mục mới vào bảng directories
         created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         path = f"D:/shared_directories/{user_id}/{name}"
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            print(path, created_at)
-            cursor.execute('''INSERT INTO directories (user_id, name, path, created_at)
-                              VALUES (?, ?, ?, ?)''', (user_id, name, path, created_at))
-            conn.commit()
-            print(f"Thư mục '{name}' đã được tạo cho user ID {user_id}.")
+        print(path, created_at)
+        self.write('''INSERT INTO directories (user_id, name, path, created_at)
+                      VALUES (?, ?, ?, ?)''', (user_id, name, path, created_at))
+        print(f"Thư mục '{name}' đã được tạo cho user ID {user_id}.")
+        return path
 
     def get_user_directories(self, user_id):
         # Lấy danh sách thư mục của người dùng từ bảng directories
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''SELECT * FROM directories WHERE user_id = ?''', (user_id,))
-            directories = cursor.fetchall()
-            return [{'id': d[0], 'user_id': d[1], 'name': d[2], 'path': d[3], 'created_at': d[4]} for d in directories]
+        cursor = self.connection().execute('''SELECT * FROM directories WHERE user_id = ?''', (user_id,))
+        directories = cursor.fetchall()
+        return [{'id': d[0], 'user_id': d[1], 'name': d[2], 'path': d[3], 'created_at': d[4]} for d in directories]
+
+    def get_directories_for_users(self, user_ids):
+        # Lấy thư mục của nhiều user trong một truy vấn: {user_id: [directory, ...]}
+        cursor = self.connection().execute('''SELECT * FROM directories
+                                              WHERE user_id IN (SELECT value FROM json_each(?))
+                                              ORDER BY user_id, id''', (json.dumps(list(user_ids)),))
+        grouped = {}
+        for d in cursor.fetchall():
+            grouped.setdefault(d[1], []).append(
+                {'id': d[0], 'user_id': d[1], 'name': d[2], 'path': d[3], 'created_at': d[4]})
+        return grouped
 
     def add_file(self, directory_id, user_id, name, file_size, file_type):
         # Thêm file mới vào bảng files
         created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''INSERT INTO files (directory_id, user_id, name, file_size, file_type, created_at)
-                              VALUES (?, ?, ?, ?, ?, ?)''', (directory_id, user_id, name, file_size, file_type, created_at))
-            conn.commit()
-            print(f"File '{name}' đã được thêm vào thư mục ID {directory_id}.")
\ No newline at end of file
+        self.write('''INSERT INTO files (directory_id, user_id, name, file_size, file_type, created_at)
+                      VALUES (?, ?, ?, ?, ?, ?)''', (directory_id, user_id, name, file_size, file_type, created_at))
+        print(f"File '{name}' đã được thêm vào thư mục ID {directory_id}.")
+
+    def get_directory(self, user_id, name):
+        # Lấy một thư mục theo user và tên
+        cursor = self.connection().execute('''SELECT * FROM directories WHERE user_id = ? AND name = ?''',
+                                           (user_id, name))
+        d = cursor.fetchone()
+        if d:
+            return {'id': d[0], 'user_id': d[1], 'name': d[2], 'path': d[3], 'created_at': d[4]}
+        return None
+
+    def upsert_files(self, directory_id, user_id, files):
+        # Thêm hoặc cập nhật metadata của nhiều file trong một thư mục (name, path, size, mtime)
+        created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.write('''INSERT INTO files (directory_id, user_id, name, path, file_size, file_type, mtime, created_at)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                      ON CONFLICT (directory_id, name) DO UPDATE SET
+                          path = excluded.path, file_size = excluded.file_size, mtime = excluded.mtime''',
+                   [(directory_id, user_id, f['name'], f['path'], f['size'], os.path.splitext(f['name'])[1].lstrip('.'),
+                     f['mtime'], created_at) for f in files], many=True)
+
+    def remove_files(self, directory_id, names):
+        # Xóa các file không còn trong thư mục khỏi chỉ mục
+        self.write('''DELETE FROM files WHERE directory_id = ? AND name = ?''',
+                   [(directory_id, name) for name in names], many=True)
+
+    def clear_directory_files(self, directory_id):
+        # Xóa toàn bộ chỉ mục file của một thư mục
+        self.write('''DELETE FROM files WHERE directory_id = ?''', (directory_id,))
+
+    def search_files(self, query, mode, user_ids, limit=100):
+        # Tìm file theo tên trong thư mục của các user đang online: exact, prefix hoặc substring
+        if mode == 'exact':
+            condition, params = 'f.name = ?', (query,)
+        elif mode == 'prefix':
+            # Khoảng [query, query+1) dùng được index idx_files_name
+            upper = query[:-1] + chr(ord(query[-1]) + 1) if query else '\U0010ffff'
+            condition, params = 'f.name >= ? AND f.name < ?', (query, upper)
+        elif mode == 'substring':
+            condition, params = 'instr(f.name, ?) > 0', (query,)
+        else:
+            raise ValueError(f"Unknown search mode: {mode}")
+
+        cursor = self.connection().execute(f'''SELECT f.user_id, f.name, f.path, f.file_size, f.mtime, d.name
+                                               FROM files f JOIN directories d ON d.id = f.directory_id
+                                               WHERE {condition}
+                                                 AND f.user_id IN (SELECT value FROM json_each(?))
+                                               LIMIT ?''', (*params, json.dumps(list(user_ids)), limit))
+        return [{'user_id': r[0], 'name': r[1], 'path': r[2], 'size': r[3], 'mtime': r[4], 'directory': r[5]}
+                for r in cursor.fetchall()]
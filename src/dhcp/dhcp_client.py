@@ -1,44 +1,216 @@
+import os
 import json
+import time
 import random
 import socket
+import threading
+
+from src.dhcp.dhcp_message import DHCPACK, DHCPDISCOVER, DHCPNAK, DHCPOFFER, DHCPRELEASE, DHCPREQUEST
+from src.utils.log import get_logger
+
+log = get_logger("dhcp_client")
 
 class DhcpClient:
     # DHCP Client configurations
     SERVER_PORT = 67
     CLIENT_PORT = 68
+    SERVER_ADDRESS = '<broadcast>'  # DISCOVER and REBIND go here; RENEW goes to the server that answered
     BUFFER_SIZE = 1024
+    REPLY_TIMEOUT = 4  # Seconds to wait for a reply before retransmitting
+    RETRIES = 3
+    LEASE_DIR = os.path.join(os.path.expanduser("~"), ".p2p_file_sharing")  # MAC and lease per profile, kept across launches
+
+    def __init__(self, lease_file=None, profile=None):
+        """Each profile is a separate client with its own MAC and lease.
 
-    def __init__(self):
-        self.client_mac = self.generate_mac_address()
+        The profile defaults to the P2P_PROFILE environment variable (else
+        "default"), so several clients on one machine only need different
+        profiles; `lease_file` overrides the location entirely.
+        """
+        profile = profile or os.environ.get("P2P_PROFILE", "default")
+        self.lease_file = lease_file or os.path.join(self.LEASE_DIR, f"dhcp_lease_{profile}.json")
+        saved = self.load_lease()
+        self.client_mac = saved["chaddr"] if saved else self.generate_mac_address()
+        self.lease = saved if saved and saved.get("yiaddr") else None
         self.assigned_ip = None
+        self.server_address = None  # (ip, port) of the server that acknowledged the lease
+        self.lock = threading.Lock()
+        self.renewer_started = False
+        self.on_change = None  # Called with the new address when the lease changes or is lost (None)
 
     def generate_mac_address(self):
         """Generate a random MAC address."""
         mac = [0x00, 0x0c, 0x29, random.randint(0x00, 0x7f), random.randint(0x00, 0x7f), random.randint(0x00, 0x7f)]
         return ':'.join(map(lambda x: format(x, '02x'), mac))
-    
+
     def create_discover_message(self):
         """Create DHCPDISCOVER message to send to server."""
         discover_message = {
-            "op": 1,  # DHCP Discover
+            "op": DHCPDISCOVER,
             "chaddr": self.client_mac
         }
         return json.dumps(discover_message)
 
-    def request_ip(self):
+    def create_request_message(self, requested_ip):
+        return json.dumps({"op": DHCPREQUEST, "chaddr": self.client_mac, "requested_ip": requested_ip})
+
+    def exchange(self, message, destination, expected_ops, retries=RETRIES):
+        """Send a message and wait for a reply with the same xid; returns (reply, server address) or (None, None)."""
+        xid = random.getrandbits(32)
+        packet = json.dumps({**json.loads(message), "xid": xid}).encode()
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.bind(('', self.CLIENT_PORT))
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            for _ in range(retries):
+                deadline = time.monotonic() + self.REPLY_TIMEOUT
+                try:
+                    sock.sendto(packet, destination)
+                except OSError as e:
+                    # e.g. network unreachable while the interface is down; wait out the timeout and retry
+                    log.warning("Could not send DHCP message to %s: %s", destination, e)
+                    time.sleep(self.REPLY_TIMEOUT)
+                    continue
+                while (remaining := deadline - time.monotonic()) > 0:
+                    sock.settimeout(remaining)
+                    try:
+                        data, address = sock.recvfrom(self.BUFFER_SIZE)
+                    except socket.timeout:
+                        break
+                    except OSError as e:
+                        log.warning("Error receiving DHCP reply: %s", e)
+                        break
+                    try:
+                        reply = json.loads(data.decode())
+                    except ValueError:  # Also UnicodeDecodeError
+                        continue  # Not a DHCP message of ours; keep waiting
+                    if isinstance(reply, dict) and reply.get("xid") == xid and reply.get("op") in expected_ops:
+                        return reply, address
+        return None, None
+
+    def request_ip(self):
+        """Get an address: reuse a saved lease that is still valid, otherwise DISCOVER/OFFER/REQUEST/ACK.
+
+        Either way the lease is then renewed in the background at T1 (RENEW to the
+        server) and T2 (REBIND by broadcast), so launching does not block on a
+        full discovery every time.
+        """
+        if self.lease and self.lease["expires_at"] > time.time():
+            self.assigned_ip = self.lease["yiaddr"]
+            print(f"Assigned IP: {self.assigned_ip} (saved lease)")
+        elif not self.discover():
+            print("No DHCP offer received.")
+            return
+        self.start_renewer()
+
+    def discover(self):
+        """Full DISCOVER -> OFFER -> REQUEST -> ACK exchange; returns True once bound."""
+        offer, _ = self.exchange(self.create_discover_message(), (self.SERVER_ADDRESS, self.SERVER_PORT), {DHCPOFFER})
+        if offer is None:
+            return False
+        return self.request(offer["yiaddr"], (self.SERVER_ADDRESS, self.SERVER_PORT))
+
+    def request(self, requested_ip, destination):
+        """Send DHCPREQUEST for `requested_ip`; True on ACK, False on NAK or no answer."""
+        reply, address = self.exchange(self.create_request_message(requested_ip), destination, {DHCPACK, DHCPNAK})
+        if reply is None:
+            return False
+        if reply["op"] == DHCPNAK:
+            print(f"DHCP server refused {requested_ip}")
+            self.drop_lease()
+            return False
+        self.bind(reply, address)
+        return True
+
+    def bind(self, ack, server_address):
+        now = time.time()
+        with self.lock:
+            changed = ack["yiaddr"] != self.assigned_ip
+            self.assigned_ip = ack["yiaddr"]
+            self.server_address = server_address
+            self.lease = {
+                "chaddr": self.client_mac,
+                "yiaddr": ack["yiaddr"],
+                "server": list(server_address),
+                "expires_at": now + ack["lease_time"],
+                "renew_at": now + ack.get("renewal_time", ack["lease_time"] * 0.5),
+                "rebind_at": now + ack.get("rebinding_time", ack["lease_time"] * 0.875),
+            }
+            self.save_lease()
+        print(f"Assigned IP: {self.assigned_ip} (lease {ack['lease_time']}s)")
+        if changed and self.on_change:
+            self.on_change(self.assigned_ip)
+
+    def drop_lease(self):
+        with self.lock:
+            had_address = self.assigned_ip is not None
+            self.lease = None
+            self.assigned_ip = None
+            self.save_lease()
+        if had_address and self.on_change:
+            self.on_change(None)
+
+    def release(self):
+        """Give the address back to the server (DHCPRELEASE gets no reply)."""
+        if self.lease is None:
+            return
+        message = json.dumps({"op": DHCPRELEASE, "chaddr": self.client_mac, "ciaddr": self.assigned_ip})
+        destination = tuple(self.lease["server"]) if self.lease.get("server") else (self.SERVER_ADDRESS, self.SERVER_PORT)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.sendto(message.encode(), destination)
+        self.drop_lease()
+
+    def start_renewer(self):
+        if self.renewer_started:
+            return
+        self.renewer_started = True
+        threading.Thread(target=self.renew_loop, daemon=True).start()
 
-            discover_message = self.create_discover_message()
-            sock.sendto(discover_message.encode(), ('<broadcast>', self.SERVER_PORT))
+    def renew_loop(self):
+        """RENEW at T1, REBIND at T2, rediscover once the lease has run out."""
+        while True:
+            try:
+                lease = self.lease
+                now = time.time()
+                if lease is None or now >= lease["expires_at"]:
+                    if lease is not None:
+                        print(f"DHCP lease for {lease['yiaddr']} expired")
+                        self.drop_lease()
+                    if not self.discover():
+                        time.sleep(self.REPLY_TIMEOUT * self.RETRIES)
+                    continue
+                if now < lease["renew_at"]:
+                    time.sleep(lease["renew_at"] - now)
+                    continue
+                if now < lease["rebind_at"] and lease.get("server"):
+                    destination = tuple(lease["server"])  # RENEWING: unicast to the server that granted it
+                else:
+                    destination = (self.SERVER_ADDRESS, self.SERVER_PORT)  # REBINDING: any server
+                if not self.request(lease["yiaddr"], destination) and self.lease is lease:
+                    # No answer: retry after half the time left until the next deadline, as RFC 2131 suggests
+                    deadline = lease["rebind_at"] if now < lease["rebind_at"] else lease["expires_at"]
+                    time.sleep(max(1, (deadline - time.time()) / 2))
+            except Exception as e:
+                # The renewer must outlive any one failure, or the lease silently runs out
+                log.warning("DHCP renewal failed, retrying: %s", e)
+                time.sleep(self.REPLY_TIMEOUT * self.RETRIES)
 
-            # Listen for DHCP OFFER from the server
-            data, _ = sock.recvfrom(self.BUFFER_SIZE)
-            offer_message = json.loads(data.decode())
+    def load_lease(self):
+        try:
+            with open(self.lease_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
 
-            if offer_message.get("op") == 2:  # DHCP Offer
-                self.assigned_ip = offer_message.get("yiaddr")
-                print(f"Assigned IP: {self.assigned_ip}")
-            else:
-                print("No DHCP offer received.")
\ No newline at end of file
+    def save_lease(self):
+        if self.lease is None:
+            # Keep the MAC so the server recognises us next time
+            data = {"chaddr": self.client_mac, "yiaddr": None, "expires_at": 0}
+        else:
+            data = self.lease
+        os.makedirs(os.path.dirname(os.path.abspath(self.lease_file)), exist_ok=True)
+        temp_path = self.lease_file + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.lease_file)
@@ -1,14 +1,19 @@
 import time
 
 class DhcpLease:
-    def __init__(self, ip, lease_time):
+    def __init__(self, ip, lease_time, client_mac=None):
         self.ip = ip
+        self.client_mac = client_mac
         self.start_time = time.time()
         self.lease_time = lease_time
 
+    @property
+    def expires_at(self):
+        return self.start_time + self.lease_time
+
     def is_expired(self):
         """Check if the lease has expired."""
-        return time.time() > self.start_time + self.lease_time
+        return time.time() > self.expires_at
 
     def renew(self, additional_time):
         """Extend the lease time."""
@@ -0,0 +1,97 @@
+"""DHCP message encodings: the original JSON form and a compact binary form.
+
+Both decode to the same dict, so the server handles them alike and answers in
+the format it was asked in. A binary message is one fixed 34-byte struct:
+
+    magic        2s  b"DH"
+    version      B   BINARY_VERSION
+    op           B   DHCPDISCOVER ... DHCPRELEASE
+    xid          I   transaction id, echoed in the reply
+    chaddr       6s  client MAC
+    address      4s  requested_ip in requests, yiaddr in replies
+    siaddr       4s  server address (replies)
+    giaddr       4s  gateway (replies)
+    subnet_mask  4s  (replies)
+    lease_time   I   seconds (replies)
+
+T1/T2 are not sent in binary replies; clients use 50% and 87.5% of lease_time.
+"""
+import json
+import socket
+import struct
+
+# Message types (the "op" field)
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+
+BINARY_MAGIC = b"DH"
+BINARY_VERSION = 1
+BINARY = struct.Struct("!2sBBI6s4s4s4s4sI")
+NO_ADDRESS = b"\0\0\0\0"
+
+REPLY_OPS = {DHCPOFFER, DHCPACK, DHCPNAK}
+
+
+def is_binary(packet):
+    return packet[:2] == BINARY_MAGIC
+
+
+def _pack_address(ip):
+    return socket.inet_aton(ip) if ip else NO_ADDRESS
+
+
+def _unpack_address(packed):
+    return socket.inet_ntoa(packed) if packed != NO_ADDRESS else None
+
+
+def _pack_mac(mac):
+    return bytes.fromhex(mac.replace(":", "")) if mac else bytes(6)
+
+
+def _unpack_mac(packed):
+    return ":".join(format(byte, "02x") for byte in packed)
+
+
+def encode_binary(message):
+    op = message["op"]
+    address = message.get("yiaddr") if op in REPLY_OPS else None
+    address = address or message.get("requested_ip") or message.get("ciaddr")
+    return BINARY.pack(
+        BINARY_MAGIC, BINARY_VERSION, op, message.get("xid", 0), _pack_mac(message.get("chaddr")),
+        _pack_address(address), _pack_address(message.get("siaddr")), _pack_address(message.get("giaddr")),
+        _pack_address(message.get("subnet_mask")), int(message.get("lease_time", 0)),
+    )
+
+
+def decode_binary(packet):
+    if len(packet) != BINARY.size:
+        raise ValueError(f"Binary DHCP message of {len(packet)} bytes, expected {BINARY.size}")
+    magic, version, op, xid, chaddr, address, siaddr, giaddr, subnet_mask, lease_time = BINARY.unpack(packet)
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary DHCP version {version}")
+    message = {"op": op, "xid": xid, "chaddr": _unpack_mac(chaddr)}
+    if op in REPLY_OPS:
+        if op == DHCPNAK:
+            message["requested_ip"] = _unpack_address(address)
+        else:
+            message["yiaddr"] = _unpack_address(address)
+        message.update(siaddr=_unpack_address(siaddr), giaddr=_unpack_address(giaddr),
+                       subnet_mask=_unpack_address(subnet_mask), lease_time=lease_time)
+    else:
+        message["requested_ip"] = _unpack_address(address)
+    return message
+
+
+def decode(packet):
+    """(message dict, binary?) for a datagram in either format."""
+    if is_binary(packet):
+        return decode_binary(packet), True
+    return json.loads(packet.decode()), False
+
+
+def encode(message, binary):
+    return encode_binary(message) if binary else json.dumps(message).encode()
@@ -1,41 +1,87 @@
-import json
+import sys
+import time
 import socket
+import asyncio
 
-from src.dhcp.dhcp_lease import DhcpLease
+from src.dhcp import dhcp_message
+from src.dhcp.dhcp_message import DHCPACK, DHCPDISCOVER, DHCPNAK, DHCPOFFER, DHCPRELEASE, DHCPREQUEST
+from src.dhcp.ip_allocator import IpAllocator
+from src.dhcp.lease_store import LeaseStore
 
 class DhcpServer:
     # DHCP Server configurations
     DHCP_SERVER_IP = '192.168.1.1'
     DHCP_POOL_START = '192.168.1.100'
     DHCP_POOL_END = '192.168.1.200'
+    DHCP_POOL_NETWORK = None  # CIDR such as '10.0.0.0/16' to lease every host address instead of START-END
     SUBNET_MASK = '255.255.255.0'
     GATEWAY = '192.168.1.1'
     SERVER_PORT = 67
     BUFFER_SIZE = 1024
     LEASE_TIME = 3600  # Lease time in seconds (1 hour)
+    OFFER_TIME = 60  # An offered address is held this long for the client's REQUEST
+    LEASE_DB = 'dhcp_leases.db'
+    ACK_BATCH = 64  # Up to this many ACKs share one commit of the lease database
+    ACK_COMMIT_DELAY = 0.002  # asyncio mode: ...or wait at most this many seconds for more
 
-    def __init__(self, ip_range_start=DHCP_POOL_START, ip_range_end=DHCP_POOL_END):
+    def __init__(self, ip_range_start=DHCP_POOL_START, ip_range_end=DHCP_POOL_END, network=DHCP_POOL_NETWORK,
+                 lease_db=LEASE_DB):
         self.ip_range_start = ip_range_start
         self.ip_range_end = ip_range_end
-        self.leases = {}
+        # The server's and gateway's own addresses are never leased out
+        reserved = (self.DHCP_SERVER_IP, self.GATEWAY)
+        if network:
+            self.allocator = IpAllocator.from_network(network, reserved, self.lease_expired)
+        else:
+            self.allocator = IpAllocator(ip_range_start, ip_range_end, reserved, self.lease_expired)
+        self.leases = self.allocator.leases  # MAC -> DhcpLease
+        self.bound = set()  # MACs whose lease was acknowledged (and stored), not just offered
+        self.store = LeaseStore(lease_db) if lease_db else None
+        self.load_leases()
+
+    def load_leases(self):
+        """Restore acknowledged leases from the lease database so clients keep their addresses."""
+        if self.store is None:
+            return
+        restored = 0
+        for client_mac, ip, start_time, lease_time in self.store.load(time.time()):
+            if self.allocator.restore(client_mac, ip, start_time, lease_time):
+                self.bound.add(client_mac)
+                restored += 1
+        print(f"Restored {restored} DHCP lease(s) from {self.store.db_name}")
+
+    def lease_expired(self, lease):
+        if lease.client_mac in self.bound:
+            self.bound.discard(lease.client_mac)
+            if self.store is not None:
+                self.store.delete(lease.client_mac)
 
     def allocate_ip(self, client_mac):
-        """Allocate an IP address to a client"""
-        start_int = int(self.ip_range_start.split('.')[-1])
-        end_int = int(self.ip_range_end.split('.')[-1])
-        
-        # Generate available IPs within the pool range
-        available_ips = [
-            f'192.168.1.{i}' for i in range(start_int, end_int + 1)
-            if f'192.168.1.{i}' not in self.leases.values()
-        ]
-        
-        if available_ips:
-            allocated_ip = available_ips[0]
-            self.leases[client_mac] = DhcpLease(allocated_ip, self.LEASE_TIME)
-            return allocated_ip
-        return None
-    
+        """Allocate an IP address to a client (the same one again if it already has a lease)."""
+        lease = self.allocator.allocate(client_mac, self.OFFER_TIME)
+        return lease.ip if lease else None
+
+    def handle_message(self, message, commit=True):
+        """Answer one client message; returns the reply dict, or None when nothing is sent back.
+
+        With commit=False lease database changes wait for the caller's store.commit().
+        """
+        op = message.get("op")
+        client_mac = message.get("chaddr", "")
+        if op == DHCPDISCOVER:
+            reply = self.handle_dhcp_discover(client_mac)
+        elif op == DHCPREQUEST:
+            reply = self.handle_dhcp_request(client_mac, message.get("requested_ip") or message.get("ciaddr"), commit)
+        elif op == DHCPRELEASE:
+            self.handle_dhcp_release(client_mac, commit)
+            reply = None
+        else:
+            print(f"Unknown DHCP message type: {op}")
+            reply = None
+        if reply is not None and "xid" in message:
+            reply["xid"] = message["xid"]
+        return reply
+
     def handle_dhcp_discover(self, client_mac):
         allocated_ip = self.allocate_ip(client_mac)
 
@@ -44,21 +90,58 @@ class DhcpServer:
             return None
 
         return self.create_dhcp_offer(allocated_ip)
-    
+
+    def handle_dhcp_request(self, client_mac, requested_ip, commit=True):
+        """SELECTING, INIT-REBOOT, RENEWING and REBINDING all come down to: may this client keep this address?"""
+        lease = self.allocator.allocate_address(client_mac, requested_ip, self.LEASE_TIME) if requested_ip else None
+        if lease is None:
+            print(f"DHCPNAK to {client_mac}: {requested_ip} is not available")
+            return {"op": DHCPNAK, "siaddr": self.DHCP_SERVER_IP, "requested_ip": requested_ip}
+        self.bound.add(client_mac)
+        if self.store is not None:
+            self.store.save(lease, commit)
+        return self.create_dhcp_ack(lease)
+
+    def handle_dhcp_release(self, client_mac, commit=True):
+        lease = self.allocator.release(client_mac)
+        if lease is not None:
+            print(f"[INFO] Lease for IP {lease.ip} released by {client_mac}.")
+        self.bound.discard(client_mac)
+        if self.store is not None:
+            self.store.delete(client_mac, commit)
+
     def create_dhcp_offer(self, allocated_ip):
         """Create a DHCP Offer message."""
         offer_message = {
-            "op": 2,  # DHCP Offer
+            "op": DHCPOFFER,
             "yiaddr": allocated_ip,
             "siaddr": self.DHCP_SERVER_IP,
             "giaddr": self.GATEWAY,
             "subnet_mask": self.SUBNET_MASK,
             "lease_time": self.LEASE_TIME
         }
-        return json.dumps(offer_message)
+        return offer_message
+
+    def create_dhcp_ack(self, lease):
+        """Create a DHCP ACK message; T1/T2 are the usual 50% and 87.5% of the lease."""
+        return {
+            "op": DHCPACK,
+            "yiaddr": lease.ip,
+            "siaddr": self.DHCP_SERVER_IP,
+            "giaddr": self.GATEWAY,
+            "subnet_mask": self.SUBNET_MASK,
+            "lease_time": lease.lease_time,
+            "renewal_time": lease.lease_time * 0.5,
+            "rebinding_time": lease.lease_time * 0.875,
+        }
 
     def start_dhcp_server(self):
-        """Start the DHCP server to listen for requests."""
+        """Start the DHCP server to listen for requests.
+
+        Datagrams that queued up while the last batch was handled (up to ACK_BATCH)
+        are read together and their lease changes committed once before any reply
+        goes out, so a burst of REQUESTs shares one lease database commit.
+        """
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as dhcp_socket:
             dhcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
             dhcp_socket.bind(('0.0.0.0', self.SERVER_PORT))
@@ -66,18 +149,115 @@ class DhcpServer:
 
             while True:
                 try:
-                    packet, client_address = dhcp_socket.recvfrom(self.BUFFER_SIZE)
-                    message = json.loads(packet.decode())
-                    client_mac = message.get("chaddr", "")
-
-                    if message.get("op") == 1:  # DHCPDISCOVER
-                        response = self.handle_dhcp_discover(client_mac)
-                        if response:
-                            dhcp_socket.sendto(response.encode(), client_address)
-                except Exception as e:
+                    packets = self.receive_batch(dhcp_socket)
+                except OSError as e:
                     print(f"An error occurred: {e}")
                     continue
+                replies = []
+                for packet, client_address in packets:
+                    try:
+                        message, binary = dhcp_message.decode(packet)
+                        response = self.handle_message(message, commit=False)
+                        if response:
+                            replies.append((dhcp_message.encode(response, binary), client_address))
+                    except Exception as e:
+                        print(f"An error occurred: {e}")
+                if self.store is not None:
+                    self.store.commit()
+                for reply, client_address in replies:
+                    try:
+                        dhcp_socket.sendto(reply, client_address)
+                    except OSError as e:
+                        print(f"An error occurred: {e}")
+
+    def receive_batch(self, dhcp_socket):
+        """Block for one datagram, then take whatever else is already queued (at most ACK_BATCH)."""
+        packets = [dhcp_socket.recvfrom(self.BUFFER_SIZE)]
+        dhcp_socket.setblocking(False)
+        try:
+            while len(packets) < self.ACK_BATCH:
+                packets.append(dhcp_socket.recvfrom(self.BUFFER_SIZE))
+        except BlockingIOError:
+            pass
+        finally:
+            dhcp_socket.setblocking(True)
+        return packets
+
+    async def serve_async(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DhcpProtocol(self), local_addr=('0.0.0.0', self.SERVER_PORT), allow_broadcast=True
+        )
+        print("DHCP Server (asyncio) is running...")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            transport.close()
+
+    def start_async_dhcp_server(self):
+        """Asyncio serving mode: datagrams are handled on an event loop and ACKs share lease commits."""
+        try:
+            asyncio.run(self.serve_async())
+        except KeyboardInterrupt:
+            print("\nDHCP server shutting down...")
+
+class DhcpProtocol(asyncio.DatagramProtocol):
+    """Answers DHCP datagrams on the event loop.
+
+    OFFERs and NAKs go out at once. ACKs are only sent once their lease is in the
+    lease database, so they are held until ACK_BATCH of them are pending or
+    ACK_COMMIT_DELAY has passed and then committed together: a boot storm costs
+    one SQLite commit per batch instead of one per client.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.pending_acks = []  # (packet, address) waiting for the next commit
+        self.flush_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        try:
+            message, binary = dhcp_message.decode(data)
+            reply = self.server.handle_message(message, commit=False)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return
+        if reply is None:
+            if message.get("op") == DHCPRELEASE:
+                self.schedule_flush()
+            return
+        packet = dhcp_message.encode(reply, binary)
+        if reply["op"] != DHCPACK or self.server.store is None:
+            self.transport.sendto(packet, address)
+            return
+        self.pending_acks.append((packet, address))
+        if len(self.pending_acks) >= self.server.ACK_BATCH:
+            self.flush()
+        else:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(self.server.ACK_COMMIT_DELAY, self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.server.store is not None:
+            self.server.store.commit()
+        pending, self.pending_acks = self.pending_acks, []
+        for packet, address in pending:
+            self.transport.sendto(packet, address)
 
 if __name__ == "__main__":
     dhcp_server = DhcpServer()
-    dhcp_server.start_dhcp_server()
\ No newline at end of file
+    if "--async" in sys.argv:
+        dhcp_server.start_async_dhcp_server()
+    else:
+        dhcp_server.start_dhcp_server()
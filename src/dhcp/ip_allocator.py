@@ -0,0 +1,179 @@
+import time
+import heapq
+import itertools
+import ipaddress
+from collections import deque
+
+from src.dhcp.dhcp_lease import DhcpLease
+from src.utils.log import get_logger
+
+log = get_logger("ip_allocator")
+
+
+class IpAllocator:
+    """Constant-time address allocation over a contiguous IPv4 pool.
+
+    Addresses are tracked by their offset in the pool: a bytearray marks the ones
+    in use, addresses never handed out are taken from a moving `next_fresh`
+    offset (so a /16 costs 64 KB and no list of 65k strings), and released
+    addresses go on a free list that is used first. Leases are indexed by MAC so
+    a client that asks again gets its address back, and a min-heap of expiry
+    times is swept lazily on every allocation to reclaim expired leases. Each
+    lease has one heap entry; a renewed lease is pushed back with its new expiry
+    when its old entry comes up, so renewing costs O(1).
+
+    Not thread-safe; the DHCP server calls it from a single thread.
+    """
+
+    def __init__(self, first, last, reserved=(), on_expire=None):
+        self.first = int(ipaddress.IPv4Address(first))
+        self.size = int(ipaddress.IPv4Address(last)) - self.first + 1
+        if self.size <= 0:
+            raise ValueError(f"Empty address pool {first} - {last}")
+        self.in_use = bytearray(self.size)
+        self.next_fresh = 0
+        self.released = deque()  # Offsets freed by release or expiry, reused first
+        self.leases = {}  # MAC -> DhcpLease
+        self.owners = {}  # offset -> MAC
+        self.expiry = []  # Min-heap of (expires_at, sequence, DhcpLease); released leases are skipped
+        self.sequence = itertools.count()
+        self.available = self.size
+        self.on_expire = on_expire  # Called with each lease reclaimed on expiry
+        for address in reserved:
+            self.reserve(address)
+
+    @classmethod
+    def from_network(cls, cidr, reserved=(), on_expire=None):
+        """Pool of every host address of a network, e.g. "10.0.0.0/16"."""
+        network = ipaddress.IPv4Network(cidr, strict=False)
+        if network.num_addresses > 2:
+            first, last = network.network_address + 1, network.broadcast_address - 1
+        else:
+            first, last = network.network_address, network.broadcast_address
+        return cls(first, last, reserved, on_expire)
+
+    def offset(self, ip):
+        """Offset of `ip` in the pool, or None if it lies outside."""
+        try:
+            offset = int(ipaddress.IPv4Address(ip)) - self.first
+        except ValueError:
+            return None
+        return offset if 0 <= offset < self.size else None
+
+    def address(self, offset):
+        return str(ipaddress.IPv4Address(self.first + offset))
+
+    def reserve(self, ip):
+        """Keep an address (server, gateway, ...) out of the pool for good."""
+        offset = self.offset(ip)
+        if offset is not None and not self.in_use[offset]:
+            self.in_use[offset] = 1
+            self.available -= 1
+
+    def lease_for(self, client_mac):
+        return self.leases.get(client_mac)
+
+    def allocate(self, client_mac, lease_time):
+        """Lease an address to `client_mac` for at least `lease_time` seconds; None if the pool is full.
+
+        A client that already has a lease gets the same address, and a longer
+        running lease is never shortened.
+        """
+        self.reclaim_expired()
+        lease = self.leases.get(client_mac)
+        if lease is not None:
+            if lease.expires_at < time.time() + lease_time:
+                self.renew(client_mac, lease_time)
+            return lease
+
+        offset = self._take_free()
+        if offset is None:
+            return None
+        return self._add_lease(client_mac, offset, lease_time)
+
+    def allocate_address(self, client_mac, ip, lease_time):
+        """Lease a specific address (a client asking for its previous one); None if it is taken or outside the pool."""
+        self.reclaim_expired()
+        offset = self.offset(ip)
+        if offset is None:
+            return None
+        lease = self.leases.get(client_mac)
+        if lease is not None and lease.ip == ip:
+            return self.renew(client_mac, lease_time)
+        if self.in_use[offset]:
+            return None  # Taken: the client keeps whatever lease it has
+        offset = self._mark_used(offset)
+        if lease is not None:
+            self.release(client_mac)  # The client moves to the address it asked for
+        return self._add_lease(client_mac, offset, lease_time)
+
+    def restore(self, client_mac, ip, start_time, lease_time):
+        """Re-create a lease loaded from storage; returns it, or None if the address is no longer available."""
+        # Allocated for the remaining time, so the expiry heap gets the original expiry
+        lease = self.allocate_address(client_mac, ip, start_time + lease_time - time.time())
+        if lease is not None:
+            lease.start_time, lease.lease_time = start_time, lease_time
+        return lease
+
+    def _add_lease(self, client_mac, offset, lease_time):
+        lease = DhcpLease(self.address(offset), lease_time, client_mac)
+        self.leases[client_mac] = lease
+        self.owners[offset] = client_mac
+        heapq.heappush(self.expiry, (lease.expires_at, next(self.sequence), lease))
+        return lease
+
+    def _take_free(self):
+        while self.released:
+            offset = self.released.popleft()
+            if not self.in_use[offset]:  # May have been reserved since it was released
+                return self._mark_used(offset)
+        while self.next_fresh < self.size:
+            offset = self.next_fresh
+            self.next_fresh += 1
+            if not self.in_use[offset]:
+                return self._mark_used(offset)
+        return None
+
+    def _mark_used(self, offset):
+        self.in_use[offset] = 1
+        self.available -= 1
+        return offset
+
+    def renew(self, client_mac, lease_time):
+        """Restart a client's lease for `lease_time` seconds; returns the lease or None."""
+        lease = self.leases.get(client_mac)
+        if lease is None:
+            return None
+        lease.start_time = time.time()
+        lease.lease_time = lease_time
+        return lease
+
+    def release(self, client_mac):
+        """Give a client's address back to the pool; returns the freed lease or None."""
+        lease = self.leases.pop(client_mac, None)
+        if lease is None:
+            return None
+        offset = self.offset(lease.ip)
+        del self.owners[offset]
+        self.in_use[offset] = 0
+        self.available += 1
+        self.released.append(offset)
+        return lease
+
+    def reclaim_expired(self, now=None):
+        """Free every lease whose expiry has passed; returns how many were reclaimed."""
+        now = time.time() if now is None else now
+        reclaimed = 0
+        while self.expiry and self.expiry[0][0] <= now:
+            _, _, lease = heapq.heappop(self.expiry)
+            if self.leases.get(lease.client_mac) is not lease:
+                continue  # Released already
+            if lease.expires_at > now:
+                heapq.heappush(self.expiry, (lease.expires_at, next(self.sequence), lease))  # Renewed since
+                continue
+            self.release(lease.client_mac)
+            log.debug("Lease for IP %s (%s) expired and was reclaimed.", lease.ip, lease.client_mac)
+            if self.on_expire is not None:
+                self.on_expire(lease)
+            reclaimed += 1
+        return reclaimed
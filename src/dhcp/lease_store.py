@@ -0,0 +1,61 @@
+import sqlite3
+import threading
+
+
+class LeaseStore:
+    """SQLite table of acknowledged leases, reloaded when the DHCP server restarts.
+
+    save/delete commit right away unless called with commit=False, in which case
+    the change is part of the next commit() (group commit in the asyncio server).
+    """
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+    )
+
+    def __init__(self, db_name='dhcp_leases.db'):
+        self.db_name = db_name
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            self.conn.execute(pragma)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS leases (
+                                 mac TEXT PRIMARY KEY,
+                                 ip TEXT NOT NULL UNIQUE,
+                                 start_time REAL NOT NULL,
+                                 lease_time REAL NOT NULL
+                             )''')
+        self.conn.commit()
+
+    def save(self, lease, commit=True):
+        with self.lock:
+            # An address has one owner: drop whatever row still holds it before upserting
+            self.conn.execute('''DELETE FROM leases WHERE ip = ? AND mac != ?''', (lease.ip, lease.client_mac))
+            self.conn.execute('''INSERT INTO leases (mac, ip, start_time, lease_time) VALUES (?, ?, ?, ?)
+                                 ON CONFLICT (mac) DO UPDATE SET
+                                     ip = excluded.ip, start_time = excluded.start_time,
+                                     lease_time = excluded.lease_time''',
+                              (lease.client_mac, lease.ip, lease.start_time, lease.lease_time))
+            if commit:
+                self.conn.commit()
+
+    def delete(self, client_mac, commit=True):
+        with self.lock:
+            self.conn.execute('''DELETE FROM leases WHERE mac = ?''', (client_mac,))
+            if commit:
+                self.conn.commit()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def load(self, now):
+        """Leases still valid at `now` as (mac, ip, start_time, lease_time); expired rows are purged."""
+        with self.lock:
+            self.conn.execute('''DELETE FROM leases WHERE start_time + lease_time <= ?''', (now,))
+            self.conn.commit()
+            return self.conn.execute('''SELECT mac, ip, start_time, lease_time FROM leases''').fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,136 @@
+"""Codecs peers can negotiate for compressed file transfers.
+
+zlib is always available; zstd (`zstandard`) and lz4 (`lz4`) are used when
+installed, and other codecs can be added with register_codec(). A requester
+lists the codecs it accepts in preference order; the serving peer picks the
+first one it also has, unless the file is known or measured to be
+incompressible, in which case the bytes go out raw.
+"""
+import os
+import zlib
+import threading
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+SAMPLE_RATIO = 0.9  # Compress only if the first block shrinks to at most this fraction
+
+# Formats that are already compressed; sampling them would only waste CPU
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".7z", ".aac", ".apk", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic",
+    ".jar", ".jpeg", ".jpg", ".lz4", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".png",
+    ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+}
+
+
+class Codec:
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress  # bytes -> bytes
+        self.decompress = decompress  # (bytes, max_size) -> bytes, raising beyond max_size
+
+
+CODECS = {}
+PREFERENCE = []  # Most recently registered first: zstd, lz4, zlib
+
+
+def register_codec(name, compress, decompress):
+    CODECS[name] = Codec(name, compress, decompress)
+    if name in PREFERENCE:
+        PREFERENCE.remove(name)
+    PREFERENCE.insert(0, name)
+
+
+def _zlib_decompress(data, max_size):
+    if max_size <= 0:
+        raise ValueError("No room for decompressed data")  # zlib reads max_length=0 as unlimited
+    decompressor = zlib.decompressobj()
+    result = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Decompressed block exceeds {max_size} bytes")
+    if not decompressor.eof:
+        raise ValueError("Truncated zlib stream")
+    return result
+
+
+register_codec("zlib", lambda data: zlib.compress(data, ZLIB_LEVEL), _zlib_decompress)
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    def _lz4_decompress(data, max_size):
+        if max_size <= 0:
+            raise ValueError("No room for decompressed data")
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        result = decompressor.decompress(data, max_length=max_size)  # Never inflates past max_size
+        if not decompressor.eof:
+            # Stopped at max_size with output still pending, or the frame is cut short
+            raise ValueError(f"Decompressed block exceeds {max_size} bytes or is truncated")
+        if decompressor.unused_data:
+            raise ValueError("Trailing data after lz4 frame")
+        return result
+
+    register_codec("lz4", lz4.frame.compress, _lz4_decompress)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    _zstd_local = threading.local()  # ZstdCompressor instances must not be shared between threads
+
+    def _zstd_compress(data):
+        compressor = getattr(_zstd_local, "compressor", None)
+        if compressor is None:
+            compressor = _zstd_local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return compressor.compress(data)
+
+    def _zstd_decompress(data, max_size):
+        if max_size <= 0:
+            raise ValueError("No room for decompressed data")
+        # decompress() allocates the size a frame header declares, so check it first;
+        # without one, max_output_size bounds the output instead
+        declared = zstandard.get_frame_parameters(data).content_size
+        if declared != zstandard.CONTENTSIZE_UNKNOWN and declared > max_size:
+            raise ValueError(f"Decompressed block exceeds {max_size} bytes")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+
+    register_codec("zstd", _zstd_compress, _zstd_decompress)
+
+
+def get_codec(name):
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"Unsupported codec {name!r}")
+    return codec
+
+
+def available_codecs():
+    return list(PREFERENCE)
+
+
+def split_accept(command):
+    """Strip a trailing " ACCEPT=zstd,zlib" from a command: (command, [codec names])."""
+    command, separator, accepted = command.rpartition(" ACCEPT=")
+    if not separator:
+        return accepted, []
+    return command, [name for name in accepted.split(",") if name]
+
+
+def with_accept(command, codecs):
+    return f"{command} ACCEPT={','.join(codecs)}" if codecs else command
+
+
+def negotiate(accepted, file_path):
+    """Codec to serve `file_path` with: the requester's first choice that we have, or None."""
+    if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return None
+    for name in accepted:
+        if name in CODECS:
+            return CODECS[name]
+    return None
+
+
+def worth_compressing(sample, compressed):
+    return len(compressed) <= len(sample) * SAMPLE_RATIO
@@ -0,0 +1,199 @@
+"""rsync-style delta transfer.
+
+The downloader splits its existing copy into fixed-size blocks and sends a weak
+rolling checksum (Adler-32) and a strong hash (BLAKE2b) per block. The serving
+peer slides a window over its version of the file one byte at a time: wherever
+the window matches one of the downloader's blocks it sends a reference to that
+block, everything else goes out as literal bytes. The reply therefore scales
+with the size of the change, not with the size of the file.
+
+Instruction stream (inside DATA frames):
+
+    b"C" index:I count:I    copy `count` consecutive blocks starting at `index`
+    b"L" length:I data      `length` literal bytes
+"""
+import math
+import zlib
+import struct
+import hashlib
+
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 128 * 1024
+LITERAL_CHUNK = 64 * 1024  # Literal runs are flushed in pieces of at most this size
+ADLER_MOD = 65521
+STRONG_DIGEST_SIZE = 16
+
+SIGNATURE = struct.Struct("!I16s")
+COPY = struct.Struct("!cII")
+LITERAL = struct.Struct("!cI")
+
+
+def choose_block_size(file_size):
+    """About sqrt(file size), rounded to a power of two, like rsync."""
+    if file_size <= 0:
+        return MIN_BLOCK_SIZE
+    block_size = 1 << round(math.log2(math.sqrt(file_size)))
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=STRONG_DIGEST_SIZE).digest()
+
+
+def roll(weak, out_byte, in_byte, block_size):
+    """Adler-32 of the window shifted by one byte (drop out_byte, append in_byte)."""
+    a = weak & 0xFFFF
+    b = weak >> 16
+    a = (a - out_byte + in_byte) % ADLER_MOD
+    b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+
+def block_signatures(file_path, block_size):
+    """Packed (weak, strong) signature of every full block of a file."""
+    signatures = bytearray()
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb") as file:
+        while file.readinto(view) == block_size:
+            signatures += SIGNATURE.pack(zlib.adler32(view), strong_hash(view))
+    return bytes(signatures)
+
+
+class DeltaTooLarge(Exception):
+    """More of the file differs than `max_literal` allows; a plain download is cheaper."""
+
+
+def signature_table(signatures):
+    """{weak: {strong: block index}} for looking blocks up while rolling."""
+    if len(signatures) % SIGNATURE.size:
+        raise ValueError(f"Signature data of {len(signatures)} bytes is not a whole number of records")
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(signatures)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+def generate_delta(data, signatures, block_size, digest=None, max_literal=None):
+    """Yield the encoded instructions that turn the downloader's copy into `data`.
+
+    `data` is any buffer supporting slicing and indexing (typically an mmap of the
+    served file). If `digest` is given it is updated with every byte of `data`, in
+    order, so the caller gets a whole-file hash without a second pass.
+
+    Unmatched bytes are the expensive part: the window rolls over them one byte
+    at a time and they go out as literals. Once more than `max_literal` of them
+    have been emitted in total, DeltaTooLarge is raised.
+    """
+    table = signature_table(signatures)
+    size = len(data)
+    position = literal_start = 0
+    copy_index = copy_count = 0
+    literal_total = 0
+    weak = None
+
+    def flush_copy():
+        return COPY.pack(b"C", copy_index, copy_count) if copy_count else b""
+
+    def count_literal(length):
+        nonlocal literal_total
+        literal_total += length
+        if max_literal is not None and literal_total > max_literal:
+            raise DeltaTooLarge(f"more than {max_literal} bytes differ")
+
+    while position + block_size <= size:
+        if weak is None:
+            weak = zlib.adler32(data[position:position + block_size])
+        candidates = table.get(weak)
+        if candidates:
+            block = data[position:position + block_size]
+            index = candidates.get(strong_hash(block))
+            if index is not None:
+                if literal_start < position:
+                    count_literal(position - literal_start)
+                    yield flush_copy()
+                    copy_count = 0
+                    literal = data[literal_start:position]
+                    if digest is not None:
+                        digest.update(literal)
+                    yield LITERAL.pack(b"L", len(literal)) + literal
+                if digest is not None:
+                    digest.update(block)
+                if copy_count and copy_index + copy_count == index:
+                    copy_count += 1
+                else:
+                    yield flush_copy()
+                    copy_index, copy_count = index, 1
+                position += block_size
+                literal_start = position
+                weak = None
+                continue
+
+        if position - literal_start >= LITERAL_CHUNK:
+            count_literal(position - literal_start)
+            yield flush_copy()
+            copy_count = 0
+            literal = data[literal_start:position]
+            if digest is not None:
+                digest.update(literal)
+            yield LITERAL.pack(b"L", len(literal)) + literal
+            literal_start = position
+        if position + block_size < size:
+            weak = roll(weak, data[position], data[position + block_size], block_size)
+        position += 1
+
+    count_literal(size - literal_start)
+    yield flush_copy()
+    for start in range(literal_start, size, LITERAL_CHUNK):
+        literal = data[start:min(start + LITERAL_CHUNK, size)]
+        if digest is not None:
+            digest.update(literal)
+        yield LITERAL.pack(b"L", len(literal)) + literal
+
+
+def apply_delta(blocks, basis, output, block_size, digest=None):
+    """Rebuild the served file into `output` from an instruction stream.
+
+    `blocks` yields the raw stream in arbitrary pieces, `basis` is the
+    downloader's old copy opened for reading. Returns (literal bytes, copied bytes).
+    """
+    pending = bytearray()
+    literal_bytes = copied_bytes = 0
+    for block in blocks:
+        pending += block
+        offset = 0
+        while len(pending) - offset >= LITERAL.size:
+            op = pending[offset:offset + 1]
+            if op == b"C":
+                if len(pending) - offset < COPY.size:
+                    break
+                _, index, count = COPY.unpack_from(pending, offset)
+                offset += COPY.size
+                basis.seek(index * block_size)
+                remaining = count * block_size
+                while remaining:
+                    data = basis.read(min(remaining, LITERAL_CHUNK))
+                    if not data:
+                        raise ValueError(f"Delta refers to block {index} past the end of the local copy")
+                    output.write(data)
+                    if digest is not None:
+                        digest.update(data)
+                    remaining -= len(data)
+                copied_bytes += count * block_size
+            elif op == b"L":
+                _, length = LITERAL.unpack_from(pending, offset)
+                if len(pending) - offset < LITERAL.size + length:
+                    break
+                start = offset + LITERAL.size
+                data = pending[start:start + length]
+                output.write(data)
+                if digest is not None:
+                    digest.update(data)
+                offset = start + length
+                literal_bytes += length
+            else:
+                raise ValueError(f"Unknown delta instruction {op!r}")
+        del pending[:offset]
+    if pending:
+        raise ValueError("Delta stream ended in the middle of an instruction")
+    return literal_bytes, copied_bytes
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import base64
+
+
+class DownloadState:
+    """Sidecar file recording which pieces of a partial download are complete and verified.
+
+    Lives next to the partial file as `<name>.state` and is tied to the content
+    (manifest root hash), not to the peers it came from, so a restarted download
+    can fetch the missing pieces from any peer serving the same file.
+    """
+    SUFFIX = ".state"
+    SAVE_INTERVAL = 1.0  # Seconds between bitmap saves while downloading
+
+    def __init__(self, download_path, manifest, bitmap=None):
+        self.download_path = download_path
+        self.state_path = download_path + self.SUFFIX
+        self.manifest = manifest
+        self.piece_count = len(manifest["pieces"])
+        self.bitmap = bitmap if bitmap is not None else bytearray((self.piece_count + 7) // 8)
+        self.last_saved = 0.0
+
+    @classmethod
+    def load(cls, download_path, manifest):
+        """Resume from an existing sidecar for the same content, or start a fresh state."""
+        try:
+            with open(download_path + cls.SUFFIX) as f:
+                saved = json.load(f)
+            if (saved["root"] == manifest["root"] and saved["size"] == manifest["size"]
+                    and saved["piece_size"] == manifest["piece_size"]
+                    and os.path.getsize(download_path) == manifest["size"]):
+                return cls(download_path, manifest, bytearray(base64.b64decode(saved["bitmap"])))
+        except (OSError, ValueError, KeyError):
+            pass
+        return cls(download_path, manifest)
+
+    @property
+    def resumed(self):
+        return any(self.bitmap)
+
+    def is_complete(self, index):
+        return bool(self.bitmap[index // 8] & (1 << (index % 8)))
+
+    def mark_complete(self, index):
+        self.bitmap[index // 8] |= 1 << (index % 8)
+
+    def completed_count(self):
+        return sum(bin(byte).count("1") for byte in self.bitmap)
+
+    def save(self, data_file=None):
+        """Persist the bitmap atomically; the data file is flushed first so no bit claims unsynced data."""
+        if data_file is not None:
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({
+                "root": self.manifest["root"],
+                "size": self.manifest["size"],
+                "piece_size": self.manifest["piece_size"],
+                "bitmap": base64.b64encode(bytes(self.bitmap)).decode(),
+            }, f)
+        os.replace(temp_path, self.state_path)
+        self.last_saved = time.monotonic()
+
+    def save_if_due(self, data_file):
+        if time.monotonic() - self.last_saved >= self.SAVE_INTERVAL:
+            self.save(data_file)
+
+    def remove(self):
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
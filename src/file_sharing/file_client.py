@@ -1,14 +1,64 @@
 from asyncio import Queue
 import os
 import json
+import bisect
+import math
+import mmap
+import base64
+import hashlib
+import time
 import socket
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from src.dhcp.dhcp_client import DhcpClient
+from src.file_sharing import compression, delta, protocol
+from src.file_sharing.download_state import DownloadState
+from src.file_sharing.manifest import ManifestCache, verify_piece, MIN_PIECE_SIZE, MAX_PIECE_SIZE
+from src.file_sharing.peer_connection_pool import PeerConnectionPool
+from src.file_sharing.piece_scheduler import PieceScheduler, split_into_pieces
+from src.file_sharing.upload_manager import UploadManager
+from src.utils import metrics
+from src.utils.log import get_logger
+
+log = get_logger("file_client")
 
 class FileClient:
     SERVER_IP = '127.0.0.1'
     SERVER_PORT = 5001
     BUFFER_SIZE = 1024
+    CHUNK_SIZE = 1024 * 1024  # 1MB pieces for multi-peer downloads
+    MAX_CONCURRENT_CHUNKS = 8  # Chunks in flight (and receive buffers held) at once
+    PEER_CONCURRENCY = 2  # Pieces requested at once from a peer before its speed is known
+    MAX_PEER_CONCURRENCY = 4  # Pieces in flight from the fastest peer
+    ENDGAME_DUPLICATES = 2  # Extra peers racing for each of the last pieces
+    COMPRESSION = True  # Offer our codecs when downloading; peers compress pieces that shrink
+    PEER_TIMEOUT = 30  # Seconds before a stalled peer request is abandoned and retried elsewhere
+    MANIFEST_TIMEOUT = 300  # Hashing a large file the first time can take a while
+    MAX_CONNECTIONS_PER_PEER = 4  # Pooled keep-alive connections per peer
+    PEER_IDLE_TIMEOUT = 60  # Pooled connections unused this long are closed
+    SEARCH_DEADLINE = 5  # Seconds a peer fan-out search may take in total
+    SEARCH_PEER_TIMEOUT = 2  # Seconds per LIST_FILE request during a search
+    SEARCH_WORKERS = 16  # Peers queried in parallel
+    LIST_PAGE_SIZE = 1000  # Directory entries per LIST_FILE page
+    MAX_LIST_PAGE_SIZE = 10000  # Largest page a peer serves, whatever the requester asks for
+    LIST_RESTARTS = 3  # Times a listing is restarted when the directory changes between pages
+    FILE_LIST_CACHE_SIZE = 256  # Peer directory listings kept with their change token
+    LISTING_SNAPSHOTS = 16  # Our own directories' sorted listings kept for serving later pages
+    UNRESPONSIVE_PEER_BACKOFF = 300  # Seconds a peer that failed a search is skipped
+    UPLOAD_RATE_LIMIT = None  # Bytes/s for all uploads together, None for unlimited
+    UPLOAD_CONNECTION_RATE_LIMIT = None  # Bytes/s for each peer connection, None for unlimited
+    MAX_PEER_CONNECTIONS = 64  # Incoming peer connections served at once; more are refused
+    PUBLISH_INTERVAL = 15  # Seconds between rescans of shared directories for the tracker index
+    PUBLISH_BATCH_BYTES = 512 * 1024  # JSON bytes per PUBLISH_FILES request, well under protocol.MAX_REQUEST_SIZE
+    MAX_PEER_REQUEST_SIZE = 8 * 1024 * 1024  # DELTA_FILE carries the block signatures of the requester's copy
+    DELTA_WORKERS = 2  # DELTA_FILE requests computed at once; more are refused (the rolling checksum is CPU bound)
+    DELTA_MAX_LITERAL = 8 * 1024 * 1024  # Differing bytes a delta may contain before the peer gives up on it
+    DELTA_MAX_SIZE_RATIO = 2  # A local copy more than this much larger or smaller is not worth a delta
+    METRICS_PORT = None  # Port for a Prometheus /metrics endpoint on localhost, None to disable
+    RETRY_SAFE_COMMANDS = {'GET_ACTIVE_DIRS', 'LIST_DIRS', 'SEARCH_FILE', 'STATS'}  # Read-only, may be resent after a lost reply
+    SUBSCRIBE_RETRY = 5  # Seconds before a dropped tracker event subscription is reopened
+    SUBSCRIPTION_TIMEOUT = 60  # Seconds without any event (heartbeats included) before the tracker is presumed gone
     ROOT_DIR = "D:/shared_directories"
 
     def __init__(self, assigned_ip):
@@ -16,8 +66,33 @@ class FileClient:
         self.assigned_ip = assigned_ip
         self.local_ip = self.get_local_ip()
         self.client_port = self.find_available_port()
-        self.peer_connections = {}
-        
+        self.peer_connections = PeerConnectionPool(
+            max_per_peer=self.MAX_CONNECTIONS_PER_PEER, idle_timeout=self.PEER_IDLE_TIMEOUT
+        )
+        self.peer_connections.start_reaper()
+        self.server_lock = threading.Lock()  # One request/reply at a time on the control connection
+        self.session_token = None  # From LOGIN; lets a new control connection log in again with RESUME
+        self.published = {}  # directory name -> {file name: (size, mtime)} last sent to the tracker
+        self.publisher_started = False
+        self.unresponsive_peers = {}  # (ip, port) -> time.monotonic() of the last failed search
+        self.manifests = ManifestCache()
+        self.upload_manager = UploadManager(self.UPLOAD_RATE_LIMIT, self.UPLOAD_CONNECTION_RATE_LIMIT)
+        self.peer_slots = threading.BoundedSemaphore(self.MAX_PEER_CONNECTIONS)
+        self.delta_slots = threading.BoundedSemaphore(self.DELTA_WORKERS)
+        self.file_lists = OrderedDict()  # (ip, port, directory path) -> (change token, files), LRU
+        self.file_lists_lock = threading.Lock()
+        self.listing_snapshots = OrderedDict()  # directory path -> (token, files, names), LRU
+        self.listing_snapshots_lock = threading.Lock()
+        # Local copy of the tracker's active directory tree, kept current by pushed events
+        self.directory_replica = {}  # user id -> {"user_id", "ip", "port", "directories"}
+        self.replica_lock = threading.Lock()
+        self.replica_version = 0  # Bumped on every change, so a UI can poll it cheaply
+        self.subscription = None  # Identifies the running subscription thread; None when not subscribed
+        self.subscription_socket = None
+        self.subscribed = False  # True once a snapshot has arrived on the current subscription
+        self.on_directory_event = None  # Called (from the subscription thread) with every applied event
+        self.setup_metrics()
+
         self.setup_server_connection()
         self.setup_peer_socket()
 
@@ -31,6 +106,33 @@ class FileClient:
             sock.bind(('', 0))  # Bind to an available port
             return sock.getsockname()[1]  # Return the port number
     
+    def setup_metrics(self):
+        """Transfer counters, answered by the STATS peer command and optionally served to Prometheus."""
+        self.metrics = metrics.MetricsRegistry()
+        self.bytes_received = self.metrics.counter(
+            "p2p_client_bytes_received_total", "File bytes downloaded from peers")
+        self.bytes_sent = self.metrics.counter("p2p_client_bytes_sent_total", "File bytes uploaded to peers")
+        self.peer_bytes = self.metrics.counter(
+            "p2p_client_peer_bytes_received_total", "Piece bytes downloaded per peer", ("peer",))
+        self.peer_seconds = self.metrics.counter(
+            "p2p_client_peer_receive_seconds_total", "Time spent receiving pieces per peer", ("peer",))
+        self.metrics.gauge("p2p_client_peer_throughput_bytes", "Average piece download rate per peer (bytes/s)",
+                           ("peer",), function=self.peer_throughput)
+        self.piece_failures = self.metrics.counter(
+            "p2p_client_piece_failures_total", "Piece requests that failed and were retried")
+        self.metrics.counter("p2p_client_pool_hits_total", "Peer requests sent on a pooled connection",
+                             function=lambda: self.peer_connections.hits)
+        self.metrics.counter("p2p_client_pool_misses_total", "Peer requests that opened a new connection",
+                             function=lambda: self.peer_connections.misses)
+        if self.METRICS_PORT:
+            metrics.start_metrics_server(self.metrics, self.METRICS_PORT)
+            print(f"Metrics on http://127.0.0.1:{self.METRICS_PORT}/metrics")
+
+    def peer_throughput(self):
+        seconds = self.peer_seconds.collect()
+        return {peer: received / seconds[peer] for peer, received in self.peer_bytes.collect().items()
+                if seconds.get(peer)}
+
     def setup_server_connection(self):
         """Establish TCP connection to the server."""
         try:
@@ -40,6 +142,24 @@ class FileClient:
             print(f"Error connecting to server: {e}")
             self.server_socket = None
 
+    def server_request(self, command):
+        request_id = protocol.send_request(self.server_socket, command)
+        return protocol.recv_reply(self.server_socket, request_id).decode()
+
+    def reconnect_to_server(self):
+        """Open a new control connection and resume the session on it; False if the server is unreachable."""
+        if self.server_socket is not None:
+            self.server_socket.close()
+        self.setup_server_connection()
+        if self.server_socket is None:
+            return False
+        if self.session_token:
+            response = self.server_request(f"RESUME {self.session_token} {self.local_ip} {self.client_port}")
+            if not response.startswith("LOGIN_SUCCESS"):
+                print("Session expired, please log in again.")
+                self.session_token = None
+        return True
+
     def setup_peer_socket(self):
         """Set up TCP socket for P2P communication."""
         self.peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -49,11 +169,35 @@ class FileClient:
         threading.Thread(target=self.listen_for_peers, daemon=True).start()
 
     def send_to_server(self, command):
-        """Send command to server via TCP and return the response."""
+        """Send command to server via TCP and return the response.
+
+        If the control connection is down, it is reopened once and, when we hold
+        a session token, logged back in with RESUME. The command is then sent on
+        the new connection only if it never left on the old one, or if it is
+        read-only (RETRY_SAFE_COMMANDS): a request whose reply was lost may
+        already have run on the server.
+        """
         try:
-            self.server_socket.send(command.encode())
-            response = self.server_socket.recv(self.BUFFER_SIZE).decode()
-            print(f"Server response: {response}")
+            with self.server_lock:
+                if self.server_socket is None and not self.reconnect_to_server():
+                    raise ConnectionError("Not connected to the server")
+                try:
+                    request_id = protocol.send_request(self.server_socket, command)
+                except OSError:
+                    if not self.reconnect_to_server():
+                        raise
+                    request_id = protocol.send_request(self.server_socket, command)
+                try:
+                    response = protocol.recv_reply(self.server_socket, request_id).decode()
+                except (OSError, protocol.ProtocolError):
+                    if command.split(maxsplit=1)[0] not in self.RETRY_SAFE_COMMANDS:
+                        self.server_socket.close()
+                        self.server_socket = None  # The next command reconnects
+                        raise
+                    if not self.reconnect_to_server():
+                        raise
+                    response = self.server_request(command)
+            log.debug("Server response: %s", response)
             return response  # Return the response for further processing
         except Exception as e:
             print(f"Error sending to server: {e}")
@@ -63,72 +207,250 @@ class FileClient:
         while True:
             try:
                 conn, addr = self.peer_socket.accept()
+                if not self.peer_slots.acquire(blocking=False):
+                    # Too many peers already; refusing lets their scheduler try another peer
+                    print(f"Refusing peer connection from {addr}: {self.MAX_PEER_CONNECTIONS} already open")
+                    conn.close()
+                    continue
                 threading.Thread(target=self.handle_peer_connection, args=(conn, addr), daemon=True).start()
             except Exception as e:
                 print(f"Error accepting peer connection: {e}")
 
+    def set_upload_limits(self, total_rate=None, per_connection_rate=None):
+        """Change the upload rate limits (bytes/s, None for unlimited) while running."""
+        self.upload_manager.configure(total_rate, per_connection_rate)
+
     def handle_peer_connection(self, conn, addr):
+        # Connections are kept alive for further requests; drop them once the peer goes quiet
+        conn.settimeout(self.PEER_IDLE_TIMEOUT * 2)
+        upload = self.upload_manager.register(addr[0])
         try:
             while True:
-                command = conn.recv(self.BUFFER_SIZE).decode()
-                if not command:
+                frame = protocol.recv_frame(conn, self.MAX_PEER_REQUEST_SIZE)
+                if frame is None:
                     break
-                print(f"Received command from {addr}: {command}")
+                frame_type, request_id, payload = frame
+                command = payload.decode()
+                log.debug("Received command from %s: %s", addr, command)
 
-                if command.startswith("DOWNLOAD_FILE"):
+                if frame_type != protocol.REQUEST:
+                    protocol.send_frame(conn, protocol.ERROR, "ERROR: Expected a request frame", request_id)
+                elif command.startswith("DOWNLOAD_FILE"):
+                    command, accepted = compression.split_accept(command)
                     _, file_path = command.split(maxsplit=1)
-                    self.send_file(file_path, conn)
+                    self.send_file(file_path, conn, request_id, compression.negotiate(accepted, file_path),
+                                   upload.throttle)
                 elif command.startswith("LIST_FILE"):
-                    _, directory_path = command.split(maxsplit=1)
-                    self.list_files_in_directory(directory_path, conn)
+                    _, arguments = command.split(maxsplit=1)
+                    options = json.loads(arguments)
+                    self.list_files_in_directory(options["path"], conn, request_id, options.get("cursor"),
+                                                 options.get("limit", self.LIST_PAGE_SIZE), options.get("if_token"))
                 elif command.startswith("GET_FILE_SIZE"):
                     _, file_path = command.split(maxsplit=1)
-                    self.get_size(file_path, conn)
+                    self.get_size(file_path, conn, request_id)
                 elif command.startswith("DOWNLOAD_CHUNK"):
-                    _, file_path, start, end = command.split()
-                    start, end = int(start), int(end)
-                    if os.path.exists(file_path):
-                        with open(file_path, "rb") as f:
-                            f.seek(start)
-                            while start <= end:
-                                chunk = f.read(min(self.BUFFER_SIZE, end - start + 1))
-                                if not chunk:
-                                    break
-                                conn.sendall(chunk)
-                                start += len(chunk)
-                                print(start)
-                        conn.sendall(b"END_OF_CHUNK")
-                    else:
-                        conn.sendall(b"ERROR: File not found")
+                    command, accepted = compression.split_accept(command)
+                    _, file_path, start, end = command.rsplit(maxsplit=3)
+                    self.send_chunk(file_path, int(start), int(end), conn, request_id,
+                                    compression.negotiate(accepted, file_path), upload.throttle)
+                elif command.startswith("DELTA_FILE"):
+                    _, arguments = command.split(maxsplit=1)
+                    self.send_delta(json.loads(arguments), conn, request_id, upload.throttle)
+                elif command.startswith("GET_MANIFEST"):
+                    _, piece_size, file_path = command.split(maxsplit=2)
+                    self.send_manifest(file_path, piece_size, conn, request_id)
+                elif command == "STATS":
+                    stats = json.dumps({"status": "STATS", "data": self.metrics.snapshot()})
+                    protocol.send_frame(conn, protocol.RESPONSE, stats, request_id)
                 else:
                     print(f"Unknown command: {command}")
+                    protocol.send_frame(conn, protocol.ERROR, "ERROR: Unknown command", request_id)
 
+        except socket.timeout:
+            pass  # Idle keep-alive connection
         except Exception as e:
             print(f"Error handling peer connection: {e}")
         finally:
+            upload.close()
+            self.peer_slots.release()
             conn.close()
 
-    def list_files_in_directory(self, directory_path, conn):
-        if os.path.exists(directory_path) and os.path.isdir(directory_path):
+    def send_manifest(self, file_path, piece_size, conn, request_id):
+        """Reply with the size and per-piece SHA-256 hashes of a shared file.
+
+        `piece_size` comes from the requester; sizes outside manifest.MIN_PIECE_SIZE
+        to MAX_PIECE_SIZE are refused, since one piece is buffered while hashing.
+        """
+        try:
+            piece_size = int(piece_size)
+        except ValueError:
+            piece_size = 0
+        if not MIN_PIECE_SIZE <= piece_size <= MAX_PIECE_SIZE:
+            protocol.send_frame(conn, protocol.ERROR, "ERROR: Invalid piece size", request_id)
+            return
+        if not os.path.isfile(file_path):
+            protocol.send_frame(conn, protocol.ERROR, "ERROR: File not found", request_id)
+            return
+        try:
+            manifest = self.manifests.get(file_path, piece_size)
+        except OSError as e:
+            protocol.send_frame(conn, protocol.ERROR, f"ERROR: {e}", request_id)
+            return
+        protocol.send_frame(conn, protocol.RESPONSE, json.dumps(manifest), request_id)
+
+    def send_delta(self, options, conn, request_id, throttle=None):
+        """Send the delta that turns the requester's copy (given as block signatures) into our file.
+
+        The END frame carries the file's size and SHA-256 so the result can be checked.
+        At most DELTA_WORKERS deltas are computed at once and each gives up after
+        DELTA_MAX_LITERAL differing bytes; the requester then downloads the
+        file the usual way.
+        """
+        file_path = options["path"]
+        block_size = int(options["block_size"])
+        if not os.path.isfile(file_path):
+            protocol.send_frame(conn, protocol.ERROR, "ERROR: File not found", request_id)
+            return
+        if not delta.MIN_BLOCK_SIZE <= block_size <= delta.MAX_BLOCK_SIZE:
+            protocol.send_frame(conn, protocol.ERROR, "ERROR: Invalid block size", request_id)
+            return
+        try:
+            signatures = base64.b64decode(options["signatures"], validate=True)
+            if len(signatures) % delta.SIGNATURE.size:
+                raise ValueError("truncated signature record")
+        except ValueError:
+            protocol.send_frame(conn, protocol.ERROR, "ERROR: Invalid signatures", request_id)
+            return
+        if not self.delta_slots.acquire(blocking=False):
+            protocol.send_frame(conn, protocol.ERROR, "ERROR: Busy", request_id)
+            return
+        try:
+            self.stream_delta(file_path, signatures, block_size, conn, request_id, throttle)
+        except delta.DeltaTooLarge as e:
+            protocol.send_frame(conn, protocol.ERROR, f"ERROR: {e}", request_id)
+        finally:
+            self.delta_slots.release()
+
+    def stream_delta(self, file_path, signatures, block_size, conn, request_id, throttle):
+        """Generate the delta against `signatures` and send it as DATA frames plus the END trailer."""
+        digest = hashlib.sha256()
+        batch = bytearray()
+        with open(file_path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
             try:
-                files = [{
-                    "name": entry,
-                    "path": os.path.join(directory_path, entry)
-                } for entry in os.listdir(directory_path) if os.path.isfile(os.path.join(directory_path, entry))]
-                print(files)
-                self.send_data_in_chunks(json.dumps(files), conn)
-                conn.sendall(b"END_OF_LIST")
-            except Exception as e:
-                print(f"Error getting list of files: {e}")
-        else:
+                for instruction in delta.generate_delta(data, signatures, block_size, digest,
+                                                        self.DELTA_MAX_LITERAL):
+                    batch += instruction
+                    if len(batch) >= protocol.STREAM_BLOCK_SIZE:
+                        if throttle is not None:
+                            throttle(len(batch))
+                        protocol.send_frame(conn, protocol.DATA, batch, request_id)
+                        self.bytes_sent.inc(len(batch))
+                        batch.clear()
+            finally:
+                if size:
+                    data.close()
+        if batch:
+            if throttle is not None:
+                throttle(len(batch))
+            protocol.send_frame(conn, protocol.DATA, batch, request_id)
+            self.bytes_sent.inc(len(batch))
+        trailer = {"size": size, "sha256": digest.hexdigest()}
+        protocol.send_frame(conn, protocol.END, json.dumps(trailer), request_id)
+
+    def list_files_in_directory(self, directory_path, conn, request_id, cursor=None,
+                                page_size=LIST_PAGE_SIZE, if_token=None):
+        """Stream one page of a directory listing as newline-delimited JSON in DATA frames.
+
+        Files are listed in name order. The END frame carries a JSON trailer with
+        the directory's change token (a hash of every file's name, size and
+        mtime, so it also moves when a file is rewritten in place) and the cursor
+        of the next page, or null after the last one. The cursor names the last
+        file sent; later pages are served from the listing the first page was
+        cut from, kept in listing_snapshots, so a whole listing is one scan. If
+        that snapshot is gone and the directory has changed since, the request
+        fails with "Stale cursor". If `if_token` is still current nothing is
+        listed and the trailer says not_modified.
+        """
+        if not os.path.isdir(directory_path):
             print(f"Invalid directory: {directory_path}")
+            protocol.send_frame(conn, protocol.ERROR, "ERROR: Invalid directory", request_id)
+            return
+        try:
+            after = None
+            if cursor is None:
+                token, files, names = self.directory_snapshot(directory_path)
+                if if_token == token:
+                    trailer = {"token": token, "next_cursor": None, "not_modified": True}
+                    protocol.send_frame(conn, protocol.END, json.dumps(trailer), request_id)
+                    return
+            else:
+                cursor_token, _, after = cursor.partition(":")
+                snapshot = self.cached_directory_snapshot(directory_path, cursor_token)
+                if snapshot is None:
+                    snapshot = self.directory_snapshot(directory_path)
+                    if snapshot[0] != cursor_token:
+                        protocol.send_frame(conn, protocol.ERROR, "ERROR: Stale cursor", request_id)
+                        return
+                token, files, names = snapshot
+            page_size = max(1, min(int(page_size), self.MAX_LIST_PAGE_SIZE))
 
-    def get_size(self, file_path, conn):
+            start = bisect.bisect_right(names, after) if after is not None else 0
+            page = files[start:start + page_size]
+            next_cursor = f"{token}:{page[-1][0]}" if start + page_size < len(files) else None
+            batch = bytearray()
+            for name, path, size, mtime in page:
+                batch += json.dumps({"name": name, "path": path, "size": size, "mtime": mtime}).encode()
+                batch += b"\n"
+                if len(batch) >= protocol.STREAM_BLOCK_SIZE:
+                    protocol.send_frame(conn, protocol.DATA, batch, request_id)
+                    batch.clear()
+            if batch:
+                protocol.send_frame(conn, protocol.DATA, batch, request_id)
+            trailer = {"token": token, "next_cursor": next_cursor, "not_modified": False}
+            protocol.send_frame(conn, protocol.END, json.dumps(trailer), request_id)
+        except OSError as e:
+            print(f"Error getting list of files: {e}")
+            protocol.send_frame(conn, protocol.ERROR, f"ERROR: {e}", request_id)
+
+    def directory_snapshot(self, directory_path):
+        """Scan a directory once: (change token, [(name, path, size, mtime)] sorted by name, names)."""
+        files, digest = [], hashlib.blake2b(digest_size=8)
+        with os.scandir(directory_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Removed mid-scan
+                files.append((entry.name, entry.path, stat.st_size, stat.st_mtime, stat.st_mtime_ns))
+        files.sort()
+        for name, _, size, _, mtime_ns in files:
+            digest.update(f"{name}\0{size}\0{mtime_ns}\n".encode())
+        snapshot = (digest.hexdigest(), [file[:4] for file in files], [file[0] for file in files])
+        with self.listing_snapshots_lock:
+            self.listing_snapshots[directory_path] = snapshot
+            self.listing_snapshots.move_to_end(directory_path)
+            while len(self.listing_snapshots) > self.LISTING_SNAPSHOTS:
+                self.listing_snapshots.popitem(last=False)
+        return snapshot
+
+    def cached_directory_snapshot(self, directory_path, token):
+        with self.listing_snapshots_lock:
+            snapshot = self.listing_snapshots.get(directory_path)
+            if snapshot is None or snapshot[0] != token:
+                return None
+            self.listing_snapshots.move_to_end(directory_path)
+            return snapshot
+
+    def get_size(self, file_path, conn, request_id):
         if os.path.exists(file_path):
             file_size = os.path.getsize(file_path)
-            conn.sendall(str(file_size).encode())
+            protocol.send_frame(conn, protocol.RESPONSE, str(file_size), request_id)
         else:
-            conn.sendall(b"ERROR: File not found")
+            protocol.send_frame(conn, protocol.ERROR, "ERROR: File not found", request_id)
 
     def register(self, username, password):
         self.send_to_server(f"REGISTER {username} {password}")
@@ -136,10 +458,18 @@ class FileClient:
     def login(self, username, password):
         response = self.send_to_server(f"LOGIN {username} {password} {self.local_ip} {self.client_port}")
         if response.startswith("LOGIN_SUCCESS"):
-            _, user_id, user_name = response.split()
+            _, user_id, user_name, *token = response.split()
             self.user_id = int(user_id)
             self.username = user_name
+            self.session_token = token[0] if token else None
+            if self.subscription is not None:
+                # The old subscription belongs to the previous session
+                self.unsubscribe()
+                self.subscribe()
             print(f"Login successful! User ID: {self.user_id}, Username: {self.username}")
+            self.published = {}
+            self.publish_all_directories()
+            self.start_publisher()
             return True
         else:
             print("Login failed.")
@@ -153,12 +483,190 @@ class FileClient:
             return
         os.makedirs(dir_path)
 
-        self.send_to_server(f"CREATE_DIR {self.user_id} {directory_name}")
+        self.send_to_server(f"CREATE_DIR {directory_name}")
+        self.publish_directory(directory_name)
         return True
 
+    def scan_directory(self, directory_name):
+        """Return {file name: (size, mtime)} for the files in one of our shared directories."""
+        dir_path = os.path.join(self.ROOT_DIR, str(self.user_id), directory_name)
+        with os.scandir(dir_path) as entries:
+            return {
+                entry.name: (stat.st_size, stat.st_mtime)
+                for entry in entries if entry.is_file()
+                for stat in (entry.stat(),)
+            }
+
+    def publish_directory(self, directory_name):
+        """Send the tracker only what changed in a directory since the last publish."""
+        try:
+            current = self.scan_directory(directory_name)
+        except OSError as e:
+            print(f"Error scanning directory '{directory_name}': {e}")
+            return
+        previous = self.published.get(directory_name)
+        dir_path = os.path.join(self.ROOT_DIR, str(self.user_id), directory_name)
+        update = {
+            "directory": directory_name,
+            # The first publish of a session replaces whatever the tracker kept from earlier sessions
+            "reset": previous is None,
+            "upsert": [
+                {"name": name, "path": os.path.join(dir_path, name), "size": size, "mtime": mtime}
+                for name, (size, mtime) in current.items()
+                if previous is None or previous.get(name) != (size, mtime)
+            ],
+            "remove": [name for name in (previous or {}) if name not in current],
+        }
+        if previous is not None and not update["upsert"] and not update["remove"]:
+            return
+        for batch in self.publish_batches(update):
+            response = self.send_to_server(f"PUBLISH_FILES {json.dumps(batch)}")
+            if not response.startswith("{"):
+                return  # Not recorded, so the next publish sends these changes again
+        self.published[directory_name] = current
+
+    def publish_batches(self, update):
+        """Split a PUBLISH_FILES update into requests of at most PUBLISH_BATCH_BYTES; only the first one resets."""
+        def new_batch(reset):
+            return {"directory": update["directory"], "reset": reset, "upsert": [], "remove": []}
+
+        batch = new_batch(update["reset"])
+        size = len(json.dumps(batch))
+        items = [("upsert", entry) for entry in update["upsert"]] + [("remove", name) for name in update["remove"]]
+        for key, item in items:
+            item_size = len(json.dumps(item)) + 2
+            if (batch["upsert"] or batch["remove"]) and size + item_size > self.PUBLISH_BATCH_BYTES:
+                yield batch
+                batch = new_batch(False)
+                size = len(json.dumps(batch))
+            batch[key].append(item)
+            size += item_size
+        yield batch
+
+    def publish_all_directories(self):
+        user_root = os.path.join(self.ROOT_DIR, str(self.user_id))
+        if not os.path.isdir(user_root):
+            return
+        with os.scandir(user_root) as entries:
+            directories = [entry.name for entry in entries if entry.is_dir() and entry.name != "download"]
+        for directory_name in directories:
+            self.publish_directory(directory_name)
+
+    def start_publisher(self):
+        """Rescan shared directories every PUBLISH_INTERVAL seconds and publish the changes."""
+        if self.publisher_started:
+            return
+        self.publisher_started = True
+
+        def publish_loop():
+            while True:
+                time.sleep(self.PUBLISH_INTERVAL)
+                try:
+                    self.publish_all_directories()
+                except Exception as e:
+                    print(f"Error publishing file index: {e}")
+        threading.Thread(target=publish_loop, daemon=True).start()
+
+    def search_file(self, file_name, mode="exact"):
+        """Ask the tracker's file index which online peers share a matching file (one round trip).
+
+        Returns None if the tracker could not answer, so callers can fall back to asking peers.
+        """
+        response = self.send_to_server(f"SEARCH_FILE {json.dumps({'query': file_name, 'mode': mode})}")
+        try:
+            data = json.loads(response)
+        except json.JSONDecodeError:
+            return None
+        if data.get("status") != "SEARCH_RESULTS":
+            return None
+        return data["data"]
+
     def list_directories(self, user_id):
         self.send_to_server(f"LIST_DIRS {user_id}")
 
+    def subscribe(self):
+        """Keep directory_replica current from tracker events instead of polling GET_ACTIVE_DIRS.
+
+        A second control connection is opened with SUBSCRIBE; it is reopened
+        (starting over from a fresh snapshot) whenever it drops, until
+        unsubscribe() or the session ends.
+        """
+        if self.session_token is None:
+            return False
+        if self.subscription is None:
+            self.subscription = subscription = object()
+            threading.Thread(target=self.subscription_loop, args=(subscription, self.session_token),
+                             daemon=True).start()
+        return True
+
+    def unsubscribe(self):
+        self.subscription = None
+        self.subscribed = False
+        sock = self.subscription_socket
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def subscription_loop(self, subscription, token):
+        while self.subscription is subscription and token == self.session_token:
+            try:
+                with socket.create_connection((self.SERVER_IP, self.SERVER_PORT)) as sock:
+                    self.subscription_socket = sock
+                    if self.subscription is not subscription:
+                        return
+                    sock.settimeout(self.SUBSCRIPTION_TIMEOUT)
+                    protocol.send_request(sock, f"SUBSCRIBE {token}")
+                    while (frame := protocol.recv_frame(sock)) is not None:
+                        frame_type, _, payload = frame
+                        if frame_type == protocol.EVENT:
+                            event = json.loads(payload)
+                            if event["type"] == "heartbeat":
+                                protocol.send_request(sock, "HEARTBEAT")
+                            else:
+                                self.apply_directory_event(event)
+                        elif frame_type == protocol.RESPONSE and payload == b"SESSION_EXPIRED":
+                            print("Session expired, directory updates stopped.")
+                            if self.subscription is subscription:
+                                self.subscription = None
+                            return
+            except (OSError, ValueError) as e:
+                if self.subscription is subscription:
+                    print(f"Directory subscription lost: {e}")
+            if self.subscription is subscription:
+                self.subscribed = False
+                time.sleep(self.SUBSCRIBE_RETRY)
+
+    def apply_directory_event(self, event):
+        """Fold one pushed event into directory_replica; every event can safely be applied twice."""
+        with self.replica_lock:
+            if event["type"] == "snapshot":
+                self.directory_replica = {user["user_id"]: user for user in event["users"]}
+                self.subscribed = True
+            elif event["type"] == "user_online":
+                self.directory_replica[event["user"]["user_id"]] = event["user"]
+            elif event["type"] == "user_offline":
+                self.directory_replica.pop(event["user_id"], None)
+            elif event["type"] == "directory_added":
+                user = self.directory_replica.get(event["user_id"])
+                directory = event["directory"]
+                if user is not None and all(d["name"] != directory["name"] for d in user["directories"]):
+                    user["directories"].append(directory)
+            else:
+                return
+            self.replica_version += 1
+        if self.on_directory_event:
+            self.on_directory_event(event)
+
+    def get_directory_tree(self):
+        """The replicated active directory tree, in the same form as get_active_directories()."""
+        with self.replica_lock:
+            return [
+                {**user, "directories": list(user["directories"])}
+                for _, user in sorted(self.directory_replica.items())
+            ]
+
     def get_active_directories(self):
         response = self.send_to_server("GET_ACTIVE_DIRS")
         try:
@@ -178,161 +686,454 @@ class FileClient:
     def list_file_in_directory(self, target_ip, target_port, directory_path):
         """Request the contents of a directory from a peer."""
         try:
-            with socket.create_connection((target_ip, target_port)) as peer_socket:
-                command = f"LIST_FILE {directory_path}"
-                peer_socket.sendall(command.encode())
-
-                # Receive the response
-                response_data = b""
-                while True:
-                    data = peer_socket.recv(self.BUFFER_SIZE)
-                    if data == b"END_OF_LIST":
-                        break
-                    response_data += data
-
-                try:
-                    response = json.loads(response_data.decode())
-                    return response
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON: {e}")
-                    return []
+            return self.request_file_list(target_ip, target_port, directory_path, self.PEER_TIMEOUT)
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON: {e}")
+            return []
         except Exception as e:
             print(f"Error listing files: {e}")
             return []
 
-    def send_file(self, file_path, conn):
-        """Send file via TCP to a connected peer."""
+    def request_file_list(self, target_ip, target_port, directory_path, timeout):
+        """Fetch a peer's directory listing page by page; raises on failure instead of returning [].
+
+        Listings are cached with the directory's change token, so asking again for
+        an unchanged directory costs one empty reply. If the directory changes
+        between pages the listing starts over (at most LIST_RESTARTS times).
+        """
+        key = (target_ip, target_port, directory_path)
+        with self.file_lists_lock:
+            cached = self.file_lists.get(key)
+        files, cursor, restarts = [], None, 0
+        while True:
+            if_token = cached[0] if cached and cursor is None else None
+            try:
+                records, trailer = self.request_file_list_page(
+                    target_ip, target_port, directory_path, timeout, cursor, if_token)
+            except protocol.RemoteError as e:
+                if cursor is None or "Stale cursor" not in str(e) or restarts >= self.LIST_RESTARTS:
+                    raise
+                files, cursor, restarts = [], None, restarts + 1
+                continue
+            if trailer["not_modified"]:
+                files = cached[1]
+                break
+            files.extend(records)
+            cursor = trailer["next_cursor"]
+            if cursor is None:
+                break
+
+        with self.file_lists_lock:
+            self.file_lists[key] = (trailer["token"], files)
+            self.file_lists.move_to_end(key)
+            while len(self.file_lists) > self.FILE_LIST_CACHE_SIZE:
+                self.file_lists.popitem(last=False)
+        return files
+
+    def request_file_list_page(self, target_ip, target_port, directory_path, timeout, cursor=None, if_token=None):
+        """One LIST_FILE page: (records, trailer), records parsed as the DATA frames arrive."""
+        options = {"path": directory_path, "limit": self.LIST_PAGE_SIZE}
+        if cursor is not None:
+            options["cursor"] = cursor
+        if if_token is not None:
+            options["if_token"] = if_token
+        records = []
+        with self.peer_connections.connection(target_ip, target_port, timeout) as peer_socket:
+            request_id = protocol.send_request(peer_socket, f"LIST_FILE {json.dumps(options)}")
+            stream = protocol.iter_data(peer_socket, request_id)
+            partial = b""
+            while True:
+                try:
+                    block = next(stream)
+                except StopIteration as end:
+                    trailer = end.value
+                    break
+                lines = (partial + block).split(b"\n")
+                partial = lines.pop()  # A record may continue in the next block
+                records.extend(json.loads(line) for line in lines if line)
+        return records, json.loads(trailer)
+
+    def send_file(self, file_path, conn, request_id, codec=None, throttle=None):
+        """Send file via TCP to a connected peer, compressed with `codec` if it helps."""
         if not os.path.exists(file_path):
-                conn.sendall(b"ERROR: File not found")
+                protocol.send_frame(conn, protocol.ERROR, "ERROR: File not found", request_id)
                 return
         try:
             with open(file_path, "rb") as file:
-                while (data := file.read(self.BUFFER_SIZE)):
-                    conn.sendall(data)
-            conn.sendall(b"END_OF_FILE")  # Mark end of file
-            print(f"File '{file_path}' sent successfully.")
+                file_size = os.fstat(file.fileno()).st_size
+                protocol.send_file_data(conn, file, 0, file_size, request_id, codec, throttle)
+            protocol.send_frame(conn, protocol.END, b"", request_id)  # Mark end of file
+            self.bytes_sent.inc(file_size)
+            log.debug("File '%s' sent successfully.", file_path)
         except Exception as e:
             print(f"Error sending file: {e}")
+            raise
 
-    def download_file(self, target_ip, target_port, file_path):
-        """Download a file from a peer via TCP."""
-        # Receive the file
+    def send_chunk(self, file_path, start, end, conn, request_id, codec=None, throttle=None):
+        """Send the inclusive byte range [start, end] of a file to a connected peer.
+
+        Each chunk is compressed on its own (if `codec` is set and a sample of it
+        shrinks), so pieces from different peers can still be fetched independently.
+        """
+        if not os.path.exists(file_path):
+            protocol.send_frame(conn, protocol.ERROR, "ERROR: File not found", request_id)
+            return
+        with open(file_path, "rb") as file:
+            file_size = os.fstat(file.fileno()).st_size
+            count = max(0, min(end, file_size - 1) - start + 1)
+            protocol.send_file_data(conn, file, start, count, request_id, codec, throttle)
+        protocol.send_frame(conn, protocol.END, b"", request_id)
+        self.bytes_sent.inc(count)
+
+    def download_file(self, target_ip, target_port, file_path, progress=None, cancel=None):
+        """Download a file from a peer via TCP.
+
+        If download/ already holds a complete older copy of a similar size, only
+        the changed regions are transferred (download_file_delta). Otherwise, or
+        if that fails (e.g. the peer finds too much changed), the file
+        goes through the same verified, resumable piece pipeline as multi-peer
+        downloads, so an interrupted transfer picks up where it stopped.
+        `progress` and `cancel` work as in download_pieces, for either path; a
+        cancelled delta leaves the old copy as it was.
+        """
         file_name = os.path.basename(file_path)
-        download_directory = f"D:/shared_directories/{self.user_id}/download"
-        os.makedirs(download_directory, exist_ok=True)  # Create folder if it doesn't exist
-        download_path = os.path.join(download_directory, file_name)
-        
+        local_path = os.path.join(f"D:/shared_directories/{self.user_id}/download", file_name)
+        if os.path.isfile(local_path) and not os.path.exists(local_path + DownloadState.SUFFIX):
+            manifest = self.delta_candidate(target_ip, target_port, file_path, local_path)
+            if manifest is not None:
+                try:
+                    return self.download_file_delta(target_ip, target_port, file_path, local_path,
+                                                    progress, cancel, manifest["size"])
+                except Exception as e:
+                    if cancel is not None and cancel.is_set():
+                        print(f"Download of '{file_name}' cancelled.")
+                        return False
+                    print(f"Delta download of '{file_name}' failed, downloading the whole file: {e}")
+
+        peer = {"ip": target_ip, "port": target_port, "path": file_path}
         try:
-            with socket.create_connection((target_ip, target_port)) as peer_socket:
-                peer_socket.sendall(f"DOWNLOAD_FILE {file_path}".encode())
-
-                with open(download_path, "wb") as file:
-                    while True:
-                        data = peer_socket.recv(self.BUFFER_SIZE)
-                        if data == b"END_OF_FILE":
-                            print(f"File '{file_name}' downloaded successfully to '{download_path}'.")
-                            break
-                        file.write(data)
+            return self.download_pieces(file_name, [peer], progress, cancel)
         except Exception as e:
             print(f"Error downloading file: {e}")
+            return False
 
-    def search_file_across_peers(self, file_name):
-        """Search for a file across all peers."""
-        peers_with_file = []
-        for user in self.get_active_directories():
-            user_ip = user["ip"]
-            user_port = user["port"]
-            directories = user["directories"]
-
-            for directory in directories:
-                files = self.list_file_in_directory(user_ip, user_port, directory["path"])
-                for file in files:
-                    if file["name"] == file_name:
-                        peers_with_file.append({
-                            "ip": user_ip,
-                            "port": user_port,
-                            "path": file["path"]
-                        })
+    def delta_candidate(self, target_ip, target_port, file_path, local_path):
+        """The peer's manifest if the local copy could be an older version of its file, else None.
+
+        Unrelated content gains nothing from a delta and costs the peer a byte-by-byte
+        scan, so only copies within DELTA_MAX_SIZE_RATIO of the peer's size qualify.
+        """
+        manifest = self.get_manifest({"ip": target_ip, "port": target_port}, file_path)
+        if manifest is None:
+            return None
+        remote_size, local_size = manifest["size"], os.path.getsize(local_path)
+        if remote_size / self.DELTA_MAX_SIZE_RATIO <= local_size <= remote_size * self.DELTA_MAX_SIZE_RATIO:
+            return manifest
+        return None
+
+    def download_file_delta(self, target_ip, target_port, file_path, local_path,
+                            progress=None, cancel=None, total_size=None):
+        """Bring `local_path` up to date with a peer's file, rsync style.
+
+        Sends the block signatures of the local copy with DELTA_FILE; the peer
+        answers with block references and literal data, which are assembled into a
+        temporary file next to the old copy. The result replaces the old copy only
+        if its SHA-256 matches the peer's.
+
+        progress(rebuilt_bytes, total_size) is called as DATA frames arrive;
+        setting `cancel` (a threading.Event) aborts between frames with
+        ConnectionAbortedError.
+        """
+        block_size = delta.choose_block_size(os.path.getsize(local_path))
+        options = {
+            "path": file_path,
+            "block_size": block_size,
+            "signatures": base64.b64encode(delta.block_signatures(local_path, block_size)).decode(),
+        }
+        temp_path = local_path + ".delta"
+        digest = hashlib.sha256()
+        end = {}
+
+        def instructions(stream, output):
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise ConnectionAbortedError("cancelled")
+                if progress is not None and total_size:
+                    progress(min(output.tell(), total_size), total_size)
+                try:
+                    block = next(stream)
+                except StopIteration as stop:
+                    end["trailer"] = stop.value
+                    return
+                yield block
+
+        try:
+            with self.peer_connections.connection(target_ip, target_port, self.PEER_TIMEOUT) as peer_socket:
+                request_id = protocol.send_request(peer_socket, f"DELTA_FILE {json.dumps(options)}")
+                stream = protocol.iter_data(peer_socket, request_id)
+                with open(local_path, "rb") as basis, open(temp_path, "wb") as output:
+                    literal_bytes, copied_bytes = delta.apply_delta(
+                        instructions(stream, output), basis, output, block_size, digest)
+            trailer = json.loads(end["trailer"])
+            if digest.hexdigest() != trailer["sha256"]:
+                raise ValueError("file hash mismatch after applying delta")
+            os.replace(temp_path, local_path)
+            self.bytes_received.inc(literal_bytes)
+            if progress is not None and total_size is not None:
+                progress(total_size, total_size)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        print(f"File '{os.path.basename(local_path)}' updated: {literal_bytes} byte(s) transferred, "
+              f"{copied_bytes} reused from the local copy.")
+        return True
+
+    def search_file_across_peers(self, file_name, on_result=None):
+        """Search for a file across all peers, through the tracker index when it is available.
+
+        on_result(peer) is called for every match as soon as it is found.
+        """
+        matches = self.search_file(file_name)
+        if matches is not None:
+            peers_with_file = [{"ip": m["ip"], "port": m["port"], "path": m["path"]} for m in matches]
+            if on_result:
+                for peer in peers_with_file:
+                    on_result(peer)
+            return peers_with_file
+
+        peers_with_file, unresponsive = self.search_peers_concurrently(file_name, on_result)
+        if unresponsive:
+            print(f"Peers not responding, skipped for {self.UNRESPONSIVE_PEER_BACKOFF}s: "
+                  + ", ".join(f"{ip}:{port}" for ip, port in unresponsive))
         return peers_with_file
-    
+
+    def search_peers_concurrently(self, file_name, on_result=None, deadline=None):
+        """Ask every active peer for its file lists in parallel, within a global deadline.
+
+        Each peer gets SEARCH_PEER_TIMEOUT seconds per request and the whole search
+        at most `deadline` seconds (SEARCH_DEADLINE by default); matches are passed
+        to on_result as they arrive. Peers that fail or time out are remembered in
+        unresponsive_peers and skipped by searches for UNRESPONSIVE_PEER_BACKOFF
+        seconds. Returns (matches, unresponsive (ip, port) list).
+        """
+        deadline_at = time.monotonic() + (self.SEARCH_DEADLINE if deadline is None else deadline)
+        now = time.monotonic()
+        users = [
+            user for user in (self.get_active_directories() or [])
+            if now - self.unresponsive_peers.get((user["ip"], user["port"]), -math.inf)
+            > self.UNRESPONSIVE_PEER_BACKOFF
+        ]
+        if not users:
+            return [], []
+
+        def search_peer(user):
+            found = []
+            for directory in user["directories"]:
+                timeout = min(self.SEARCH_PEER_TIMEOUT, max(0.1, deadline_at - time.monotonic()))
+                for file in self.request_file_list(user["ip"], user["port"], directory["path"], timeout):
+                    if file["name"] == file_name:
+                        found.append({"ip": user["ip"], "port": user["port"], "path": file["path"]})
+            return found
+
+        peers_with_file, unresponsive = [], []
+        executor = ThreadPoolExecutor(max_workers=min(self.SEARCH_WORKERS, len(users)))
+        futures = {executor.submit(search_peer, user): (user["ip"], user["port"]) for user in users}
+        try:
+            for future in as_completed(futures, timeout=max(0, deadline_at - time.monotonic())):
+                peer_address = futures[future]
+                try:
+                    found = future.result()
+                except Exception as e:
+                    print(f"Peer {peer_address[0]}:{peer_address[1]} did not answer: {e}")
+                    unresponsive.append(peer_address)
+                    continue
+                self.unresponsive_peers.pop(peer_address, None)
+                for peer in found:
+                    peers_with_file.append(peer)
+                    if on_result:
+                        on_result(peer)
+        except FuturesTimeoutError:
+            unresponsive.extend(address for future, address in futures.items() if not future.done())
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        marked_at = time.monotonic()
+        for peer_address in unresponsive:
+            self.unresponsive_peers[peer_address] = marked_at
+        return peers_with_file, unresponsive
+
     def get_file_size(self, peer, file_path):
         """Request file size from a peer."""
         try:
-            with socket.create_connection((peer["ip"], peer["port"])) as peer_socket:
-                command = f"GET_FILE_SIZE {file_path}"
-                peer_socket.sendall(command.encode())
-                size = peer_socket.recv(1024).decode()
+            with self.peer_connections.connection(peer["ip"], peer["port"], self.PEER_TIMEOUT) as peer_socket:
+                request_id = protocol.send_request(peer_socket, f"GET_FILE_SIZE {file_path}")
+                size = protocol.recv_reply(peer_socket, request_id).decode()
                 return int(size)
         except Exception as e:
             print(f"Error retrieving file size from {peer['ip']}:{peer['port']}: {e}")
             return None
 
-    def download_file_bittorrent(self, file_name, peers):
+    def download_file_bittorrent(self, file_name, peers, progress=None, cancel=None):
         """Download file from multiple peers without knowing file size."""
-        chunk_size = 1024 * 1024  # 1MB
+        return self.download_pieces(file_name, peers, progress, cancel)
+
+    def download_pieces(self, file_name, peers, progress=None, cancel=None):
+        """Download a file piece by piece from one or more peers into download/.
+
+        Every peer is asked for the file's manifest first and only peers serving
+        the same content are used. Pieces are handed out by a PieceScheduler that
+        gives faster peers more pieces in flight and races the last pieces on
+        several peers (endgame); each piece is checked against its SHA-256 on
+        arrival, and failed or corrupt pieces are retried on another peer.
+        Verified pieces are written at their offset in a pre-sized output file,
+        so peak memory is MAX_CONCURRENT_CHUNKS x CHUNK_SIZE.
+
+        Completed pieces are recorded in a `<name>.state` sidecar; if one matching
+        the same content exists, only the missing pieces are fetched, from
+        whichever peers are available now.
+
+        progress(done_bytes, total_bytes), if given, is called from a download
+        thread once the size is known and after every stored piece. `cancel` is
+        an optional threading.Event: setting it aborts the download, which
+        returns False and keeps the sidecar so it can be resumed later.
+        """
         download_directory = f"D:/shared_directories/{self.user_id}/download"
         os.makedirs(download_directory, exist_ok=True)
         download_path = os.path.join(download_directory, file_name)
 
-        # Get file size from one of the peers
-        file_size = self.get_file_size(peers[0], peers[0]["path"])
-        if not file_size:
-            print("Failed to retrieve file size. Aborting.")
-            return
-        
-        # Prepare chunk download queue
-        num_chunks = (file_size + chunk_size - 1) // chunk_size
-        file_chunks = {}
-        chunk_lock = threading.Lock()
+        manifest, peers = self.select_consistent_peers(peers)
+        if manifest is None:
+            print("Failed to retrieve file manifest. Aborting.")
+            return False
+        file_size = manifest["size"]
+
+        state = DownloadState.load(download_path, manifest)
+        if state.resumed:
+            print(f"Resuming '{file_name}': {state.completed_count()}/{state.piece_count} pieces already downloaded.")
+        else:
+            # Pre-size the output file (sparse where the filesystem supports it)
+            with open(download_path, "wb") as output_file:
+                output_file.truncate(file_size)
+        missing = [
+            piece for piece in split_into_pieces(file_size, self.CHUNK_SIZE)
+            if not state.is_complete(piece.index)
+        ]
+        done_bytes = file_size - sum(piece.size for piece in missing)
+        if progress is not None:
+            progress(done_bytes, file_size)
 
-        def worker(peer, chunk_id, chunk_start, chunk_end):
+        def fetch_verified(peer, piece, buffer, transfer):
+            start = time.perf_counter()
             try:
-                with socket.create_connection((peer["ip"], peer["port"])) as peer_socket:
-                    command = f"DOWNLOAD_CHUNK {peer['path']} {chunk_start} {chunk_end}"
-                    peer_socket.sendall(command.encode())
-
-                    data = b""
-                    while True:
-                        packet = peer_socket.recv(self.BUFFER_SIZE)
-                        if packet == b"END_OF_CHUNK":
-                            break
-                        data += packet
-
-                    with chunk_lock:
-                        file_chunks[chunk_id] = data
-                        print(f"Đã tải chunk {chunk_id} từ {peer['ip']}:{peer['port']}")
-            except Exception as e:
-                print(f"Lỗi khi tải chunk {chunk_id} từ {peer['ip']}:{peer['port']}: {e}")
+                received = self.fetch_piece(peer, piece, buffer, transfer)
+                if received != piece.size:
+                    raise ConnectionError(f"short piece ({received} of {piece.size} bytes)")
+                if not verify_piece(manifest, piece.index, buffer[:received]):
+                    raise ValueError("piece hash mismatch")
+            except Exception:
+                if not transfer.cancelled:
+                    self.piece_failures.inc()
+                raise
+            labels = (f"{peer['ip']}:{peer['port']}",)
+            self.peer_bytes.inc(received, labels)
+            self.peer_seconds.inc(time.perf_counter() - start, labels)
+            self.bytes_received.inc(received)
+            return received
 
-        # Start threads for each peer
-        threads = []
-        for chunk_id in range(num_chunks):
-            chunk_start = chunk_id * chunk_size
-            chunk_end = min((chunk_id + 1) * chunk_size - 1, file_size - 1)
+        write_lock = threading.Lock()
+        with open(download_path, "r+b") as output_file:
+            def store(piece, data):
+                nonlocal done_bytes
+                with write_lock:
+                    output_file.seek(piece.offset)
+                    output_file.write(data)
+                    state.mark_complete(piece.index)
+                    state.save_if_due(output_file)
+                    done_bytes += piece.size
+                    done = done_bytes
+                log.debug("Đã tải chunk %s", piece.index)
+                if progress is not None:
+                    progress(done, file_size)
 
-            # Lấy peer để tải chunk này
-            peer = peers[chunk_id % len(peers)]  # Sử dụng vòng lặp qua các peers
+            scheduler = PieceScheduler(
+                peers,
+                missing,
+                fetch=fetch_verified,
+                store=store,
+                piece_size=self.CHUNK_SIZE,
+                peer_concurrency=self.PEER_CONCURRENCY,
+                max_peer_concurrency=self.MAX_PEER_CONCURRENCY,
+                max_in_flight=self.MAX_CONCURRENT_CHUNKS,
+                endgame_duplicates=self.ENDGAME_DUPLICATES,
+            )
+            completed = scheduler.run(cancel) if missing else True
+            if not completed:
+                state.save(output_file)
 
-            # Tạo luồng worker cho mỗi chunk
-            thread = threading.Thread(target=worker, args=(peer, chunk_id, chunk_start, chunk_end))
-            threads.append(thread)
-            thread.start()
+        if not completed and scheduler.cancelled:
+            print(f"Download of '{file_name}' cancelled; run it again to resume.")
+            return False
+        if not completed:
+            print(f"Download of '{file_name}' incomplete: {len(scheduler.failed)} chunk(s) missing; "
+                  f"run it again to resume.")
+            return False
+        state.remove()
+        print(f"File '{file_name}' downloaded successfully to '{download_path}'.")
+        return True
+
+    def get_manifest(self, peer, file_path):
+        """Request a file's piece manifest from a peer; None on failure."""
+        try:
+            with self.peer_connections.connection(peer["ip"], peer["port"], self.MANIFEST_TIMEOUT) as peer_socket:
+                request_id = protocol.send_request(peer_socket, f"GET_MANIFEST {self.CHUNK_SIZE} {file_path}")
+                manifest = json.loads(protocol.recv_reply(peer_socket, request_id).decode())
+            if manifest.get("piece_size") != self.CHUNK_SIZE:
+                raise ValueError(f"unexpected piece size {manifest.get('piece_size')}")
+            return manifest
+        except Exception as e:
+            print(f"Error retrieving manifest from {peer['ip']}:{peer['port']}: {e}")
+            return None
 
-        for thread in threads:
-            thread.join()
+    def select_consistent_peers(self, peers):
+        """Fetch manifests from all peers and keep those serving the same content.
 
-        # Combine chunks
-        with open(download_path, "wb") as output_file:
-            for chunk_id in sorted(file_chunks):
-                output_file.write(file_chunks[chunk_id])
+        The content of the first peer that answers wins (the one the user picked);
+        peers with a same-named but different file are left out.
+        Returns (manifest, peers) or (None, []).
+        """
+        with ThreadPoolExecutor(max_workers=min(self.SEARCH_WORKERS, len(peers)) or 1) as executor:
+            manifests = list(executor.map(lambda peer: self.get_manifest(peer, peer["path"]), peers))
+        reference = next((m for m in manifests if m is not None), None)
+        if reference is None:
+            return None, []
+        matching = [peer for peer, m in zip(peers, manifests) if m is not None and m["root"] == reference["root"]]
+        for peer, m in zip(peers, manifests):
+            if m is not None and m["root"] != reference["root"]:
+                print(f"Skipping {peer['ip']}:{peer['port']}: '{peer['path']}' has different content")
+        return reference, matching
 
-        print(f"File '{file_name}' downloaded successfully using BitTorrent to '{download_path}'.")
+    def fetch_piece(self, peer, piece, buffer, transfer=None):
+        """Receive one piece from a peer into `buffer`; returns the number of bytes received.
 
-    def send_data_in_chunks(self, data, conn):
-        while data:
-            chunk = data[:self.BUFFER_SIZE]
-            conn.sendall(chunk.encode())
-            data = data[self.BUFFER_SIZE:]
+        If the scheduler cancels `transfer` (endgame duplicate lost the race) the
+        socket is shut down, which aborts the receive and keeps the connection out
+        of the pool. The transfer is finished before the socket goes back to the
+        pool, so a cancel arriving after that leaves the socket alone.
+        """
+        with self.peer_connections.connection(peer["ip"], peer["port"], self.PEER_TIMEOUT) as peer_socket:
+            on_first_frame = None
+            if transfer is not None:
+                transfer.on_cancel(lambda: peer_socket.shutdown(socket.SHUT_RDWR))
+                on_first_frame = transfer.mark_first_byte
+            command = f"DOWNLOAD_CHUNK {peer['path']} {piece.offset} {piece.end}"
+            if self.COMPRESSION:
+                command = compression.with_accept(command, compression.available_codecs())
+            request_id = protocol.send_request(peer_socket, command)
+            received = protocol.recv_data_into(peer_socket, request_id, buffer, on_first_frame)
+            if transfer is not None and not transfer.finish():
+                raise ConnectionAbortedError("cancelled")
+            return received
 
 def main():
     # Step 1: Obtain an IP from the DHCP server
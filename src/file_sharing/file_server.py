@@ -1,114 +1,313 @@
 import os
+import sys
 import json
+import time
 import socket
+import asyncio
 import threading
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from src.db.database_handler import DatabaseHandler
+from src.file_sharing import protocol
+from src.file_sharing.presence import PresenceHub, SocketConnection, StreamConnection
+from src.file_sharing.session_table import SessionTable
+from src.utils import metrics
+from src.utils.log import get_logger
+
+log = get_logger("file_server")
 
 class FileServer:
     # File sharing configurations
     SERVER_IP = '127.0.0.1'
     SERVER_PORT = 5001
     BUFFER_SIZE = 1024
+    BACKLOG = 1024  # Pending connections the OS queues during connect bursts
+    DB_WORKERS = 8  # Threads running blocking DatabaseHandler calls in asyncio mode
+    # Commands whose argument is the rest of the line, unsplit: one JSON document, or a name that may hold spaces
+    UNSPLIT_COMMANDS = {'PUBLISH_FILES', 'SEARCH_FILE', 'CREATE_DIR'}
+    SEARCH_LIMIT = 200
     ROOT_DIR = "D:/shared_directories"
+    METRICS_PORT = None  # Port for a Prometheus /metrics endpoint on localhost, None to disable
+    SESSION_TTL = 12 * 3600  # Seconds a session token stays valid without being used
+    MAX_SESSIONS = 100000  # Least recently used sessions are evicted beyond this
+    HEARTBEAT_INTERVAL = 10  # Seconds between heartbeats to subscribed connections
+    HEARTBEAT_MISSES = 3  # Unanswered heartbeats before a subscriber's user is pruned as dead
 
     def __init__(self):
         self.db_handler = DatabaseHandler()
-        self.active_users = {}
+        self.active_users = {}  # socket address -> "Unknown" or {"id", "ip", "port", "token"} once logged in
+        self.sessions = SessionTable(self.SESSION_TTL, self.MAX_SESSIONS)
+        self.presence = PresenceHub()
+        self.control_connections = {}  # socket address -> SocketConnection / StreamConnection
+        # GET_ACTIVE_DIRS snapshot, dropped on LOGIN, disconnect and CREATE_DIR
+        self.active_dirs_cache = None
+        self.active_dirs_generation = 0
+        self.active_dirs_lock = threading.Lock()
+        self.commands = {
+            'REGISTER': self.handle_register,
+            'LOGIN': self.handle_login,
+            'RESUME': self.handle_resume,
+            'CREATE_DIR': self.handle_create_directory,
+            'LIST_DIRS': self.handle_list_directories,
+            'GET_ACTIVE_DIRS': self.handle_get_active_directories,
+            'PUBLISH_FILES': self.handle_publish_files,
+            'SEARCH_FILE': self.handle_search_file,
+            'STATS': self.handle_stats,
+            'SUBSCRIBE': self.handle_subscribe,
+            'HEARTBEAT': self.handle_heartbeat,
+        }
+        self.metrics = metrics.MetricsRegistry()
+        self.requests_total = self.metrics.counter(
+            "p2p_server_requests_total", "Control requests handled", ("command",))
+        self.request_seconds = self.metrics.histogram(
+            "p2p_server_request_seconds", "Time to handle a control request", ("command",))
+        self.connections = self.metrics.gauge("p2p_server_connections", "Open control connections")
+        self.metrics.gauge("p2p_server_active_users", "Logged-in users",
+                           function=lambda: sum(isinstance(user, dict) for user in list(self.active_users.values())))
+        self.metrics.gauge("p2p_server_sessions", "Live session tokens", function=lambda: len(self.sessions))
+        self.metrics.gauge("p2p_server_subscribers", "Connections receiving presence events",
+                           function=lambda: len(self.presence.subscribers))
 
     def hash_password(self, password):
         return hashlib.sha256(password.encode()).hexdigest()
 
+    def dispatch(self, request, client_address):
+        """Run one request through the command table and return the response text."""
+        command, _, rest = request.strip().partition(" ")
+        args = [rest] if command in self.UNSPLIT_COMMANDS else rest.split()
+        handler = self.commands.get(command)
+        if handler is None:
+            self.requests_total.inc(labels=("UNKNOWN",))  # Keeps arbitrary input out of the label set
+            return "ERROR: Unknown command"
+        start = time.perf_counter()
+        try:
+            return handler(args, client_address)
+        except (ValueError, IndexError):
+            return "ERROR: Invalid arguments."  # e.g. a port that is not a number; keeps the connection open
+        finally:
+            labels = (command,)
+            self.requests_total.inc(labels=labels)
+            self.request_seconds.observe(time.perf_counter() - start, labels)
+
     def handle_client(self, client_socket):
         client_address = client_socket.getpeername()
-        self.active_users[client_address] = "Unknown"
+        connection = SocketConnection(client_socket)
+        self.open_connection(client_address, connection)
+        subscribed = False
         while True:
             try:
-                request = client_socket.recv(self.BUFFER_SIZE).decode()
-                command, *args = request.split()
-
-                commands = {
-                    'REGISTER': self.handle_register,
-                    'LOGIN': self.handle_login,
-                    'CREATE_DIR': self.handle_create_directory,
-                    'LIST_DIRS': self.handle_list_directories,
-                    'GET_ACTIVE_DIRS': self.handle_get_active_directories,
-                }
-                if command in commands:
-                    commands[command](client_socket, args, client_address)
-                else:
-                    client_socket.send("ERROR: Unknown command".encode())
+                frame = protocol.recv_frame(client_socket, protocol.MAX_REQUEST_SIZE)
+                if frame is None:
+                    break
+                frame_type, request_id, payload = frame
+                if frame_type != protocol.REQUEST:
+                    connection.send_frame(protocol.ERROR, "ERROR: Expected a request frame", request_id)
+                    continue
+                response = self.dispatch(payload.decode(), client_address)
+                connection.send_frame(protocol.RESPONSE, response, request_id)
+                if not subscribed and self.presence.is_subscribed(client_address):
+                    # From now on the client answers heartbeats; silence means it is gone
+                    subscribed = True
+                    client_socket.settimeout(self.HEARTBEAT_INTERVAL * self.HEARTBEAT_MISSES)
+            except socket.timeout:
+                self.prune_subscriber(client_address)
+                break
             except Exception as e:
                 print(f"Error handling client request: {e}")
                 break
 
-        if client_address in self.active_users:
-            del self.active_users[client_address]
+        self.close_connection(client_address)
         client_socket.close()  # Close the client socket after handling
 
-    def handle_register(self, client_socket, args, *_):
-        if len(args) < 2:
-            client_socket.send("ERROR: Missing registration info.".encode())
+    async def handle_client_async(self, reader, writer):
+        """Serve one control connection on the event loop; DB work runs in the executor."""
+        client_address = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+        self.open_connection(client_address, StreamConnection(writer, loop))
+        try:
+            while True:
+                if self.presence.is_subscribed(client_address):
+                    try:
+                        frame = await asyncio.wait_for(
+                            protocol.read_frame(reader, protocol.MAX_REQUEST_SIZE), self.HEARTBEAT_INTERVAL * self.HEARTBEAT_MISSES)
+                    except asyncio.TimeoutError:
+                        self.prune_subscriber(client_address)
+                        break
+                else:
+                    frame = await protocol.read_frame(reader, protocol.MAX_REQUEST_SIZE)
+                if frame is None:
+                    break
+                frame_type, request_id, payload = frame
+                if frame_type != protocol.REQUEST:
+                    writer.write(protocol.encode_frame(protocol.ERROR, "ERROR: Expected a request frame", request_id))
+                    continue
+                response = await loop.run_in_executor(
+                    self.db_executor, self.dispatch, payload.decode(), client_address
+                )
+                writer.write(protocol.encode_frame(protocol.RESPONSE, response, request_id))
+                await writer.drain()
+        except Exception as e:
+            print(f"Error handling client request: {e}")
+        finally:
+            self.close_connection(client_address)
+            writer.close()
+
+    def open_connection(self, client_address, connection):
+        self.active_users[client_address] = "Unknown"
+        self.control_connections[client_address] = connection
+        self.connections.inc()
+
+    def close_connection(self, client_address):
+        self.presence.unsubscribe(client_address)
+        self.control_connections.pop(client_address, None)
+        self.remove_active_user(client_address)
+        self.connections.dec()
+
+    def prune_subscriber(self, client_address):
+        """A subscriber missed its heartbeats: its host is presumably gone, so log its user out everywhere.
+
+        Closing the user's other control connections makes their handlers clean
+        up (and publish user_offline) without waiting for TCP to notice.
+        """
+        entry = self.presence.unsubscribe(client_address)
+        if entry is None:
             return
+        _, user_id = entry
+        print(f"Subscriber {client_address} missed {self.HEARTBEAT_MISSES} heartbeats, pruning user {user_id}")
+        for address, user in list(self.active_users.items()):
+            if isinstance(user, dict) and user["id"] == user_id:
+                connection = self.control_connections.get(address)
+                if connection is not None:
+                    connection.close()
+
+    def handle_register(self, args, *_):
+        if len(args) < 2:
+            return "ERROR: Missing registration info."
 
         username, password = args[0], args[1]
         password_hash = self.hash_password(password)
         self.db_handler.register_user(username, password_hash)
-        client_socket.send("Registration successful.".encode())
+        return "Registration successful."
 
-    def handle_login(self, client_socket, args, client_address):
-        if len(args) < 3:
-            client_socket.send("ERROR: Missing login info.".encode())
-            return
+    def handle_login(self, args, client_address):
+        if len(args) < 4:
+            return "ERROR: Missing login info."
 
         username, password, client_ip, client_port = args[0], args[1], args[2], int(args[3])
         password_hash = self.hash_password(password)
         user = self.db_handler.get_user(username, password_hash)
         if user:
-            self.active_users[client_address] = {"id": user["id"], "ip": client_ip, "port": client_port}
-            client_socket.send(f"LOGIN_SUCCESS {user['id']} {user['username']}".encode())
-        else:
-            client_socket.send("LOGIN_FAILED".encode())
+            session = self.sessions.create(user["id"], user["username"])
+            return self.bind_session(session, client_address, client_ip, client_port)
+        return "LOGIN_FAILED"
 
-    def handle_create_directory(self, client_socket, args, *_):
-        if len(args) < 2:
-            client_socket.send("ERROR: Missing directory info.".encode())
-            return
+    def handle_resume(self, args, client_address):
+        """RESUME <token> <ip> <port>: log a new connection in with a session token instead of the password."""
+        if len(args) < 3:
+            return "ERROR: Missing session info."
 
-        user_id, directory_name = int(args[0]), args[1]
+        session = self.sessions.get(args[0])
+        if session is None:
+            return "SESSION_EXPIRED"
+        if not self.account_exists(session):
+            return "SESSION_EXPIRED"
+        return self.bind_session(session, client_address, args[1], int(args[2]))
 
-        self.db_handler.add_directory(user_id, directory_name)
-        client_socket.send(f"Directory '{directory_name}' created.".encode())
+    def bind_session(self, session, client_address, client_ip, client_port):
+        previous = self.active_users.get(client_address)
+        if isinstance(previous, dict):
+            self.presence.user_disconnected(previous["id"])
+        self.active_users[client_address] = {
+            "id": session.user_id, "ip": client_ip, "port": client_port, "token": session.token
+        }
+        self.invalidate_active_directories()
+        self.presence.user_connected(session.user_id, lambda: {
+            "user_id": session.user_id, "ip": client_ip, "port": client_port,
+            "directories": [{"name": d["name"], "path": d["path"]}
+                            for d in self.db_handler.get_user_directories(session.user_id)],
+        })
+        return f"LOGIN_SUCCESS {session.user_id} {session.username} {session.token}"
 
-    def handle_list_directories(self, client_socket, args, *_):
-        if len(args) < 1:
-            client_socket.send("ERROR: Missing user ID.".encode())
-            return
-        
-        user_id = int(args[0])
+    def account_exists(self, session):
+        """Whether a session's account is still there; if it was deleted (or re-created), end all its sessions."""
+        account = self.db_handler.get_user_record(session.username)  # Served from the user cache
+        if account is None or account["id"] != session.user_id:
+            self.sessions.remove_user(session.user_id)
+            return False
+        return True
+
+    def session_user(self, client_address):
+        """The logged-in user of a connection, or None if it never logged in, its session has ended or its account is gone."""
+        user = self.active_users.get(client_address)
+        if not isinstance(user, dict):
+            return None
+        session = self.sessions.get(user["token"])
+        if session is None or not self.account_exists(session):
+            self.active_users[client_address] = "Unknown"
+            self.invalidate_active_directories()
+            self.presence.user_disconnected(user["id"])
+            return None
+        return user
+
+    def handle_create_directory(self, args, client_address):
+        """CREATE_DIR <name> for the connection's own user; the name is the rest of the line and may contain spaces."""
+        directory_name = args[0].strip() if args else ""
+        if not directory_name:
+            return "ERROR: Missing directory info."
+        user = self.session_user(client_address)
+        if user is None:
+            return "ERROR: Login required."
+
+        path = self.db_handler.add_directory(user["id"], directory_name)
+        self.invalidate_active_directories()
+        self.presence.directory_added(user["id"], directory_name, path)
+        return f"Directory '{directory_name}' created."
+
+    def handle_list_directories(self, args, client_address):
+        """LIST_DIRS <user_id>, or LIST_DIRS alone for the connection's own user."""
+        if args:
+            user_id = int(args[0])
+        else:
+            user = self.session_user(client_address)
+            if user is None:
+                return "ERROR: Missing user ID."
+            user_id = user["id"]
         directories = self.db_handler.get_user_directories(user_id)
         if directories:
-            dir_list = "\n".join(f"{d['name']} - {d['path']}" for d in directories)
-            client_socket.send(dir_list.encode())
-        else:
-            client_socket.send("No directories found.".encode())
+            return "\n".join(f"{d['name']} - {d['path']}" for d in directories)
+        return "No directories found."
 
-    def handle_get_active_directories(self, client_socket, *_):
-        if not self.active_users:
-            response = json.dumps({"status": "ACTIVE_DIRS", "message": "Không có thư mục nào."})
-            client_socket.send(response.encode())
-            return
-        
+    def handle_get_active_directories(self, *_):
+        """Serve the pre-encoded active-directory snapshot, rebuilding it only after a change."""
+        with self.active_dirs_lock:
+            cached, generation = self.active_dirs_cache, self.active_dirs_generation
+        if cached is not None:
+            return cached
+
+        response = self.build_active_directories()
+        with self.active_dirs_lock:
+            # Only keep the snapshot if nothing changed while it was being built
+            if generation == self.active_dirs_generation:
+                self.active_dirs_cache = response
+        return response
+
+    def build_active_directories(self):
+        online = [user for user in list(self.active_users.values()) if isinstance(user, dict)]
+        if not online:
+            return json.dumps({"status": "ACTIVE_DIRS", "message": "Không có thư mục nào."}).encode()
+
+        # One query for every online user instead of one per user
+        directories = self.db_handler.get_directories_for_users({user["id"] for user in online})
         grouped_directories = {
             user["id"]: {
                 "ip": user["ip"],
                 "port": user["port"],
                 "directories": [
                     {"name": d["name"], "path": d["path"]}
-                    for d in self.db_handler.get_user_directories(user["id"])
+                    for d in directories.get(user["id"], [])
                 ],
             }
-            for addr, user in self.active_users.items()
+            for user in online
         }
         response = {
             "status": "ACTIVE_DIRS",
@@ -117,18 +316,113 @@ class FileServer:
                 for user_id, details in grouped_directories.items()
             ],
         }
-        client_socket.send(json.dumps(response).encode())
+        return json.dumps(response).encode()
+
+    def invalidate_active_directories(self):
+        with self.active_dirs_lock:
+            self.active_dirs_generation += 1
+            self.active_dirs_cache = None
+
+    def remove_active_user(self, client_address):
+        user = self.active_users.pop(client_address, None)
+        if isinstance(user, dict):
+            self.invalidate_active_directories()
+            self.presence.user_disconnected(user["id"])
+
+    def handle_subscribe(self, args, client_address):
+        """SUBSCRIBE <token>: turn this connection into a feed of presence and directory events."""
+        if len(args) < 1:
+            return "ERROR: Missing session token."
+        session = self.sessions.get(args[0])
+        if session is None or not self.account_exists(session):
+            return "SESSION_EXPIRED"
+        connection = self.control_connections.get(client_address)
+        if connection is None:
+            return "ERROR: Connection closed."
+        self.presence.subscribe(client_address, connection, session.user_id,
+                                lambda: json.loads(self.handle_get_active_directories()).get("data", []))
+        return "SUBSCRIBED"
+
+    def handle_heartbeat(self, *_):
+        return "OK"
+
+    def start_heartbeats(self):
+        def heartbeat_loop():
+            while True:
+                time.sleep(self.HEARTBEAT_INTERVAL)
+                self.presence.heartbeat()
+        threading.Thread(target=heartbeat_loop, daemon=True).start()
+
+    def handle_publish_files(self, args, client_address):
+        """Index a directory's file metadata as sent by its owner: upserts, removals, or a full reset."""
+        user = self.session_user(client_address)
+        if user is None:
+            return "ERROR: Login required."
+        try:
+            update = json.loads(args[0])
+        except (IndexError, json.JSONDecodeError):
+            return "ERROR: Invalid file list."
+        if not valid_file_update(update):
+            return "ERROR: Invalid file list."
+
+        directory = self.db_handler.get_directory(user["id"], update.get("directory"))
+        if directory is None:
+            return "ERROR: Unknown directory."
+        if update.get("reset"):
+            self.db_handler.clear_directory_files(directory["id"])
+        if update.get("remove"):
+            self.db_handler.remove_files(directory["id"], update["remove"])
+        if update.get("upsert"):
+            self.db_handler.upsert_files(directory["id"], user["id"], update["upsert"])
+        return json.dumps({"status": "PUBLISHED", "indexed": len(update.get("upsert", []))})
+
+    def handle_search_file(self, args, *_):
+        """Look a file name up in the index; only peers that are online are returned."""
+        try:
+            request = json.loads(args[0])
+        except (IndexError, json.JSONDecodeError):
+            return "ERROR: Invalid search request."
+        if not isinstance(request, dict):
+            return "ERROR: Invalid search request."
+        query, mode, limit = request.get("query"), request.get("mode", "exact"), request.get("limit", self.SEARCH_LIMIT)
+        if not isinstance(query, str) or not isinstance(mode, str):
+            return "ERROR: Invalid search request."
+        if not isinstance(limit, int) or isinstance(limit, bool):
+            return "ERROR: Invalid search limit."
+        limit = max(1, min(limit, self.SEARCH_LIMIT))  # SQLite reads a negative LIMIT as no limit
+
+        online = {user["id"]: user for user in list(self.active_users.values()) if isinstance(user, dict)}
+        try:
+            matches = self.db_handler.search_files(query, mode, online, limit)
+        except ValueError as e:
+            return f"ERROR: {e}"
+        results = [
+            {"ip": online[m["user_id"]]["ip"], "port": online[m["user_id"]]["port"], **m}
+            for m in matches
+        ]
+        return json.dumps({"status": "SEARCH_RESULTS", "data": results})
+
+    def handle_stats(self, *_):
+        """Counters, gauges and per-command latency summaries as JSON."""
+        return json.dumps({"status": "STATS", "data": self.metrics.snapshot()})
+
+    def start_metrics_endpoint(self):
+        if self.METRICS_PORT:
+            metrics.start_metrics_server(self.metrics, self.METRICS_PORT)
+            print(f"Metrics on http://127.0.0.1:{self.METRICS_PORT}/metrics")
 
     def start_file_server(self):
+        self.start_metrics_endpoint()
+        self.start_heartbeats()
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.bind((self.SERVER_IP, self.SERVER_PORT))
-        server_socket.listen(5)
+        server_socket.listen(self.BACKLOG)
         print("File Server is running...")
 
         try:
             while True:
                 client_socket, addr = server_socket.accept()
-                print(f"Connection from {addr}")
+                log.debug("Connection from %s", addr)
                 client_thread = threading.Thread(target=self.handle_client, daemon=True, args=(client_socket,))
                 client_thread.start()
         except KeyboardInterrupt:
@@ -136,6 +430,61 @@ class FileServer:
         finally:
             server_socket.close()
 
+    async def serve_async(self):
+        """Accept control connections on a single event loop."""
+        server = await asyncio.start_server(
+            self.handle_client_async, self.SERVER_IP, self.SERVER_PORT, backlog=self.BACKLOG
+        )
+        print("File Server (asyncio) is running...")
+        async with server:
+            await server.serve_forever()
+
+    def start_async_file_server(self):
+        """Asyncio serving mode: one event loop holds every idle control connection."""
+        raise_open_file_limit()
+        self.start_metrics_endpoint()
+        self.start_heartbeats()
+        self.db_executor = ThreadPoolExecutor(max_workers=self.DB_WORKERS, thread_name_prefix="db")
+        try:
+            asyncio.run(self.serve_async())
+        except KeyboardInterrupt:
+            print("\nServer shutting down...")
+        finally:
+            self.db_executor.shutdown(wait=False)
+
+def valid_file_update(update):
+    """Whether a PUBLISH_FILES document has the shape DatabaseHandler expects, so bad input gets an ERROR reply."""
+    if not isinstance(update, dict) or not isinstance(update.get("directory"), str):
+        return False
+    upsert, remove = update.get("upsert", []), update.get("remove", [])
+    if not isinstance(upsert, list) or not isinstance(remove, list):
+        return False
+    if not all(isinstance(name, str) for name in remove):
+        return False
+    for entry in upsert:
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str) or not isinstance(entry.get("path"), str):
+            return False
+        for key in ("size", "mtime"):
+            if not isinstance(entry.get(key), (int, float)) or isinstance(entry.get(key), bool):
+                return False
+    return True
+
+def raise_open_file_limit():
+    """Lift the soft open-file limit to the hard limit so 10k+ sockets fit (POSIX only)."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            print(f"Could not raise open file limit: {e}")
+
 if __name__ == "__main__":
     file_server = FileServer()
-    file_server.start_file_server() 
\ No newline at end of file
+    if "--async" in sys.argv:
+        file_server.start_async_file_server()
+    else:
+        file_server.start_file_server() 
\ No newline at end of file
@@ -0,0 +1,67 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+MIN_PIECE_SIZE = 16 * 1024
+MAX_PIECE_SIZE = 16 * 1024 * 1024  # A requested piece size is allocated as one hashing buffer
+
+
+def build_manifest(file_path, piece_size):
+    """Hash a file piece by piece.
+
+    The manifest lists the total size and the SHA-256 of every piece; `root` is the
+    SHA-256 of all piece digests and identifies the file content as a whole.
+    """
+    if not MIN_PIECE_SIZE <= piece_size <= MAX_PIECE_SIZE:
+        raise ValueError(f"Piece size {piece_size} outside {MIN_PIECE_SIZE}..{MAX_PIECE_SIZE}")
+    pieces = []
+    root = hashlib.sha256()
+    buffer = bytearray(piece_size)
+    view = memoryview(buffer)
+    size = 0
+    with open(file_path, "rb") as file:
+        while True:
+            n = file.readinto(view)
+            if not n:
+                break
+            digest = hashlib.sha256(view[:n]).digest()
+            pieces.append(digest.hex())
+            root.update(digest)
+            size += n
+    return {"size": size, "piece_size": piece_size, "pieces": pieces, "root": root.hexdigest()}
+
+
+def verify_piece(manifest, index, data):
+    return hashlib.sha256(data).hexdigest() == manifest["pieces"][index]
+
+
+class ManifestCache:
+    """Manifests of shared files, recomputed only when a file's size or mtime changes.
+
+    Entries are keyed by (path, size, mtime, piece size) and the least recently
+    used ones are dropped beyond `max_entries`.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file_path, piece_size):
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, piece_size)
+        with self.lock:
+            manifest = self.entries.get(key)
+            if manifest is not None:
+                self.entries.move_to_end(key)
+                return manifest
+
+        manifest = build_manifest(file_path, piece_size)
+        if manifest["size"] != stat.st_size:
+            raise OSError(f"File changed while hashing: {file_path}")
+        with self.lock:
+            self.entries[key] = manifest
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return manifest
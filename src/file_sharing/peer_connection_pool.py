@@ -0,0 +1,114 @@
+import time
+import socket
+import selectors
+import threading
+from contextlib import contextmanager
+
+
+class PeerConnectionPool:
+    """Keep-alive TCP connections to peers, shared across requests.
+
+    LIST_FILE, GET_FILE_SIZE, DOWNLOAD_FILE and DOWNLOAD_CHUNK requests borrow a
+    connection with `connection(ip, port)` and hand it back when the reply has
+    been read completely, so consecutive requests skip the TCP handshake and
+    slow start. At most `max_per_peer` connections per peer are open at once;
+    connections idle for longer than `idle_timeout` seconds are closed.
+    """
+
+    def __init__(self, max_per_peer=4, idle_timeout=60, connect_timeout=10):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.idle = {}  # (ip, port) -> [(socket, last_used), ...], most recent last
+        self.slots = {}  # (ip, port) -> BoundedSemaphore(max_per_peer)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _slot(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.max_per_peer)
+            return self.slots[key]
+
+    @staticmethod
+    def _is_reusable(sock):
+        # An idle connection must have nothing to read: readable means EOF or stray bytes.
+        # A selector rather than select.select(), which rejects descriptors >= 1024
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(sock, selectors.EVENT_READ)
+                return not selector.select(0)
+        except (OSError, ValueError):
+            return False
+
+    def _take_idle(self, key):
+        now = time.monotonic()
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                sock, last_used = connections.pop()
+                if now - last_used <= self.idle_timeout and self._is_reusable(sock):
+                    self.hits += 1
+                    return sock
+                sock.close()
+            self.misses += 1
+        return None
+
+    def _give_back(self, key, sock):
+        with self.lock:
+            self.idle.setdefault(key, []).append((sock, time.monotonic()))
+
+    @contextmanager
+    def connection(self, ip, port, timeout=None):
+        """Borrow a connection to (ip, port); it is closed instead of reused if the body raises."""
+        key = (ip, port)
+        slot = self._slot(key)
+        if not slot.acquire(timeout=self.connect_timeout if timeout is None else timeout):
+            raise TimeoutError(f"No free connection to {ip}:{port}")
+        try:
+            sock = self._take_idle(key)
+            if sock is None:
+                connect_timeout = self.connect_timeout if timeout is None else min(timeout, self.connect_timeout)
+                sock = socket.create_connection(key, timeout=connect_timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(timeout)
+            try:
+                yield sock
+            except BaseException:
+                sock.close()
+                raise
+            self._give_back(key, sock)
+        finally:
+            slot.release()
+
+    def evict_idle(self):
+        """Close connections that have been idle for longer than idle_timeout."""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self.lock:
+            for key, connections in list(self.idle.items()):
+                keep = []
+                for sock, last_used in connections:
+                    if last_used < cutoff:
+                        sock.close()
+                    else:
+                        keep.append((sock, last_used))
+                if keep:
+                    self.idle[key] = keep
+                else:
+                    del self.idle[key]
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for sock, _ in connections:
+                    sock.close()
+            self.idle.clear()
+
+    def start_reaper(self):
+        """Evict idle connections in the background every idle_timeout / 2 seconds."""
+        def reap():
+            while True:
+                time.sleep(max(1, self.idle_timeout / 2))
+                self.evict_idle()
+        threading.Thread(target=reap, daemon=True).start()
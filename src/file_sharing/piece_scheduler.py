@@ -0,0 +1,356 @@
+import time
+import queue
+import threading
+from collections import deque
+
+from src.utils.log import get_logger
+
+log = get_logger("piece_scheduler")
+
+
+class Piece:
+    """A byte range of the file being downloaded."""
+    __slots__ = ("index", "offset", "size")
+
+    def __init__(self, index, offset, size):
+        self.index = index
+        self.offset = offset
+        self.size = size
+
+    @property
+    def end(self):
+        """Inclusive last byte, as DOWNLOAD_CHUNK expects it."""
+        return self.offset + self.size - 1
+
+    def __repr__(self):
+        return f"Piece({self.index}, offset={self.offset}, size={self.size})"
+
+
+def split_into_pieces(file_size, piece_size):
+    return [
+        Piece(index, offset, min(piece_size, file_size - offset))
+        for index, offset in enumerate(range(0, file_size, piece_size))
+    ]
+
+
+class Transfer:
+    """One attempt at fetching one piece from one peer.
+
+    In endgame mode the same piece can be requested from several peers; once one
+    copy arrives the others are cancelled through the callbacks that fetch()
+    registered with on_cancel (typically shutting the socket down). fetch()
+    calls finish() before it lets go of the socket, so a late cancel() can no
+    longer reach a connection that went back to the pool.
+    """
+
+    def __init__(self, piece, peer_index):
+        self.piece = piece
+        self.peer_index = peer_index
+        self.started = time.monotonic()
+        self.first_byte = None
+        self.cancelled = False
+        self.finished = False
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def mark_first_byte(self):
+        if self.first_byte is None:
+            self.first_byte = time.monotonic()
+
+    def on_cancel(self, callback):
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def finish(self):
+        """Drop the cancel callbacks; False if the transfer was cancelled first."""
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.finished = True
+            self.callbacks = []
+            return True
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled or self.finished:
+                return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except OSError:
+                pass
+
+
+class PeerStats:
+    """Exponentially weighted throughput and round-trip time of one peer."""
+    ALPHA = 0.3
+
+    def __init__(self):
+        self.throughput = None  # bytes per second
+        self.rtt = None  # seconds from request to first reply frame
+        self.pieces = 0
+        self.failures = 0
+
+    def record(self, size, duration, rtt):
+        rate = size / max(duration, 1e-6)
+        self.throughput = rate if self.throughput is None else self.ALPHA * rate + (1 - self.ALPHA) * self.throughput
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else self.ALPHA * rtt + (1 - self.ALPHA) * self.rtt
+        self.pieces += 1
+
+
+class PieceScheduler:
+    """Download pieces from several peers through a shared work queue.
+
+    Each peer gets a fixed pool of `max_peer_concurrency` worker threads that pull
+    pieces from the queue. How many of them may hold a piece at once adapts to
+    the peer's measured throughput: the fastest peer may use all of them, slower
+    peers proportionally fewer (at least one), and peers not measured yet start
+    at `peer_concurrency`. A failed or timed-out piece goes back to the front of
+    the queue and is retried on a peer that has not tried it yet; a peer that
+    keeps failing is dropped. At most `max_in_flight` requests are being received
+    at once, each into one of a fixed set of reusable buffers.
+
+    Once the queue is empty the scheduler enters endgame mode: idle workers also
+    request pieces that are still in flight elsewhere (up to `endgame_duplicates`
+    extra copies, oldest first), the first copy to arrive wins and the others are
+    cancelled, so the tail of the download does not wait on the slowest peer.
+
+    fetch(peer, piece, buffer, transfer) receives the piece into `buffer` and
+    returns the number of bytes written; it should raise on error or timeout,
+    call transfer.mark_first_byte() when the reply starts, and register a way to
+    abort itself with transfer.on_cancel().
+    store(piece, data) is called exactly once for every completed piece.
+
+    cancel() (or setting the Event passed to run) stops the download: no new
+    piece is started, running transfers are aborted and run() returns False
+    with the pieces that were stored so far left in place.
+    """
+    CANCEL_POLL = 0.2  # seconds between checks of run()'s cancel event
+
+    def __init__(self, peers, pieces, fetch, store, piece_size,
+                 peer_concurrency=2, max_peer_concurrency=4, max_in_flight=8,
+                 max_attempts=5, max_peer_failures=3, endgame_duplicates=2):
+        self.peers = list(peers)
+        self.pieces = list(pieces)
+        self.fetch = fetch
+        self.store = store
+        self.peer_concurrency = peer_concurrency
+        self.max_peer_concurrency = max(peer_concurrency, max_peer_concurrency)
+        self.max_attempts = max_attempts
+        self.max_peer_failures = max_peer_failures
+        self.endgame_duplicates = endgame_duplicates
+
+        self.pending = deque(self.pieces)
+        self.completed = set()
+        self.storing = set()
+        self.failed = set()
+        self.transfers = {}  # piece index -> [Transfer, ...] currently running
+        self.peer_in_flight = [0] * len(self.peers)
+        self.attempts = {}  # piece index -> number of failed attempts
+        self.tried = {}  # piece index -> set of peer indexes that failed it
+        self.peer_failures = [0] * len(self.peers)  # consecutive failures per peer
+        self.stats = [PeerStats() for _ in self.peers]
+        self.alive = set(range(len(self.peers)))
+        self.endgame = False
+        self.cancelled = False
+        self.condition = threading.Condition()
+
+        self.buffers = queue.LifoQueue()
+        for _ in range(max(1, min(max_in_flight, len(self.pieces) * (1 + endgame_duplicates)))):
+            self.buffers.put(bytearray(piece_size))
+
+    def run(self, cancel=None):
+        """Download every piece; returns True if all of them completed.
+
+        `cancel` is an optional threading.Event; once it is set the download is
+        cancelled as by cancel().
+        """
+        threads = [
+            threading.Thread(target=self.worker, args=(peer_index,), daemon=True)
+            for peer_index in range(len(self.peers))
+            for _ in range(self.max_peer_concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(self.CANCEL_POLL if cancel is not None else None)
+                if cancel is not None and cancel.is_set() and not self.cancelled:
+                    self.cancel()
+        return len(self.completed) == len(self.pieces)
+
+    def cancel(self):
+        """Stop the download: nothing new is started and running transfers are aborted."""
+        with self.condition:
+            self.cancelled = True
+            self.pending.clear()
+            running = [transfer for transfers in self.transfers.values() for transfer in transfers]
+            self.condition.notify_all()
+        for transfer in running:
+            transfer.cancel()
+
+    def peer_stats(self):
+        """Per-peer throughput (bytes/s), RTT (s) and piece counts measured so far."""
+        with self.condition:
+            return [
+                {"ip": peer["ip"], "port": peer["port"], "throughput": stats.throughput,
+                 "rtt": stats.rtt, "pieces": stats.pieces, "failures": stats.failures}
+                for peer, stats in zip(self.peers, self.stats)
+            ]
+
+    def worker(self, peer_index):
+        peer = self.peers[peer_index]
+        while True:
+            transfer = self.next_transfer(peer_index)
+            if transfer is None:
+                return
+            piece = transfer.piece
+            buffer = self.buffers.get()
+            # Timed from here: waiting for a buffer is not the peer's latency
+            transfer.started = time.monotonic()
+            claimed = False
+            try:
+                if transfer.cancelled:
+                    raise ConnectionAbortedError("cancelled")
+                received = self.fetch(peer, piece, memoryview(buffer), transfer)
+                if received != piece.size:
+                    raise ConnectionError(f"short piece ({received} of {piece.size} bytes)")
+                claimed = self.claim(transfer)
+                if claimed:
+                    self.store(piece, memoryview(buffer)[:received])
+                    self.piece_done(transfer)
+                else:
+                    self.transfer_ended(transfer)  # Another peer's copy won the race
+            except Exception as e:
+                if claimed:
+                    with self.condition:
+                        self.storing.discard(piece.index)  # store() failed; the piece is up for grabs again
+                if transfer.cancelled:
+                    self.transfer_ended(transfer)
+                else:
+                    log.warning("Lỗi khi tải chunk %s từ %s:%s: %s", piece.index, peer["ip"], peer["port"], e)
+                    self.piece_failed(transfer)
+            finally:
+                self.buffers.put(buffer)
+
+    def is_eligible(self, piece, peer_index):
+        tried = self.tried.get(piece.index, ())
+        # Prefer a peer that has not failed this piece; once every live peer has, any may retry it
+        return peer_index not in tried or self.alive.issubset(tried)
+
+    def allowed_concurrency(self, peer_index):
+        """Concurrent pieces this peer may hold, proportional to its share of the best throughput."""
+        rate = self.stats[peer_index].throughput
+        if rate is None:
+            return self.peer_concurrency
+        best = max(stats.throughput for stats in self.stats if stats.throughput is not None)
+        return max(1, min(self.max_peer_concurrency, round(self.max_peer_concurrency * rate / best)))
+
+    def endgame_piece(self, peer_index):
+        """An in-flight piece this peer could race for, oldest request first."""
+        candidates = [
+            running for index, running in self.transfers.items()
+            if index not in self.storing and index not in self.completed
+            and len(running) <= self.endgame_duplicates
+            and all(t.peer_index != peer_index for t in running)
+            and peer_index not in self.tried.get(index, ())
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda running: min(t.started for t in running))[0].piece
+
+    def start_transfer(self, piece, peer_index):
+        transfer = Transfer(piece, peer_index)
+        self.transfers.setdefault(piece.index, []).append(transfer)
+        self.peer_in_flight[peer_index] += 1
+        return transfer
+
+    def next_transfer(self, peer_index):
+        """Block until there is work for this peer; None once the peer has nothing left to do."""
+        with self.condition:
+            while True:
+                if peer_index not in self.alive or self.cancelled:
+                    return None
+                if self.peer_in_flight[peer_index] < self.allowed_concurrency(peer_index):
+                    for piece in self.pending:
+                        if self.is_eligible(piece, peer_index):
+                            self.pending.remove(piece)
+                            return self.start_transfer(piece, peer_index)
+                    if not self.pending and self.endgame_duplicates:
+                        piece = self.endgame_piece(peer_index)
+                        if piece is not None:
+                            if not self.endgame:
+                                self.endgame = True
+                                log.debug("Endgame: %s chunk(s) left, requesting duplicates", len(self.transfers))
+                            return self.start_transfer(piece, peer_index)
+                if not self.pending and not self.transfers:
+                    return None
+                self.condition.wait()
+
+    def claim(self, transfer):
+        """First finished copy of a piece wins the right to store it; the rest are cancelled."""
+        with self.condition:
+            index = transfer.piece.index
+            if index in self.completed or index in self.storing:
+                return False
+            self.storing.add(index)
+            losers = [t for t in self.transfers.get(index, []) if t is not transfer]
+        for loser in losers:
+            loser.cancel()
+        return True
+
+    def _remove_transfer(self, transfer):
+        running = self.transfers.get(transfer.piece.index, [])
+        if transfer in running:
+            running.remove(transfer)
+            self.peer_in_flight[transfer.peer_index] -= 1
+        if not running:
+            self.transfers.pop(transfer.piece.index, None)
+
+    def piece_done(self, transfer):
+        now = time.monotonic()
+        with self.condition:
+            self._remove_transfer(transfer)
+            self.storing.discard(transfer.piece.index)
+            self.completed.add(transfer.piece.index)
+            self.peer_failures[transfer.peer_index] = 0
+            rtt = transfer.first_byte - transfer.started if transfer.first_byte else None
+            self.stats[transfer.peer_index].record(transfer.piece.size, now - transfer.started, rtt)
+            self.condition.notify_all()
+
+    def transfer_ended(self, transfer):
+        with self.condition:
+            self._remove_transfer(transfer)
+            self.condition.notify_all()
+
+    def piece_failed(self, transfer):
+        piece, peer_index = transfer.piece, transfer.peer_index
+        with self.condition:
+            self._remove_transfer(transfer)
+            self.stats[peer_index].failures += 1
+            self.attempts[piece.index] = self.attempts.get(piece.index, 0) + 1
+            self.tried.setdefault(piece.index, set()).add(peer_index)
+            self.peer_failures[peer_index] += 1
+            if self.peer_failures[peer_index] >= self.max_peer_failures and peer_index in self.alive:
+                self.alive.discard(peer_index)
+                peer = self.peers[peer_index]
+                print(f"Bỏ peer {peer['ip']}:{peer['port']} sau {self.peer_failures[peer_index]} lần lỗi liên tiếp")
+
+            still_running = piece.index in self.transfers or piece.index in self.completed
+            if still_running:
+                pass  # An endgame duplicate is still working on it
+            elif self.attempts[piece.index] >= self.max_attempts or not self.alive:
+                self.failed.add(piece.index)
+            else:
+                self.pending.appendleft(piece)  # Retry soon, on another peer if possible
+
+            if not self.alive:
+                self.failed.update(p.index for p in self.pending)
+                self.pending.clear()
+            self.condition.notify_all()
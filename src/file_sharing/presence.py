@@ -0,0 +1,184 @@
+"""Presence and directory-change events pushed to subscribed tracker connections.
+
+A client that sends SUBSCRIBE on a control connection first gets a snapshot of
+the active directory tree, then one EVENT frame per change:
+
+    {"type": "snapshot", "seq": n, "users": [{"user_id", "ip", "port", "directories": [...]}, ...]}
+    {"type": "user_online", "seq": n, "user": {"user_id", "ip", "port", "directories": [...]}}
+    {"type": "user_offline", "seq": n, "user_id": id}
+    {"type": "directory_added", "seq": n, "user_id": id, "directory": {"name", "path"}}
+    {"type": "heartbeat", "seq": n}
+
+The snapshot is taken and the subscriber registered under the hub lock, and
+every event is numbered and queued under that same lock right after the state
+change it reports. So no change is lost between snapshot and feed, and events
+arrive in the order the changes happened. A change made just before the
+snapshot may still be reported once more as an event; applying an event twice
+has no further effect. Heartbeats are answered with a HEARTBEAT request; a
+subscription that stays silent too long is treated as a dead peer (see
+FileServer.HEARTBEAT_INTERVAL). A subscriber that cannot keep up with its
+events is disconnected instead of buffering them without limit.
+"""
+import json
+import queue
+import socket
+import threading
+
+from src.file_sharing import protocol
+
+
+class SocketConnection:
+    """A control connection served by a thread: replies from its handler, events from anywhere.
+
+    Events go through a queue drained by a writer thread (started on subscribe),
+    so a slow subscriber never blocks whoever published the event. Once
+    MAX_PENDING_EVENTS are waiting the subscriber is disconnected.
+    """
+    MAX_PENDING_EVENTS = 1000  # Events queued for a stalled subscriber before it is dropped
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.outbox = None
+
+    def send_frame(self, frame_type, payload, request_id):
+        with self.send_lock:
+            protocol.send_frame(self.sock, frame_type, payload, request_id)
+
+    def start_push(self):
+        self.outbox = queue.Queue(self.MAX_PENDING_EVENTS)
+        threading.Thread(target=self.push_loop, daemon=True).start()
+
+    def push(self, frame):
+        try:
+            self.outbox.put_nowait(frame)
+        except queue.Full:
+            self.close()
+
+    def push_loop(self):
+        while (frame := self.outbox.get()) is not None:
+            try:
+                with self.send_lock:
+                    self.sock.sendall(frame)
+            except OSError:
+                self.close()
+                return
+
+    def stop_push(self):
+        if self.outbox is not None:
+            try:
+                self.outbox.put_nowait(None)
+            except queue.Full:
+                self.close()  # The writer fails on the closed socket and stops
+
+    def close(self):
+        """Abort the connection; its handler's blocking read fails and it cleans up as usual."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class StreamConnection:
+    """A control connection served on the asyncio loop; pushes are handed to the loop thread.
+
+    Once more than MAX_BUFFERED_BYTES sit unsent in the transport the
+    subscriber is disconnected.
+    """
+    MAX_BUFFERED_BYTES = 4 * 1024 * 1024  # Unsent event bytes for a stalled subscriber before it is dropped
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+
+    def start_push(self):
+        pass
+
+    def push(self, frame):
+        self.loop.call_soon_threadsafe(self._write, frame)
+
+    def _write(self, frame):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > self.MAX_BUFFERED_BYTES:
+            self.writer.transport.abort()  # close() would wait for the buffer to drain; the handler sees EOF
+            return
+        self.writer.write(frame)
+
+    def stop_push(self):
+        pass
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+
+class PresenceHub:
+    """Counts logged-in connections per user and fans events out to subscribers."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.subscribers = {}  # socket address -> (connection, user id)
+        self.online = {}  # user id -> logged-in control connections
+
+    def subscribe(self, address, connection, user_id, snapshot):
+        """Start pushing to `connection`, beginning with `snapshot()` (the active directory tree).
+
+        The snapshot is taken under the hub lock, so every change published after
+        it reaches this subscriber and none published before it is missing from it.
+        """
+        connection.start_push()
+        with self.lock:
+            self.subscribers[address] = (connection, user_id)
+            self.seq += 1
+            event = {"type": "snapshot", "seq": self.seq, "users": snapshot()}
+            connection.push(protocol.encode_frame(protocol.EVENT, json.dumps(event)))
+
+    def unsubscribe(self, address):
+        with self.lock:
+            entry = self.subscribers.pop(address, None)
+        if entry is not None:
+            entry[0].stop_push()
+        return entry
+
+    def is_subscribed(self, address):
+        return address in self.subscribers
+
+    def user_connected(self, user_id, describe):
+        """A connection logged in; `describe()` gives the user's entry and is only called if it is news."""
+        with self.lock:
+            self.online[user_id] = self.online.get(user_id, 0) + 1
+            if self.online[user_id] == 1:
+                self._publish({"type": "user_online"}, lambda event: event.update(user=describe()))
+
+    def user_disconnected(self, user_id):
+        with self.lock:
+            remaining = self.online.get(user_id, 0) - 1
+            if remaining > 0:
+                self.online[user_id] = remaining
+                return
+            self.online.pop(user_id, None)
+            self._publish({"type": "user_offline", "user_id": user_id})
+
+    def directory_added(self, user_id, name, path):
+        with self.lock:
+            self._publish({"type": "directory_added", "user_id": user_id, "directory": {"name": name, "path": path}})
+
+    def heartbeat(self):
+        with self.lock:
+            self._publish({"type": "heartbeat"})
+
+    def _publish(self, event, complete=None):
+        """Number and queue an event for every subscriber; the caller holds self.lock.
+
+        complete(event) fills in details that are only worth computing when someone listens.
+        """
+        if not self.subscribers:
+            return
+        if complete is not None:
+            complete(event)
+        self.seq += 1
+        event["seq"] = self.seq
+        frame = protocol.encode_frame(protocol.EVENT, json.dumps(event))
+        for connection, _ in list(self.subscribers.values()):
+            connection.push(frame)
@@ -0,0 +1,363 @@
+"""Length-prefixed framing shared by the tracker and peer protocols.
+
+Every message is a fixed 16-byte header followed by `length` payload bytes:
+
+    magic    2s  b"FS"
+    version  B   PROTOCOL_VERSION
+    type     B   REQUEST / RESPONSE / DATA / END / ERROR / ENCODING / EVENT
+    req_id   I   chosen by the requester, echoed on every frame of the reply
+    length   Q   payload size in bytes
+
+Commands keep their text form ("LOGIN alice secret 10.0.0.5 6000") inside a
+REQUEST frame. Short replies come back as one RESPONSE frame; file contents come
+back as any number of DATA frames closed by an END frame, so no payload byte is
+ever mistaken for a sentinel and nothing is truncated.
+
+A DATA stream may start with an ENCODING frame naming a codec (see
+compression.py); every DATA frame after it is then compressed on its own, so
+receivers decode frame by frame.
+
+EVENT frames (request id 0) are pushed by the tracker, unasked, on a control
+connection that sent SUBSCRIBE; their payload is one JSON event.
+"""
+import os
+import struct
+import asyncio
+import itertools
+from src.file_sharing import compression
+
+MAGIC = b"FS"
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!2sBBIQ")
+
+# Frame types
+REQUEST = 1
+RESPONSE = 2
+DATA = 3
+END = 4
+ERROR = 5
+ENCODING = 6
+EVENT = 7
+
+STREAM_BLOCK_SIZE = 64 * 1024  # Payload bytes handled per read/write when streaming
+SENDFILE_FALLBACK_BLOCK = 256 * 1024  # Read size for the buffered path when sendfile is missing
+COMPRESSION_BLOCK_SIZE = 256 * 1024  # Uncompressed bytes per compressed DATA frame
+THROTTLE_BLOCK_SIZE = 64 * 1024  # Bytes per sendfile call when a throttle is given, so a new limit takes effect mid-transfer
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024  # Upper bound for a REQUEST/RESPONSE/ERROR payload
+MAX_REQUEST_SIZE = 1024 * 1024  # Upper bound for a REQUEST read by a listener (unauthenticated input)
+RECV_PREALLOCATE_LIMIT = 1024 * 1024  # Larger payloads are read in blocks, so memory follows what actually arrives
+
+_request_ids = itertools.count(1)
+
+
+class ProtocolError(Exception):
+    """The peer sent something that is not a valid frame for this protocol version."""
+
+
+class RemoteError(Exception):
+    """The other side answered with an ERROR frame."""
+
+
+def next_request_id():
+    return next(_request_ids) & 0xFFFFFFFF
+
+
+def pack_header(frame_type, request_id, length):
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, frame_type, request_id, length)
+
+
+def unpack_header(header):
+    magic, version, frame_type, request_id, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad frame magic {magic!r}")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    return frame_type, request_id, length
+
+
+def encode_frame(frame_type, payload=b"", request_id=0):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return pack_header(frame_type, request_id, len(payload)) + payload
+
+
+def send_frame(sock, frame_type, payload=b"", request_id=0):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    header = pack_header(frame_type, request_id, len(payload))
+    if len(payload) > STREAM_BLOCK_SIZE:
+        # Avoid copying a large payload just to prepend 16 bytes
+        sock.sendall(header)
+        sock.sendall(payload)
+    else:
+        sock.sendall(header + payload)
+
+
+def send_request(sock, command):
+    """Send a command and return the request id its reply will carry."""
+    request_id = next_request_id()
+    send_frame(sock, REQUEST, command, request_id)
+    return request_id
+
+
+def send_file_data(sock, file, offset, count, request_id, codec=None, throttle=None):
+    """Send `count` bytes of `file` starting at `offset` as a single DATA frame.
+
+    The body goes out through sendfile(2) when the platform has it, so the bytes
+    never pass through Python; elsewhere it falls back to a buffered copy.
+    With a `codec` the first block is compressed as a sample: if it shrinks
+    enough the range is sent compressed (_send_compressed), otherwise raw.
+    throttle(n), if given, blocks until n more bytes may be sent (rate limiting);
+    the body is then sent in THROTTLE_BLOCK_SIZE steps.
+    """
+    if codec is not None and count:
+        file.seek(offset)
+        sample = file.read(min(COMPRESSION_BLOCK_SIZE, count))
+        compressed = codec.compress(sample)
+        if compression.worth_compressing(sample, compressed):
+            _send_compressed(sock, file, len(sample), count, compressed, codec, request_id, throttle)
+            return
+    sock.sendall(pack_header(DATA, request_id, count))
+    if count == 0:
+        return
+    if throttle is not None:
+        sent = _send_throttled(sock, file, offset, count, throttle)
+    elif hasattr(os, "sendfile"):
+        sent = sock.sendfile(file, offset, count)
+    else:
+        sent = _send_buffered(sock, file, offset, count)
+    if sent != count:
+        raise ConnectionError(f"File shrank while sending: {sent} of {count} bytes sent")
+
+
+def _send_throttled(sock, file, offset, count, throttle):
+    sent = 0
+    while sent < count:
+        size = min(THROTTLE_BLOCK_SIZE, count - sent)
+        throttle(size)
+        if hasattr(os, "sendfile"):
+            n = sock.sendfile(file, offset + sent, size)
+        else:
+            n = _send_buffered(sock, file, offset + sent, size)
+        sent += n
+        if n < size:
+            break
+    return sent
+
+
+def _send_compressed(sock, file, sent, count, compressed, codec, request_id, throttle=None):
+    # ENCODING frame first, then one independently compressed DATA frame per block;
+    # `compressed` is the already compressed first block and the file is positioned after it
+    send_frame(sock, ENCODING, codec.name, request_id)
+    while True:
+        if throttle is not None:
+            throttle(len(compressed))
+        send_frame(sock, DATA, compressed, request_id)
+        if sent >= count:
+            return
+        block = file.read(min(COMPRESSION_BLOCK_SIZE, count - sent))
+        if not block:
+            raise ConnectionError(f"File shrank while sending: {sent} of {count} bytes sent")
+        sent += len(block)
+        compressed = codec.compress(block)
+
+
+def _send_buffered(sock, file, offset, count):
+    buffer = bytearray(min(SENDFILE_FALLBACK_BLOCK, count))
+    view = memoryview(buffer)
+    file.seek(offset)
+    sent = 0
+    while sent < count:
+        n = file.readinto(view[:min(len(buffer), count - sent)])
+        if not n:
+            break
+        sock.sendall(view[:n])
+        sent += n
+    return sent
+
+
+def recv_into_exact(sock, view):
+    """Fill the writable buffer `view` completely from the socket."""
+    view = memoryview(view).cast("B")
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("Connection closed mid-frame")
+        received += n
+
+
+def recv_exact(sock, size):
+    if size <= RECV_PREALLOCATE_LIMIT:
+        buffer = bytearray(size)
+        recv_into_exact(sock, buffer)
+        return bytes(buffer)
+    # Don't reserve a size taken from a header up front; a peer that announces more than it sends gets nowhere
+    buffer = bytearray()
+    while len(buffer) < size:
+        block = sock.recv(min(STREAM_BLOCK_SIZE, size - len(buffer)))
+        if not block:
+            raise ConnectionError("Connection closed mid-frame")
+        buffer += block
+    return bytes(buffer)
+
+
+def recv_header(sock):
+    """Read one frame header. Returns None if the peer closed cleanly between frames."""
+    header = bytearray(HEADER.size)
+    view = memoryview(header)
+    received = 0
+    while received < HEADER.size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            if received == 0:
+                return None
+            raise ConnectionError("Connection closed mid-header")
+        received += n
+    return unpack_header(header)
+
+
+def recv_frame(sock, max_size=MAX_MESSAGE_SIZE):
+    """Read one whole frame: (type, request_id, payload) or None on clean close."""
+    header = recv_header(sock)
+    if header is None:
+        return None
+    frame_type, request_id, length = header
+    if length > max_size:
+        raise ProtocolError(f"Frame of {length} bytes exceeds limit of {max_size}")
+    return frame_type, request_id, recv_exact(sock, length)
+
+
+def recv_reply(sock, request_id):
+    """Read the single-frame reply to `request_id` and return its payload."""
+    frame = recv_frame(sock)
+    if frame is None:
+        raise ConnectionError("Connection closed before reply")
+    frame_type, reply_id, payload = frame
+    if reply_id != request_id:
+        raise ProtocolError(f"Reply for request {reply_id}, expected {request_id}")
+    if frame_type == ERROR:
+        raise RemoteError(payload.decode(errors="replace"))
+    if frame_type != RESPONSE:
+        raise ProtocolError(f"Expected RESPONSE frame, got type {frame_type}")
+    return payload
+
+
+def iter_data(sock, request_id, block_size=STREAM_BLOCK_SIZE):
+    """Yield the payload of a DATA stream in blocks of at most `block_size` bytes.
+
+    DATA frames may be any size; they are never held in memory whole, except
+    compressed frames, which are decoded one frame at a time. The END frame's
+    payload (a trailer, usually empty) is the generator's return value.
+    """
+    codec = None
+    while True:
+        header = recv_header(sock)
+        if header is None:
+            raise ConnectionError("Connection closed before end of stream")
+        frame_type, reply_id, length = header
+        if reply_id != request_id:
+            raise ProtocolError(f"Frame for request {reply_id}, expected {request_id}")
+        if frame_type == END:
+            return recv_exact(sock, min(length, MAX_MESSAGE_SIZE)) if length else b""
+        if frame_type == ERROR:
+            raise RemoteError(recv_exact(sock, min(length, MAX_MESSAGE_SIZE)).decode(errors="replace"))
+        if frame_type == ENCODING:
+            codec = _read_codec(sock, length)
+            continue
+        if frame_type != DATA:
+            raise ProtocolError(f"Expected DATA frame, got type {frame_type}")
+        if codec is not None:
+            yield _read_compressed(sock, length, codec, MAX_MESSAGE_SIZE)
+            continue
+        while length:
+            block = recv_exact(sock, min(block_size, length))
+            length -= len(block)
+            yield block
+
+
+def recv_data_into(sock, request_id, buffer, on_first_frame=None):
+    """Receive a DATA stream straight into `buffer` with recv_into; return the byte count.
+
+    Used for pieces of known maximum size so no per-packet bytes objects are created.
+    on_first_frame() is called when the first reply header arrives (for RTT measurement).
+    """
+    view = memoryview(buffer).cast("B")
+    received = 0
+    codec = None
+    while True:
+        header = recv_header(sock)
+        if header is None:
+            raise ConnectionError("Connection closed before end of stream")
+        if on_first_frame is not None:
+            on_first_frame()
+            on_first_frame = None
+        frame_type, reply_id, length = header
+        if reply_id != request_id:
+            raise ProtocolError(f"Frame for request {reply_id}, expected {request_id}")
+        if frame_type == END:
+            if length:
+                recv_exact(sock, length)
+            return received
+        if frame_type == ERROR:
+            raise RemoteError(recv_exact(sock, min(length, MAX_MESSAGE_SIZE)).decode(errors="replace"))
+        if frame_type == ENCODING:
+            codec = _read_codec(sock, length)
+            continue
+        if frame_type != DATA:
+            raise ProtocolError(f"Expected DATA frame, got type {frame_type}")
+        if codec is not None:
+            if received >= len(view):
+                raise ProtocolError(f"DATA stream larger than the {len(view)}-byte receive buffer")
+            block = _read_compressed(sock, length, codec, len(view) - received)
+            view[received:received + len(block)] = block
+            received += len(block)
+            continue
+        if received + length > len(view):
+            raise ProtocolError(f"DATA stream larger than the {len(view)}-byte receive buffer")
+        recv_into_exact(sock, view[received:received + length])
+        received += length
+
+
+def _read_codec(sock, length):
+    if length > 64:
+        raise ProtocolError(f"ENCODING frame of {length} bytes")
+    try:
+        return compression.get_codec(recv_exact(sock, length).decode())
+    except ValueError as e:
+        raise ProtocolError(str(e))
+
+
+def _read_compressed(sock, length, codec, max_size):
+    if max_size <= 0:
+        raise ProtocolError("Compressed frame with no room left for its data")
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"Compressed frame of {length} bytes exceeds limit of {MAX_MESSAGE_SIZE}")
+    try:
+        return codec.decompress(recv_exact(sock, length), max_size)
+    except Exception as e:  # ValueError, zlib.error and the like from the codec
+        raise ProtocolError(f"Bad {codec.name} frame: {e}")
+
+
+async def read_frame(reader, max_size=MAX_MESSAGE_SIZE):
+    """asyncio counterpart of recv_frame for StreamReader."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed mid-header")
+    frame_type, request_id, length = unpack_header(header)
+    if length > max_size:
+        raise ProtocolError(f"Frame of {length} bytes exceeds limit of {max_size}")
+    try:
+        if length <= RECV_PREALLOCATE_LIMIT:
+            payload = await reader.readexactly(length)
+        else:
+            payload = bytearray()
+            while len(payload) < length:
+                payload += await reader.readexactly(min(STREAM_BLOCK_SIZE, length - len(payload)))
+            payload = bytes(payload)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed mid-frame")
+    return frame_type, request_id, payload
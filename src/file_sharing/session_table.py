@@ -0,0 +1,70 @@
+import time
+import secrets
+import threading
+from collections import OrderedDict
+
+
+class Session:
+    __slots__ = ("token", "user_id", "username", "expires_at")
+
+    def __init__(self, token, user_id, username, expires_at):
+        self.token = token
+        self.user_id = user_id
+        self.username = username
+        self.expires_at = expires_at
+
+
+class SessionTable:
+    """Login sessions by token, held in memory so commands never go back to the database.
+
+    A session expires after `ttl` seconds without use; every successful lookup
+    extends it. Sessions are kept in least-recently-used order, so expired ones
+    collect at the front and are dropped from there, and once `max_sessions` is
+    reached the least recently used session is evicted to make room.
+    """
+
+    def __init__(self, ttl, max_sessions):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # token -> Session, least recently used first
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, user_id, username):
+        now = time.monotonic()
+        session = Session(secrets.token_urlsafe(24), user_id, username, now + self.ttl)
+        with self.lock:
+            self._drop_expired(now)
+            while len(self.sessions) >= self.max_sessions:
+                self.sessions.popitem(last=False)
+            self.sessions[session.token] = session
+        return session
+
+    def get(self, token):
+        """The live session for `token` (its TTL restarted), or None if unknown, expired or evicted."""
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            if session.expires_at <= now:
+                del self.sessions[token]
+                return None
+            session.expires_at = now + self.ttl
+            self.sessions.move_to_end(token)
+            return session
+
+    def remove_user(self, user_id):
+        """End every session of a user; done once the server finds the account deleted."""
+        with self.lock:
+            for token in [token for token, session in self.sessions.items() if session.user_id == user_id]:
+                del self.sessions[token]
+
+    def _drop_expired(self, now):
+        while self.sessions:
+            token, session = next(iter(self.sessions.items()))
+            if session.expires_at > now:
+                break
+            del self.sessions[token]
@@ -0,0 +1,155 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+
+class TokenBucket:
+    """Rate limit in bytes per second with a burst allowance; rate None means unlimited.
+
+    Not thread-safe on its own: UploadManager guards every bucket with its lock.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst=None):
+        self.refill()
+        self.rate = rate
+        self.burst = burst or (max(rate / 4, UploadManager.QUANTUM) if rate else 0)
+        self.tokens = min(self.tokens, self.burst) if rate else 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, size):
+        """Seconds until `size` bytes may go out (0 if now); sizes above the burst wait for a full bucket."""
+        if not self.rate:
+            return 0
+        self.refill()
+        needed = min(size, self.burst)
+        return 0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def consume(self, size):
+        if self.rate:
+            self.tokens -= size  # May go negative after an oversized send; later sends repay it
+
+
+class Upload:
+    """One peer connection's share of the upload bandwidth."""
+
+    def __init__(self, manager, peer):
+        self.manager = manager
+        self.peer = peer  # Peer address the fair queue groups uploads by
+        self.bucket = TokenBucket(manager.per_connection_rate)
+
+    @property
+    def throttle(self):
+        """Callable blocking until n more bytes may be sent.
+
+        Given even while uploads are unlimited, so limits configured later apply
+        to transfers already running; until then it returns at once.
+        """
+        return self.wait_for
+
+    def wait_for(self, size):
+        self.manager.acquire(self, size)
+
+    def close(self):
+        self.manager.unregister(self)
+
+
+class UploadManager:
+    """Shapes and shares the upload bandwidth of the peer listener.
+
+    Every connection gets an Upload with its own token bucket (per_connection_rate)
+    and all of them draw from a global bucket (global_rate), both in bytes per
+    second, None meaning unlimited. Senders ask for QUANTUM-sized grants; grants
+    from the global bucket are handed out round-robin between peer addresses,
+    first come first served within a peer, so one downloader with many
+    connections cannot starve the others. Limits can be changed at any time with
+    configure(); waiting senders pick the new rates up immediately.
+    """
+    QUANTUM = 64 * 1024  # Bytes sent per grant while a limit is active
+
+    def __init__(self, global_rate=None, per_connection_rate=None):
+        self.condition = threading.Condition()
+        self.global_rate = global_rate
+        self.per_connection_rate = per_connection_rate
+        self.bucket = TokenBucket(global_rate)
+        self.uploads = set()
+        self.waiting = OrderedDict()  # peer -> deque of waiting tickets, served round-robin
+
+    @property
+    def limited(self):
+        return bool(self.global_rate or self.per_connection_rate)
+
+    def configure(self, global_rate=None, per_connection_rate=None):
+        with self.condition:
+            self.global_rate = global_rate
+            self.per_connection_rate = per_connection_rate
+            self.bucket.configure(global_rate)
+            for upload in self.uploads:
+                upload.bucket.configure(per_connection_rate)
+            self.condition.notify_all()
+        print(f"Upload limits: total {global_rate or 'unlimited'} B/s, "
+              f"per connection {per_connection_rate or 'unlimited'} B/s")
+
+    def register(self, peer):
+        with self.condition:
+            upload = Upload(self, peer)
+            self.uploads.add(upload)
+            return upload
+
+    def unregister(self, upload):
+        with self.condition:
+            self.uploads.discard(upload)
+
+    def acquire(self, upload, size):
+        """Block until `size` bytes may be sent on `upload`'s connection."""
+        if not self.limited:
+            return  # Unlimited: no lock, no queueing
+        with self.condition:
+            # The connection's own limit is waited out before queueing, so a capped
+            # connection never holds up the head of the shared queue
+            while True:
+                delay = upload.bucket.delay(size)
+                if delay <= 0:
+                    break
+                self.condition.wait(delay)
+
+            ticket = object()
+            self.waiting.setdefault(upload.peer, deque()).append(ticket)
+            while True:
+                peer, tickets = next(iter(self.waiting.items()))
+                if tickets[0] is ticket:
+                    delay = self.bucket.delay(size)
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                else:
+                    self.condition.wait()
+
+            tickets.popleft()
+            if tickets:
+                self.waiting.move_to_end(peer)  # Next grant goes to another peer
+            else:
+                del self.waiting[peer]
+            self.bucket.consume(size)
+            upload.bucket.consume(size)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "uploads": len(self.uploads),
+                "waiting": sum(len(tickets) for tickets in self.waiting.values()),
+                "global_rate": self.global_rate,
+                "per_connection_rate": self.per_connection_rate,
+            }
@@ -40,15 +40,23 @@ class LoginPage(tk.Frame):
         username = self.username_entry.get()
         password = self.password_entry.get()
         if username and password:
-            result = self.file_client.login(username, password)
-            if result:
-                messagebox.showinfo("Login", "Login Successful")
-                self.master.on_authenticated()
-            else:
-                messagebox.showerror("Login Error", "Login failed. Please try again.")
+            self.master.tasks.submit(
+                self.file_client.login,
+                username,
+                password,
+                on_done=self.login_finished,
+                on_error=lambda e: messagebox.showerror("Login Error", f"Login failed: {e}"),
+            )
         else:
             messagebox.showerror("Input Error", "Please enter both username and password.")
 
+    def login_finished(self, result):
+        if result:
+            messagebox.showinfo("Login", "Login Successful")
+            self.master.on_authenticated()
+        else:
+            messagebox.showerror("Login Error", "Login failed. Please try again.")
+
 class RegisterPage(tk.Frame):
     """Registration Page."""
     def __init__(self, master, file_client):
@@ -77,8 +85,16 @@ class RegisterPage(tk.Frame):
         username = self.username_entry.get()
         password = self.password_entry.get()
         if username and password:
-            self.file_client.register(username, password)
-            messagebox.showinfo("Registration", "Registration successful!")
-            self.master.switch_frame(LoginPage)
+            self.master.tasks.submit(
+                self.file_client.register,
+                username,
+                password,
+                on_done=self.register_finished,
+                on_error=lambda e: messagebox.showerror("Registration Error", f"Registration failed: {e}"),
+            )
         else:
-            messagebox.showerror("Input Error", "Please enter both username and password.")
\ No newline at end of file
+            messagebox.showerror("Input Error", "Please enter both username and password.")
+
+    def register_finished(self, _):
+        messagebox.showinfo("Registration", "Registration successful!")
+        self.master.switch_frame(LoginPage)
@@ -0,0 +1,60 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BackgroundTasks:
+    """Runs FileClient calls on worker threads and hands the results back to the Tk thread.
+
+    Tk widgets may only be touched from the thread running mainloop, so workers
+    never call back directly: results go into a queue that the Tk thread drains
+    every POLL_INTERVAL_MS through after().
+
+        tasks.submit(client.list_file_in_directory, ip, port, path,
+                     on_done=show_files, on_error=show_error)
+
+    Callbacks that are methods (or partials of methods) of a widget destroyed in
+    the meantime are dropped.
+    """
+    MAX_WORKERS = 16  # Concurrent network calls; downloads hold a worker until they finish
+    POLL_INTERVAL_MS = 50  # How often finished calls are delivered to the GUI
+
+    def __init__(self, root):
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix="gui-network")
+        self.results = queue.Queue()
+        self.root.after(self.POLL_INTERVAL_MS, self.deliver)
+
+    def submit(self, function, *args, on_done=None, on_error=None, **kwargs):
+        """Run function(*args, **kwargs) in the background; on_done(result) or on_error(exception) runs on the Tk thread."""
+        def run():
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if on_error is not None:
+                    self.results.put((on_error, (e,)))
+            else:
+                if on_done is not None:
+                    self.results.put((on_done, (result,)))
+        return self.executor.submit(run)
+
+    def call_soon(self, callback, *args):
+        """Run callback(*args) on the Tk thread; safe to call from any thread (e.g. progress reports)."""
+        self.results.put((callback, args))
+
+    def deliver(self):
+        while True:
+            try:
+                callback, args = self.results.get_nowait()
+            except queue.Empty:
+                break
+            widget = getattr(getattr(callback, "func", callback), "__self__", None)  # Unwraps functools.partial
+            if widget is not None and hasattr(widget, "winfo_exists") and not widget.winfo_exists():
+                continue  # The page it belonged to is gone
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Error in GUI callback: {e}")
+        self.root.after(self.POLL_INTERVAL_MS, self.deliver)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -2,6 +2,7 @@ import tkinter as tk
 from tkinter import ttk
 from src.gui.main_app_page import MainAppPage
 from src.gui.auth_gui import AuthGUI
+from src.gui.background import BackgroundTasks
 from src.dhcp.dhcp_client import DhcpClient
 from src.file_sharing.file_client import FileClient
 
@@ -10,8 +11,9 @@ class MainApplication(tk.Tk):
     def __init__(self, file_client):
         super().__init__()
         self.file_client = file_client
+        self.tasks = BackgroundTasks(self)  # Network calls made by the pages
         self.title("File Sharing Application")
-        self.geometry("500x400")
+        self.geometry("560x560")  # Room for the download rows
         self.resizable(False, False)
         self.style = ttk.Style(self)
         self.configure_styles(self.style)
@@ -29,6 +31,7 @@ class MainApplication(tk.Tk):
         self.switch_frame(MainAppPage)
 
     def on_logout(self):
+        self.file_client.unsubscribe()
         self.switch_frame(AuthGUI)
 
     def switch_frame(self, frame_class, **kwargs):
@@ -1,14 +1,27 @@
 import os
+import threading
 import tkinter as tk
+from functools import partial
 from tkinter import ttk, messagebox, simpledialog
 
+from src.gui.transfer_panel import TransferPanel
+
 class MainAppPage(tk.Frame):
-    """Main Application Page."""
+    """Main Application Page.
+
+    Nothing here talks to the network on the Tk thread: FileClient calls go
+    through master.tasks (a BackgroundTasks) and their results are applied when
+    they come back, so a slow peer or a large download never freezes the window.
+    """
+    POLL_INTERVAL_MS = 500  # How often the tree is synced with the client's directory replica
+
     def __init__(self, master, file_client):
         super().__init__(master, bg="#f8f9fa")
         self.file_client = file_client
         self.master = master
+        self.tasks = master.tasks
         self.current_path = "/"  # Root directory by default
+        self.refresh_generation = 0  # Only the latest Refresh may repaint the tree
         self.build_ui()
 
     def build_ui(self):
@@ -82,6 +95,7 @@ class MainAppPage(tk.Frame):
         style.configure("Treeview.Heading", font=("Arial", 12, "bold"))
 
         self.treeview.bind("<Double-1>", self.on_treeview_click)
+        self.treeview.bind("<<TreeviewOpen>>", self.on_treeview_open)
 
         # Control Buttons
         button_frame = tk.Frame(explorer_frame, bg="#f8f9fa")
@@ -90,64 +104,110 @@ class MainAppPage(tk.Frame):
         ttk.Button(button_frame, text="Back", command=self.go_back).pack(side="left", padx=5)
         ttk.Button(button_frame, text="Refresh", command=self.refresh_directory).pack(side="right", padx=5)
 
-        # Load initial directory
+        # Downloads, with progress and a Cancel button each
+        self.transfers = TransferPanel(explorer_frame)
+        self.transfers.pack(fill="x")
+
+        # Load initial directory, then follow the tracker's pushed changes
+        self.replica_version = None
+        self.file_client.subscribe()
         self.refresh_directory()
+        self.after(self.POLL_INTERVAL_MS, self.poll_directory_updates)
 
     def create_folder(self):
         """Create a new folder in the current directory."""
         folder_name = simpledialog.askstring("Create Folder", "Enter folder name:")
         if folder_name:
-            try:
-                # Use the file_client's create_directory method to create the folder
-                success = self.file_client.create_directory(folder_name)
-                if success:
-                    messagebox.showinfo("Success", f"Folder '{folder_name}' created!")
-                    self.refresh_directory()  # Refresh the directory to show the new folder
-                else:
-                    messagebox.showerror("Error", "Failed to create folder.")
-            except Exception as e:
-                messagebox.showerror("Error", f"Error creating folder: {e}")
+            # Use the file_client's create_directory method to create the folder
+            self.tasks.submit(
+                self.file_client.create_directory,
+                folder_name,
+                on_done=partial(self.folder_created, folder_name),
+                on_error=partial(self.show_error, "Error creating folder"),
+            )
         else:
             messagebox.showwarning("Cancelled", "Folder creation cancelled.")
 
+    def folder_created(self, folder_name, success):
+        if success:
+            messagebox.showinfo("Success", f"Folder '{folder_name}' created!")
+            self.refresh_directory()  # Refresh the directory to show the new folder
+        else:
+            messagebox.showerror("Error", "Failed to create folder.")
+
+    def show_error(self, message, error):
+        messagebox.showerror("Error", f"{message}: {error}")
+
     def refresh_directory(self):
         """Fetch and display the list of directories and files shared by users."""
+        self.refresh_generation += 1
+        # The pushed replica is current already; only ask the tracker if the subscription is down
+        if self.file_client.subscribed:
+            self.replica_version = self.file_client.replica_version
+            self.show_directories(self.refresh_generation, self.file_client.get_directory_tree())
+        else:
+            self.tasks.submit(
+                self.file_client.get_active_directories,  # Fetch directories
+                on_done=partial(self.show_directories, self.refresh_generation),
+                on_error=partial(self.show_error, "Error fetching directories"),
+            )
+
+    def show_directories(self, generation, active_dirs):
+        if generation != self.refresh_generation:
+            return  # A newer refresh was started meanwhile
         self.treeview.delete(*self.treeview.get_children())  # Clear existing items
-
-        # Get active directories shared by users
-        self.active_dirs = self.file_client.get_active_directories()  # Fetch directories
-
-        if self.active_dirs:
-            for user in self.active_dirs:
-                user_id = user['user_id']
-                if user_id != self.file_client.user_id:
-                    directories = user['directories']
-
-                    # Insert user_id as a root node
-                    user_node = self.treeview.insert("", "end", user_id, text=f"User {user_id}", tags=("user",))
-
-                    for directory in directories:
-                        # Insert directory names under the user node with the path as a hidden value
-                        directory_node = self.treeview.insert(
-                            user_node,
-                            "end",
-                            f"{user_id}_{directory['name']}",  # Use directory name as the item ID for simplicity
-                            text=directory['name'],  # Display the name in the tree view
-                            values=(user['ip'], user['port'], directory['path']),  # Store the hidden path in 'values'
-                            tags=("directory",)
-                        )
-                        # Insert a placeholder for files to be fetched when the directory is clicked
-                        self.treeview.insert(directory_node, "end", text="...", tags=("loading",))  # Placeholder for files
+        self.active_dirs = active_dirs or []
+        self.sync_directory_tree(self.active_dirs)
 
         self.treeview.tag_configure("user", foreground="#007BFF")  # Style for user nodes
         self.treeview.tag_configure("directory", foreground="#6c757d")  # Style for directories
 
+    def poll_directory_updates(self):
+        """Apply replica changes pushed since the last poll, leaving opened directories as they are."""
+        if not self.winfo_exists():
+            return
+        version = self.file_client.replica_version
+        if self.file_client.subscribed and version != self.replica_version:
+            self.replica_version = version
+            self.active_dirs = self.file_client.get_directory_tree()
+            self.sync_directory_tree(self.active_dirs)
+        self.after(self.POLL_INTERVAL_MS, self.poll_directory_updates)
+
+    def sync_directory_tree(self, users):
+        """Add and remove user and directory nodes so the tree matches `users`; other nodes are untouched."""
+        wanted = {str(user['user_id']): user for user in users if user['user_id'] != self.file_client.user_id}
+        for item in self.treeview.get_children():
+            if item not in wanted:
+                self.treeview.delete(item)  # User went offline
+
+        for user_node, user in wanted.items():
+            if not self.treeview.exists(user_node):
+                # Insert user_id as a root node
+                self.treeview.insert("", "end", user_node, text=f"User {user_node}", tags=("user",))
+
+            for directory in user['directories']:
+                directory_node = f"{user_node}_{directory['name']}"  # Use directory name as the item ID for simplicity
+                values = (user['ip'], user['port'], directory['path'])  # Store the hidden path in 'values'
+                if self.treeview.exists(directory_node):
+                    self.treeview.item(directory_node, values=values)  # The user may be back on another port
+                    continue
+                # Insert directory names under the user node with the path as a hidden value
+                self.treeview.insert(
+                    user_node,
+                    "end",
+                    directory_node,
+                    text=directory['name'],  # Display the name in the tree view
+                    values=values,
+                    tags=("directory",)
+                )
+                # Insert a placeholder for files to be fetched when the directory is opened
+                self.treeview.insert(directory_node, "end", text="...", tags=("loading",))  # Placeholder for files
+
     def on_treeview_click(self, event):
         """Handle treeview item double-click."""
         selected_item = self.treeview.selection()
         if selected_item:
             item = self.treeview.item(selected_item[0])
-            selected_name = item["text"]
             hidden_values = item["values"]
 
             if hidden_values:
@@ -157,48 +217,106 @@ class MainAppPage(tk.Frame):
                 elif item['tags'][0] == 'file':  # Check if it's a file
                     self.download_file(target_ip, target_port, path)
 
+    def on_treeview_open(self, event):
+        """Load a directory's files the first time its node is expanded."""
+        item_id = self.treeview.focus()
+        item = self.treeview.item(item_id)
+        if item["tags"] and item["tags"][0] == "directory" and item["values"]:
+            target_ip, target_port, path = item["values"]
+            self.refresh_directory_contents(item_id, target_ip, target_port, path)
+
     def refresh_directory_contents(self, parent_item, target_ip, target_port, directory_path):
-        """Fetch and display contents of a directory."""
+        """Fetch the contents of a directory in the background, once; several may load at the same time."""
+        placeholders = [
+            child for child in self.treeview.get_children(parent_item)
+            if self.treeview.item(child)["tags"][0] == "loading"
+        ]
+        if not placeholders or self.treeview.item(placeholders[0])["text"] == "Loading...":
+            return  # Already loaded, or on its way
+        self.treeview.item(placeholders[0], text="Loading...")
+
+        # Get the files in the directory; request_file_list raises on failure so it can be told from an empty one
+        self.tasks.submit(
+            self.file_client.request_file_list,
+            target_ip,
+            target_port,
+            directory_path,
+            self.file_client.PEER_TIMEOUT,
+            on_done=partial(self.show_directory_contents, parent_item, target_ip, target_port),
+            on_error=partial(self.show_directory_contents, parent_item, target_ip, target_port, None),
+        )
+
+    def show_directory_contents(self, parent_item, target_ip, target_port, files, error=None):
+        if not self.treeview.exists(parent_item):
+            return  # The user went offline meanwhile
+        placeholders = [
+            child for child in self.treeview.get_children(parent_item)
+            if self.treeview.item(child)["tags"][0] == "loading"
+        ]
+        if files is None:
+            # Keep the placeholder so the directory can be opened again to retry
+            for child in placeholders:
+                self.treeview.item(child, text="(unavailable, reopen to retry)")
+            return
         # Clear existing placeholders
-        for child in self.treeview.get_children(parent_item):
-            if self.treeview.item(child)["tags"][0] == "loading":
-                self.treeview.delete(child)
-
-        # Get the files in the directory
-        files = self.file_client.list_file_in_directory(target_ip, target_port, directory_path)
-        if files:
-            for file in files:
-                self.treeview.insert(
-                    parent_item,
-                    "end",
-                    file['name'],  # Display file name
-                    text=file['name'],
-                    values=(target_ip, target_port, file['path']),  # Store file path in 'values'
-                    tags=("file",)  # Tag the item as a file
-                )
+        self.treeview.delete(*placeholders)
+        for file in files:
+            self.treeview.insert(
+                parent_item,
+                "end",
+                f"{parent_item}/{file['name']}",  # Unique across directories
+                text=file['name'],  # Display file name
+                values=(target_ip, target_port, file['path']),  # Store file path in 'values'
+                tags=("file",)  # Tag the item as a file
+            )
 
     def download_file(self, target_ip, target_port, file_path):
-        """Download the selected file from the peer."""
-        try:
-            file_name = os.path.basename(file_path)
-            download_directory = f"D:/shared_directories/{self.file_client.user_id}/download"
-            download_path = os.path.join(download_directory, file_name)
-
-            peers = self.file_client.search_file_across_peers(file_name)
+        """Download the selected file from the peer, in the background with a progress row."""
+        file_name = os.path.basename(file_path)
+        row = self.transfers.add(file_name, threading.Event())
+        self.tasks.submit(
+            self.file_client.search_file_across_peers,
+            file_name,
+            on_done=partial(self.start_download, row, target_ip, target_port, file_path),
+            on_error=partial(self.download_failed, row),
+        )
 
-            if len(peers) > 1:
-                response = messagebox.askyesno("BitTorrent Download", f"File '{file_name}' found on {len(peers)} peers. Do you want to download using BitTorrent?")
-                if response:
-                    self.file_client.download_file_bittorrent(file_name, peers)
-                    return
+    def start_download(self, row, target_ip, target_port, file_path, peers):
+        file_name = os.path.basename(file_path)
+        if row.cancel_event.is_set():
+            row.finish("Cancelled")
+            return
+
+        download = partial(self.file_client.download_file, target_ip, target_port, file_path)
+        if len(peers) > 1:
+            response = messagebox.askyesno("BitTorrent Download", f"File '{file_name}' found on {len(peers)} peers. Do you want to download using BitTorrent?")
+            if response:
+                download = partial(self.file_client.download_file_bittorrent, file_name, peers)
+
+        row.status_label.configure(text="Connecting...")
+        self.tasks.submit(
+            download,
+            progress=partial(self.tasks.call_soon, row.update_progress),  # Called from download threads
+            cancel=row.cancel_event,
+            on_done=partial(self.download_finished, row),
+            on_error=partial(self.download_failed, row),
+        )
 
-            self.file_client.download_file(target_ip, target_port, file_path)
+    def download_finished(self, row, success):
+        if success:
+            row.finish("Downloaded")
+        elif row.cancel_event.is_set():
+            row.finish("Cancelled, can be resumed")
+        else:
+            row.finish("Failed, retry to resume")
 
-            # Confirm success
-            messagebox.showinfo("Download Complete", f"File '{file_name}' has been downloaded to '{download_path}'")
+    def download_failed(self, row, error):
+        row.finish(f"Error: {error}")
 
-        except Exception as e:
-            messagebox.showerror("Error", f"Error downloading file: {e}")
+    def destroy(self):
+        # Leaving the page (e.g. logout) stops running downloads; their progress is kept for resuming
+        self.transfers.cancel_all()
+        super().destroy()
 
     def go_back(self):
         """Navigate back to the parent directory."""
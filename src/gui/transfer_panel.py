@@ -0,0 +1,97 @@
+import time
+import tkinter as tk
+from collections import deque
+from tkinter import ttk
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class TransferRow(tk.Frame):
+    """One download: name, progress bar, speed and ETA, and a Cancel button."""
+    SPEED_WINDOW = 5  # Seconds of progress reports the speed is averaged over
+    REDRAW_INTERVAL = 0.1  # Seconds between redraws; progress may be reported per piece
+
+    def __init__(self, master, file_name, cancel):
+        super().__init__(master, bg="#f8f9fa")
+        self.cancel_event = cancel
+        self.samples = deque()  # (time, bytes done) within the last SPEED_WINDOW seconds
+        self.last_redraw = 0
+
+        tk.Label(self, text=file_name, bg="#f8f9fa", anchor="w", width=16).pack(side="left", padx=5)
+        self.progress_bar = ttk.Progressbar(self, mode="indeterminate", length=150)
+        self.progress_bar.pack(side="left", padx=5)
+        self.progress_bar.start()
+        self.status_label = tk.Label(self, text="Searching peers...", bg="#f8f9fa", anchor="w", width=20)
+        self.status_label.pack(side="left", padx=5)
+        self.button = ttk.Button(self, text="Cancel", command=self.cancel)
+        self.button.pack(side="right", padx=5)
+
+    def update_progress(self, done, total):
+        now = time.monotonic()
+        self.samples.append((now, done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.SPEED_WINDOW:
+            self.samples.popleft()
+        if now - self.last_redraw < self.REDRAW_INTERVAL and done < total:
+            return
+        self.last_redraw = now
+
+        if str(self.progress_bar["mode"]) == "indeterminate":
+            self.progress_bar.stop()
+            self.progress_bar.configure(mode="determinate", maximum=max(total, 1))
+        self.progress_bar["value"] = done
+
+        start_time, start_done = self.samples[0]
+        speed = (done - start_done) / (now - start_time) if now > start_time else 0
+        if self.cancel_event.is_set():
+            return
+        if speed > 0:
+            eta = format_duration((total - done) / speed)
+            self.status_label.configure(text=f"{format_size(speed)}/s, {eta} left")
+        else:
+            self.status_label.configure(text=f"{format_size(done)} of {format_size(total)}")
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.button.configure(state="disabled")
+        self.status_label.configure(text="Cancelling...")
+
+    def finish(self, message):
+        """The download ended; show `message` and let the user dismiss the row."""
+        self.progress_bar.stop()
+        if str(self.progress_bar["mode"]) == "indeterminate":
+            self.progress_bar.configure(mode="determinate", maximum=1, value=0)
+        self.status_label.configure(text=message)
+        self.button.configure(text="Close", state="normal", command=self.destroy)
+
+
+class TransferPanel(tk.Frame):
+    """The list of running and finished downloads under the directory explorer."""
+
+    def __init__(self, master):
+        super().__init__(master, bg="#f8f9fa")
+        self.rows = []
+
+    def add(self, file_name, cancel):
+        self.rows = [row for row in self.rows if row.winfo_exists()]  # Drop closed rows
+        row = TransferRow(self, file_name, cancel)
+        row.pack(fill="x", pady=2)
+        self.rows.append(row)
+        return row
+
+    def cancel_all(self):
+        for row in self.rows:
+            row.cancel_event.set()
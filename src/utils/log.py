@@ -0,0 +1,49 @@
+"""Leveled logging for messages on busy paths (one per request, piece or connection).
+
+Messages go to stdout like the rest of the program's output, but below the
+configured level they cost one integer comparison: pass the arguments
+separately (log.debug("Sent %s", path)) so nothing is formatted unless it is
+printed. The level comes from the P2P_LOG_LEVEL environment variable (DEBUG,
+INFO, WARNING, ERROR; INFO by default) or set_level().
+"""
+import os
+import sys
+import logging
+
+ROOT_LOGGER = "p2p"
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is when the message is emitted, as print does."""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, _):
+        pass
+
+
+def _configure():
+    root = logging.getLogger(ROOT_LOGGER)
+    if not root.handlers:
+        handler = _StdoutHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        root.addHandler(handler)
+        root.propagate = False
+        root.setLevel(os.environ.get("P2P_LOG_LEVEL", "INFO").upper())
+    return root
+
+
+def get_logger(name):
+    _configure()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def set_level(level):
+    """Change the level of every logger from get_logger, e.g. set_level("DEBUG")."""
+    _configure().setLevel(level.upper() if isinstance(level, str) else level)
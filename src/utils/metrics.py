@@ -0,0 +1,211 @@
+"""In-process counters, gauges and histograms, readable as JSON (STATS) or Prometheus text.
+
+Metrics live in a MetricsRegistry; each one may carry label names, and every
+update names the label values as a tuple:
+
+    requests = registry.counter("requests_total", "Requests handled", ("command",))
+    requests.inc(labels=("LOGIN",))
+
+Updates take one lock and a dict lookup, so they are cheap enough for the
+request path. A metric created with function=... has no state of its own and is
+read from the callback when collected (e.g. len(active_users)).
+"""
+import json
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; covers a cached reply on loopback up to a slow database write
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help_text, label_names=(), function=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.function = function  # () -> value, or {label values: value} for labelled metrics
+        self.values = {}  # label values -> value
+        self.lock = threading.Lock()
+
+    def collect(self):
+        """{label values: value} at this moment."""
+        if self.function is not None:
+            value = self.function()
+            return dict(value) if isinstance(value, dict) else {(): value}
+        with self.lock:
+            return dict(self.values)
+
+    def snapshot(self):
+        values = self.collect()
+        if not self.label_names:
+            return values.get((), 0)
+        return {",".join(map(str, labels)): value for labels, value in values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.TYPE}"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram; STATS shows count, sum and bucket-estimated p50/p90/p99."""
+    TYPE = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                # Per-bucket (not cumulative) counts, the last one for values above every bound
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        with self.lock:
+            return {labels: (list(counts), total, count) for labels, (counts, total, count) in self.values.items()}
+
+    def quantile(self, counts, count, fraction):
+        """Upper bound of the bucket holding the given fraction of observations."""
+        rank, seen = fraction * count, 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def summarize(self, counts, total, count):
+        summary = {"count": count, "sum": total, "mean": total / count if count else None}
+        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            value = self.quantile(counts, count, fraction) if count else None
+            summary[name] = None if value == float("inf") else value
+        return summary
+
+    def snapshot(self):
+        values = {labels: self.summarize(*series) for labels, series in self.collect().items()}
+        if not self.label_names:
+            return values.get((), self.summarize([0] * (len(self.buckets) + 1), 0.0, 0))
+        return {",".join(map(str, labels)): summary for labels, summary in values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.TYPE}"]
+        for labels, (counts, total, count) in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                label_text = _format_labels(self.label_names, labels, (("le", _format_value(bound)),))
+                lines.append(f"{self.name}_bucket{label_text} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label_names=(), function=None):
+        return self.register(Counter(name, help_text, label_names, function))
+
+    def gauge(self, name, help_text, label_names=(), function=None):
+        return self.register(Gauge(name, help_text, label_names, function))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def snapshot(self):
+        """Every metric as plain JSON-serialisable values, for the STATS command."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def render_prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass  # Scrapes every few seconds would flood the console
+
+
+def start_metrics_server(registry, port, host="127.0.0.1"):
+    """Serve /metrics for Prometheus on a background thread; localhost only unless `host` says otherwise."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server